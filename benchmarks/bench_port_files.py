@@ -0,0 +1,59 @@
+"""
+Compares the cost of finding stale vRouter ports in a port directory.
+
+The previous get_all_port_uuids listed the directory and stat'ed every file,
+then looked each UUID up in the Database; with a watched PortFileIndex the
+directory isn't touched and stale ports are a set difference.
+Run from the repository root: python -m benchmarks.bench_port_files
+"""
+from __future__ import print_function
+
+from builtins import range
+import os
+import shutil
+import tempfile
+import timeit
+
+from cvm.clients import PortFileIndex
+
+PORTS = 5000
+STALE = 50
+REPEAT = 5
+
+
+def find_stale_before(path, vmi_models):
+    """ The previous listing plus per-file stat and per-UUID lookup. """
+    port_uuids = []
+    for file_name in os.listdir(path):
+        if os.path.isfile(os.path.join(path, file_name)):
+            port_uuids.append(file_name)
+    return [port_uuid for port_uuid in port_uuids if vmi_models.get(port_uuid) is None]
+
+
+def find_stale_after(index, vmi_models):
+    return set(index.get_uuids()).difference(vmi_models)
+
+
+def main():
+    path = tempfile.mkdtemp()
+    try:
+        uuids = ['port-uuid-%d' % i for i in range(PORTS)]
+        for uuid in uuids:
+            open(os.path.join(path, uuid), 'w').close()
+        vmi_models = dict.fromkeys(uuids[STALE:], object())
+        index = PortFileIndex(path)
+        start = timeit.default_timer()
+        index.rescan()
+        print('seed     one scan of %d port files: %.2fms' % (PORTS, (timeit.default_timer() - start) * 1e3))
+        index.watched = True
+        assert len(find_stale_before(path, vmi_models)) == len(find_stale_after(index, vmi_models)) == STALE
+        for label, find_stale in (('before', lambda: find_stale_before(path, vmi_models)),
+                                  ('after', lambda: find_stale_after(index, vmi_models))):
+            best = min(timeit.Timer(find_stale).repeat(repeat=REPEAT, number=1))
+            print('%-8s stale port detection: %.2fms' % (label, best * 1e3))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Measures UpdateHandler dispatch cost per change over synthetic update sets.
+
+The handlers only count calls, so the numbers show routing overhead alone.
+Run from the repository root: python -m benchmarks.bench_update_handler
+"""
+from __future__ import print_function
+
+from builtins import range
+import random
+import timeit
+
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+from cvm import controllers
+
+EVENTS_PER_PAGE = 1000
+PAGES = 5
+PROPERTY_CHANGES = 5000
+REPEAT = 5
+
+EVENT_TYPES = (
+    vim.event.VmCreatedEvent,
+    vim.event.VmRegisteredEvent,
+    vim.event.VmRenamedEvent,
+    vim.event.VmReconfiguredEvent,
+    vim.event.VmRemovedEvent,
+    vim.event.VmPoweredOnEvent,
+    vim.event.VmPoweredOffEvent,
+    vim.event.UserLoginSessionEvent,
+)
+PROPERTY_NAMES = ('guest.net', 'guest.toolsRunningStatus', 'runtime.powerState', 'config.hardware.device')
+
+
+def make_counting_handler(handler_class):
+    class CountingHandler(handler_class):
+        calls = 0
+
+        def _handle_event(self, event):
+            CountingHandler.calls += 1
+
+        def _handle_change(self, obj, value):
+            if isinstance(self, controllers.AbstractEventHandler):
+                return handler_class._handle_change(self, obj, value)
+            CountingHandler.calls += 1
+            return None
+
+        def _log_managed_object_not_found(self, value):
+            pass
+
+    CountingHandler.__name__ = handler_class.__name__
+    return CountingHandler()
+
+
+def make_handlers():
+    return [make_counting_handler(handler_class) for handler_class in (
+        controllers.VmUpdatedHandler,
+        controllers.VmRegisteredHandler,
+        controllers.VmRenamedHandler,
+        controllers.VmReconfiguredHandler,
+        controllers.VmRemovedHandler,
+        controllers.GuestNetHandler,
+        controllers.VmwareToolsStatusHandler,
+        controllers.PowerStateHandler,
+    )]
+
+
+def make_update_set(rng):
+    update_set = vmodl.query.PropertyCollector.UpdateSet()
+    filter_update = vmodl.query.PropertyCollector.FilterUpdate()
+    key = 0
+    for _ in range(PAGES):
+        events = []
+        for _ in range(EVENTS_PER_PAGE):
+            event = rng.choice(EVENT_TYPES)()
+            event.key = key
+            event.vm = vim.event.VmEventArgument(name='vm-%d' % (key % 100))
+            key += 1
+            events.append(event)
+        rng.shuffle(events)
+        filter_update.objectSet.append(make_object_update('latestPage', vim.event.Event.Array(events)))
+    for _ in range(PROPERTY_CHANGES):
+        filter_update.objectSet.append(make_object_update(rng.choice(PROPERTY_NAMES), 'value'))
+    update_set.filterSet = [filter_update]
+    return update_set
+
+
+def make_object_update(name, value):
+    object_update = vmodl.query.PropertyCollector.ObjectUpdate()
+    change = vmodl.query.PropertyCollector.Change()
+    change.name = name
+    change.val = value
+    object_update.changeSet = [change]
+    return object_update
+
+
+def handle_update_by_scanning(handlers, update_set):
+    """ The previous dispatch: every change goes through every handler. """
+    for property_filter_update in update_set.filterSet:
+        for object_update in property_filter_update.objectSet:
+            for property_change in object_update.changeSet:
+                for handler in handlers:
+                    handler.handle_change(object_update.obj, property_change)
+
+
+def main():
+    update_set = make_update_set(random.Random(0))
+    changes = PAGES * EVENTS_PER_PAGE + PROPERTY_CHANGES
+    handlers = make_handlers()
+    update_handler = controllers.UpdateHandler(handlers)
+    for label, dispatch in (
+            ('scan all handlers', lambda: handle_update_by_scanning(handlers, update_set)),
+            ('routing table', lambda: update_handler.handle_update(update_set))):
+        best = min(timeit.Timer(dispatch).repeat(repeat=REPEAT, number=1))
+        print('%-18s %d changes: %.4fs (%.2fus per change)' % (label, changes, best, best * 1e6 / changes))
+
+
+if __name__ == '__main__':
+    main()
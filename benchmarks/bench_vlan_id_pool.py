@@ -0,0 +1,65 @@
+"""
+Compares VlanIdPool with the deque-based pool it replaced.
+
+Run from the repository root: python -m benchmarks.bench_vlan_id_pool
+"""
+from __future__ import print_function
+
+from builtins import object
+from builtins import range
+import random
+import timeit
+from collections import deque
+
+from cvm.constants import VLAN_ID_RANGE_END, VLAN_ID_RANGE_START
+from cvm.models import VlanIdPool
+
+ALLOCATIONS = 4094
+REPEAT = 5
+
+
+class DequeVlanIdPool(object):
+    """ The previous implementation, without logging. """
+
+    def __init__(self, start, end):
+        self._available_ids = deque(list(range(start, end + 1)))
+
+    def reserve(self, vlan_id):
+        try:
+            self._available_ids.remove(vlan_id)
+        except ValueError:
+            pass
+
+    def get_available(self):
+        return self._available_ids.popleft()
+
+    def free(self, vlan_id):
+        if vlan_id not in self._available_ids:
+            self._available_ids.append(vlan_id)
+
+    def is_available(self, vlan_id):
+        return vlan_id in self._available_ids
+
+
+def allocate_and_free(pool_class, vlan_ids_to_free):
+    pool = pool_class(VLAN_ID_RANGE_START, VLAN_ID_RANGE_END)
+    for _ in range(ALLOCATIONS):
+        pool.get_available()
+    for vlan_id in vlan_ids_to_free:
+        pool.is_available(vlan_id)
+        pool.free(vlan_id)
+    for vlan_id in vlan_ids_to_free:
+        pool.reserve(vlan_id)
+
+
+def main():
+    vlan_ids = list(range(VLAN_ID_RANGE_START, VLAN_ID_RANGE_START + ALLOCATIONS))
+    random.Random(0).shuffle(vlan_ids)
+    for pool_class in (DequeVlanIdPool, VlanIdPool):
+        timer = timeit.Timer(lambda: allocate_and_free(pool_class, vlan_ids))
+        best = min(timer.repeat(repeat=REPEAT, number=1))
+        print('%-16s %d allocations + frees + reserves: %.4fs' % (pool_class.__name__, ALLOCATIONS, best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Counts what VirtualMachineInterfaceModel allocates while one event is handled.
+
+Each simulated event reads identifiers the way the services do (database keys,
+logging, vRouter calls, repr) and then builds the VNC objects once.
+Run from the repository root: python -m benchmarks.bench_vmi_model
+"""
+from __future__ import print_function
+
+from builtins import object
+from builtins import range
+import collections
+import timeit
+import tracemalloc
+import uuid
+
+from vnc_api import vnc_api
+
+from cvm import models
+
+INTERFACES = 100
+UUID_READS = 20
+DISPLAY_NAME_READS = 5
+REPEAT = 5
+
+counts = collections.Counter()
+
+
+def counting(cls):
+    class Counting(cls):
+        def __init__(self, *args, **kwargs):
+            counts[cls.__name__] += 1
+            super(Counting, self).__init__(*args, **kwargs)
+
+    Counting.__name__ = cls.__name__
+    return Counting
+
+
+def counting_uuid3(namespace, name, _uuid3=uuid.uuid3):
+    counts['uuid3'] += 1
+    return _uuid3(namespace, name)
+
+
+class LegacyVirtualMachineInterfaceModel(models.VirtualMachineInterfaceModel):
+    """ The previous model: identifiers derived on every access, full VMI built for the instance IP ref. """
+
+    @property
+    def uuid(self):
+        return self.create_uuid(self.vcenter_port.mac_address)
+
+    @property
+    def display_name(self):
+        if self.vn_model and self.vm_model:
+            return 'vmi-{}-{}'.format(self.vn_model.name, self.vm_model.name)
+        return None
+
+    def _construct_vnc_vmi_ref(self):
+        return self.construct_vnc_vmi()
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeVmModel(object):
+    def __init__(self, index):
+        self.uuid = 'vm-uuid-%d' % index
+        self.name = 'VM%d' % index
+
+    @property
+    def vnc_vm(self):
+        vnc_vm = models.VirtualMachine(name=self.uuid, display_name=self.name, id_perms=models.ID_PERMS)
+        vnc_vm.set_uuid(self.uuid)
+        return vnc_vm
+
+
+def make_vmi_models(model_class, project, security_group, vn_model):
+    vmi_models = []
+    for index in range(INTERFACES):
+        port = models.VCenterPort(models.PortRecord(device_key=4000, mac_address='00:50:56:00:00:%02x' % index,
+                                                    port_key=str(index), portgroup_key='dvportgroup-1'))
+        vmi_model = model_class(FakeVmModel(index), vn_model, port)
+        vmi_model.parent = project
+        vmi_model.security_group = security_group
+        vmi_models.append(vmi_model)
+    return vmi_models
+
+
+def handle_event(vmi_models):
+    for vmi_model in vmi_models:
+        for _ in range(UUID_READS):
+            _ = vmi_model.uuid
+        for _ in range(DISPLAY_NAME_READS):
+            _ = vmi_model.display_name
+        repr(vmi_model)
+        vmi_model.construct_instance_ip()
+        vmi_model.construct_vnc_vmi()
+
+
+def measure(label, vmi_models):
+    handle_event(vmi_models)
+    counts.clear()
+    tracemalloc.start()
+    handle_event(vmi_models)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_interface = {name: count / float(INTERFACES) for name, count in counts.items()}
+    best = min(timeit.Timer(lambda: handle_event(vmi_models)).repeat(repeat=REPEAT, number=1))
+    print('%-8s per interface: %5.1f uuid3, %3.1f VMI, %3.1f VM objects; peak %6.1f KiB, %.1fus' % (
+        label, per_interface['uuid3'], per_interface['VirtualMachineInterface'],
+        per_interface['VirtualMachine'], peak / 1024.0, best * 1e6 / INTERFACES))
+
+
+def main():
+    models.uuid.uuid3 = counting_uuid3
+    models.VirtualMachineInterface = counting(models.VirtualMachineInterface)
+    models.VirtualMachine = counting(models.VirtualMachine)
+    project = vnc_api.Project(name='vCenter', parent_obj=vnc_api.Domain(name='default-domain'))
+    vnc_vn = vnc_api.VirtualNetwork(name='DPG1', parent_obj=project)
+    vnc_vn.set_uuid('vn-uuid-1')
+    vnc_vn.set_network_ipam(vnc_api.NetworkIpam(name='ipam', parent_obj=project), None)
+    security_group = vnc_api.SecurityGroup(name='default', parent_obj=project)
+    vn_model = models.VirtualNetworkModel(Namespace(key='dvportgroup-1'), vnc_vn)
+    for label, model_class in (('before', LegacyVirtualMachineInterfaceModel),
+                               ('after', models.VirtualMachineInterfaceModel)):
+        measure(label, make_vmi_models(model_class, project, security_group, vn_model))
+
+
+if __name__ == '__main__':
+    main()
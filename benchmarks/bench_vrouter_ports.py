@@ -0,0 +1,51 @@
+"""
+Compares ways of reading the vRouter Agent's view of the pending ports.
+
+A local fake agent serves the REST API over real TCP, so connection setup is
+part of the measurement: a new connection per read (previous client), one
+pooled keep-alive session, and a single port listing.
+Run from the repository root: python -m benchmarks.bench_vrouter_ports
+"""
+from __future__ import print_function
+
+from builtins import range
+import json
+import timeit
+
+import requests
+
+from cvm.clients import VRouterAPIClient
+from tests.fake_vrouter_agent import FakeVRouterAgent, make_agent_port
+
+PORTS = 200
+REPEAT = 5
+
+
+def read_port_per_connection(agent_url, vmi_uuid):
+    """ The previous read_port: module level requests.get, no timeout. """
+    response = requests.get('{}/port/{}'.format(agent_url, vmi_uuid))
+    if response.status_code == requests.codes.ok:
+        return json.loads(response.content)
+    return None
+
+
+def measure(label, agent, read_ports):
+    read_ports()
+    agent.requests = agent.connections = 0
+    best = min(timeit.Timer(read_ports).repeat(repeat=REPEAT, number=1))
+    print('%-10s %4d requests, %4d connections per sync; %7.2fms' % (
+        label, agent.requests // REPEAT, agent.connections // REPEAT, best * 1e3))
+
+
+def main():
+    ports = [make_agent_port('port-uuid-%d' % i, vlan_id=i) for i in range(PORTS)]
+    uuids = [port['id'] for port in ports]
+    with FakeVRouterAgent(ports) as agent:
+        client = VRouterAPIClient({'agent_url': agent.url})
+        measure('before', agent, lambda: [read_port_per_connection(agent.url, uuid) for uuid in uuids])
+        measure('session', agent, lambda: [client.read_port(uuid) for uuid in uuids])
+        measure('listing', agent, client.read_all_ports)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Compares a cold start sync with a warm start sync seeded from a Database snapshot.
+
+Every call to a fake ESXi, vCenter, VNC or vRouter client sleeps for LATENCY
+seconds, so the difference reflects saved round trips.
+Run from the repository root: python -m benchmarks.bench_warm_start
+"""
+from __future__ import print_function
+
+from builtins import object
+from builtins import range
+import time
+
+import gevent
+from pyVmomi import vim  # pylint: disable=no-name-in-module
+from vnc_api import vnc_api
+
+from cvm import controllers, database, services
+from cvm.clients import PortStateCache
+from cvm.models import HostRecord, VlanIdPool, make_vm_record
+
+VMS = 200
+LATENCY = 0.001
+
+
+class Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeClient(object):
+    """ Answers every call after LATENCY seconds, with canned results for the calls sync relies on. """
+
+    def __init__(self, results=None):
+        self._results = results or {}
+        self.calls = 0
+
+    def __getattr__(self, name):
+        result = self._results.get(name)
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            gevent.sleep(LATENCY)
+            return result(*args, **kwargs) if callable(result) else result
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def make_vmware_vm(index, host):
+    port = vim.dvs.PortConnection(portKey=str(index), portgroupKey='dvportgroup-1')
+    device = vim.vm.device.VirtualVmxnet3(
+        macAddress='00:50:56:00:%02x:%02x' % (index // 256, index % 256),
+        backing=vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(port=port))
+    config = Namespace(instanceUuid='vm-uuid-%d' % index, template=False, hardware=Namespace(device=[device]))
+    return Namespace(_moId='vm-%d' % index, name='VM%d' % index, config=config,
+                     summary=Namespace(runtime=Namespace(host=host)))
+
+
+def make_clients(snapshot=None):
+    project = vnc_api.Project(name='vCenter', parent_obj=vnc_api.Domain(name='default-domain'))
+    project.set_uuid('project-uuid')
+    vnc_vn = vnc_api.VirtualNetwork(name='DPG1', parent=project)
+    vnc_vn.set_uuid('vn-uuid-1')
+    vnc_vn.set_network_ipam(vnc_api.NetworkIpam(name='ipam', parent_obj=project), None)
+    host = Namespace(hardware=Namespace(systemInfo=Namespace(uuid='host-uuid')))
+    vmware_vms = [make_vmware_vm(index, host) for index in range(VMS)]
+    inventory = [make_vm_record(
+        vmware_vm,
+        {
+            'config.instanceUuid': vmware_vm.config.instanceUuid,
+            'name': vmware_vm.name,
+            'runtime.powerState': 'poweredOn',
+            'guest.toolsRunningStatus': 'guestToolsRunning',
+            'summary.runtime.host': host,
+        },
+        vmware_vm.config.hardware.device,
+        host=HostRecord(uuid='host-uuid', name='host'),
+    ) for vmware_vm in vmware_vms]
+    # Objects of a snapshot exist in VNC and vCenter as recorded, so the warm start can confirm them
+    vmi_records = (snapshot or {}).get('vmis', {})
+    vnc_vmi_uuids = {}
+    for vmi_uuid, record in vmi_records.items():
+        vnc_vmi_uuids.setdefault(record['vm_uuid'], []).append(vmi_uuid)
+    vlan_ids = {record['port_key']: record['vlan_id'] for record in vmi_records.values()}
+    esxi_api_client = FakeClient({'read_vm_inventory': lambda: inventory})
+    vcenter_api_client = FakeClient({
+        'get_dpg_by_key': lambda key: Namespace(key=key, name='DPG1'),
+        'get_vlan_ids': lambda ports: {port.port_key: vlan_ids.get(port.port_key) for port in ports},
+        'get_all_vms': vmware_vms,
+    })
+    security_group = vnc_api.SecurityGroup(name='default', parent_obj=project)
+    vnc_api_client = FakeClient({
+        'read_or_create_project': project,
+        'read_or_create_security_group': security_group,
+        'read_vn': vnc_vn,
+        'create_and_read_instance_ip': lambda vmi_model: Namespace(instance_ip_address='10.0.0.1'),
+        'get_all_vm_uuids': list(vnc_vmi_uuids),
+        'get_vmi_uuids_by_vm_uuids': lambda vm_uuids: {vm_uuid: vnc_vmi_uuids.get(vm_uuid, []) for vm_uuid in vm_uuids},
+    })
+    vrouter_api_client = FakeClient({'get_all_port_uuids': []})
+    vrouter_api_client.port_state_cache = PortStateCache()
+    return esxi_api_client, vcenter_api_client, vnc_api_client, vrouter_api_client
+
+
+def build_controller(cvm_database, clients):
+    esxi_api_client, vcenter_api_client, vnc_api_client, vrouter_api_client = clients
+    service_kwargs = {
+        'database': cvm_database,
+        'esxi_api_client': esxi_api_client,
+        'vcenter_api_client': vcenter_api_client,
+        'vnc_api_client': vnc_api_client,
+        'vrouter_api_client': vrouter_api_client,
+        'vlan_id_pool': VlanIdPool(1, 4094),
+    }
+    vlan_id_service = services.VlanIdService(**service_kwargs)
+    # vCenter VLANs are programmed by the worker pool in production; leave them out of the measurement
+    vlan_id_service.defer_vcenter_updates(Namespace(submit_update=lambda vmi_models: None,
+                                                    submit_restore=lambda vmi_models: None))
+    return controllers.VmwareController(
+        services.VirtualMachineService(**service_kwargs),
+        services.VirtualNetworkService(**service_kwargs),
+        services.VirtualMachineInterfaceService(**service_kwargs),
+        services.VRouterPortService(**service_kwargs),
+        vlan_id_service,
+        None,
+        controllers.SharedLock(),
+    )
+
+
+def run_sync(snapshot=None):
+    cvm_database = database.Database()
+    if snapshot is not None:
+        cvm_database.load_snapshot(snapshot)
+    clients = make_clients(snapshot)
+    controller = build_controller(cvm_database, clients)
+    start = time.time()
+    controller.sync()
+    elapsed = time.time() - start
+    for vm_model in cvm_database.get_all_vm_models():
+        for vmi_model in vm_model.vmi_models:
+            vmi_model.vcenter_port.vlan_success = True
+    return elapsed, sum(client.calls for client in clients), cvm_database.make_snapshot()
+
+
+def main():
+    cold_time, cold_calls, snapshot = run_sync()
+    warm_time, warm_calls, _ = run_sync(snapshot)
+    print('%d VMs, %.1fms per remote call' % (VMS, LATENCY * 1000))
+    print('cold start: %.3fs, %d remote calls' % (cold_time, cold_calls))
+    print('warm start: %.3fs, %d remote calls' % (warm_time, warm_calls))
+
+
+if __name__ == '__main__':
+    main()
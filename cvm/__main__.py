@@ -29,7 +29,12 @@ def main(args):
     greenlets = [
         gevent.spawn(context.supervisor.supervise),
         gevent.spawn(context.vmware_monitor.monitor),
+        gevent.spawn(context.vlan_id_worker_pool.run),
+        gevent.spawn(context.port_file_monitor.run),
+        gevent.spawn(context.clients["vcenter_api_client"].keep_session_alive),
     ]
+    if context.snapshot_writer is not None:
+        greenlets.append(gevent.spawn(context.snapshot_writer.run))
     gevent.joinall(greenlets, raise_error=True)
 
 
@@ -4,8 +4,10 @@ import types
 
 from builtins import str
 from builtins import next
+from builtins import range
 from builtins import object
 import atexit
+import collections
 import itertools
 import json
 import logging
@@ -14,6 +16,9 @@ import os
 import time
 from uuid import uuid4
 
+import gevent
+import gevent.local
+import gevent.lock
 import requests
 from pyVim.connect import Disconnect, SmartConnectNoSSL
 from pyVim.task import WaitForTask
@@ -25,10 +30,17 @@ from contrail_vrouter_api.vrouter_api import ContrailVRouterApi
 
 from cvm import exceptions
 from cvm.constants import (ID_PERMS_CREATOR, VM_PROPERTY_FILTERS, VNC_ROOT_DOMAIN,
+                           PORTGROUP_PROPERTY_FILTERS, VM_INVENTORY_PROPERTIES,
+                           HOST_INVENTORY_PROPERTIES, INVENTORY_PAGE_SIZE,
                            VNC_VCENTER_DEFAULT_SG, VNC_VCENTER_DEFAULT_SG_FQN,
                            VNC_VCENTER_IPAM, VNC_VCENTER_IPAM_FQN,
-                           VNC_VCENTER_PROJECT, HISTORY_COLLECTOR_PAGE_SIZE)
-from cvm.models import find_vrouter_uuid
+                           VNC_VCENTER_PROJECT, HISTORY_COLLECTOR_PAGE_SIZE,
+                           VNC_LIST_PAGE_SIZE, VNC_CACHE_TTL, VNC_CACHE_SIZE,
+                           VCENTER_KEEPALIVE_INTERVAL, PORTGROUP_REFRESH_INTERVAL, VROUTER_AGENT_URL,
+                           VROUTER_PORT_LIST_PATH, VROUTER_CONNECT_TIMEOUT,
+                           VROUTER_READ_TIMEOUT, VROUTER_POOL_SIZE, VROUTER_PORT_FILES_PATH,
+                           VROUTER_PORT_VERIFY_INTERVAL, VROUTER_PORT_STATE_KEYS)
+from cvm.models import HostRecord, find_vrouter_uuid, make_vm_record
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +56,21 @@ def raises_connection_error(func, msg):
     return wrapper_raises_socket_error
 
 
+def renews_session(func):
+    """ Retries func once on a new vCenter session if the session it ran with was no longer authenticated. """
+    @functools.wraps(func)
+    def wrapper_renews_session(self, *args, **kwargs):
+        generation = self._session_generation
+        try:
+            return func(self, *args, **kwargs)
+        except vim.fault.NotAuthenticated:
+            logger.info('vCenter session is no longer valid, retrying %s with a new one', func.__name__)
+            self._renew_session(generation)
+            return func(self, *args, **kwargs)
+
+    return wrapper_renews_session
+
+
 def api_client_error_translator(decorator, msg):
     def decorate(cls):
         try:
@@ -146,14 +173,46 @@ class ESXiAPIClient(VSphereAPIClient):
     def renew_connection(self):
         self._create_connection()
 
-    def read_vm_properties(self, vmware_vm):
-        filter_spec = make_filter_spec(vmware_vm, VM_PROPERTY_FILTERS)
-        options = vmodl.query.PropertyCollector.RetrieveOptions()
-        object_set = self._property_collector.RetrievePropertiesEx([filter_spec], options=options).objects
-        prop_set = object_set[0].propSet
-        properties = {prop.name: prop.val for prop in prop_set}
-        logger.info('Read from ESXi API %s properties: %s', vmware_vm.name, properties)
-        return properties
+    def get_updates_version(self):
+        return self._version
+
+    def read_vm_record(self, vmware_vm):
+        """ Reads one VM together with its ethernet devices and host uuid; returns None when it is gone. """
+        object_contents = self._retrieve_all(make_inventory_filter_spec(vmware_vm))
+        vm_records = make_vm_records(object_contents)
+        if not vm_records:
+            return None
+        logger.info('Read from ESXi API %s', vm_records[0])
+        return vm_records[0]
+
+    def read_vm_inventory(self):
+        """ Reads all VMs, their ethernet devices and host uuids with one paged RetrievePropertiesEx. """
+        view = self._si.content.viewManager.CreateContainerView(
+            self._datacenter.vmFolder, [vim.VirtualMachine], True)
+        try:
+            object_contents = self._retrieve_all(make_inventory_filter_spec(view, [make_view_traversal_spec()]))
+        finally:
+            view.DestroyView()
+        inventory = make_vm_records(object_contents)
+        logger.info('Read from ESXi API inventory of %d VMs', len(inventory))
+        return inventory
+
+    def _retrieve_all(self, filter_spec):
+        options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=INVENTORY_PAGE_SIZE)
+        result = self._property_collector.RetrievePropertiesEx([filter_spec], options=options)
+        object_contents = []
+        while result is not None:
+            object_contents.extend(result.objects)
+            if not result.token:
+                break
+            result = self._property_collector.ContinueRetrievePropertiesEx(result.token)
+        return object_contents
+
+    def create_property_watcher(self, vm_morefs, filters):
+        """ Watches VMs by the managed object ids kept in models, without reading them first. """
+        stub = self._si._stub  # pylint: disable=protected-access
+        vmware_vms = [vim.VirtualMachine(vm_moref, stub) for vm_moref in vm_morefs]
+        return PropertyWatcher(self._property_collector, vmware_vms, filters)
 
     def read_vrouter_uuid(self):
         return find_vrouter_uuid(self._host)
@@ -184,6 +243,80 @@ def make_filter_spec(obj, filters):
     return filter_spec
 
 
+def make_vm_to_host_traversal_spec():
+    return vmodl.query.PropertyCollector.TraversalSpec(
+        name='vmToHost', type=vim.VirtualMachine, path='runtime.host', skip=False)
+
+
+def make_view_traversal_spec():
+    return vmodl.query.PropertyCollector.TraversalSpec(
+        name='viewToVms', type=vim.view.ContainerView, path='view', skip=False,
+        selectSet=[make_vm_to_host_traversal_spec()])
+
+
+def make_inventory_filter_spec(obj, select_set=None):
+    """ Selects VM and host inventory properties starting from a VM, or from a view when select_set traverses it. """
+    skip = select_set is not None
+    if select_set is None:
+        select_set = [make_vm_to_host_traversal_spec()]
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=skip, selectSet=select_set)]
+    filter_spec.propSet = [
+        vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, all=False,
+                                                   pathSet=VM_INVENTORY_PROPERTIES),
+        vmodl.query.PropertyCollector.PropertySpec(type=vim.HostSystem, all=False,
+                                                   pathSet=HOST_INVENTORY_PROPERTIES),
+    ]
+    return filter_spec
+
+
+def make_vm_records(object_contents):
+    vm_contents = []
+    hosts = {}
+    for object_content in object_contents:
+        properties = {prop.name: prop.val for prop in object_content.propSet}
+        if isinstance(object_content.obj, vim.HostSystem):
+            hosts[object_content.obj] = HostRecord(uuid=properties.get('hardware.systemInfo.uuid'),
+                                                   name=properties.get('name'))
+        else:
+            vm_contents.append((object_content.obj, properties))
+    return [make_vm_record(
+        vmware_vm,
+        {name: properties[name] for name in VM_PROPERTY_FILTERS if name in properties},
+        properties.get('config.hardware.device'),
+        host=hosts.get(properties.get('summary.runtime.host')),
+        template=properties.get('config.template'),
+    ) for vmware_vm, properties in vm_contents]
+
+
+@api_client_error_translator(raises_connection_error, "Connection to ESXi lost.")
+class PropertyWatcher(object):
+    """ Reports changes of the given properties of objects, through a dedicated property collector. """
+
+    def __init__(self, property_collector, objects, filters):
+        self._collector = property_collector.CreatePropertyCollector()
+        for obj in objects:
+            self._collector.CreateFilter(make_filter_spec(obj, filters), False)
+        self._version = ''
+
+    def wait(self, timeout):
+        """ Blocks up to timeout seconds and returns [(moref, {property: value})]; the first call returns all. """
+        wait_options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max(int(timeout), 0))
+        update_set = self._collector.WaitForUpdatesEx(self._version, wait_options)
+        if not update_set:
+            return []
+        self._version = update_set.version
+        changes = []
+        for filter_update in update_set.filterSet:
+            for object_update in filter_update.objectSet:
+                changes.append((object_update.obj._moId,  # pylint: disable=protected-access
+                                {change.name: change.val for change in object_update.changeSet}))
+        return changes
+
+    def destroy(self):
+        self._collector.DestroyPropertyCollector()
+
+
 @api_client_error_translator(raises_connection_error, "Connection to vCenter lost.")
 class VCenterAPIClient(VSphereAPIClient):
     WAITING_TIMEOUT = 20
@@ -193,9 +326,69 @@ class VCenterAPIClient(VSphereAPIClient):
         super(VCenterAPIClient, self).__init__()
         self._vcenter_cfg = vcenter_cfg
         self._dvs = None
+        self._portgroup_lock = gevent.lock.RLock()
+        self._clear_portgroups()
+        self._keepalive_interval = vcenter_cfg.get('keepalive_interval') or VCENTER_KEEPALIVE_INTERVAL
+        self._last_used = 0
+        self.login_count = 0
+        # Guards logging in and out; each login starts a new generation of the session, so a greenlet
+        # still holding an older one can't expire its successor.
+        self._session_lock = gevent.lock.RLock()
+        self._session_generation = 0
+        self._session_expired = False
+        self._checkouts = gevent.local.local()
+        atexit.register(self._logout)
         self._test_connection()
 
     def __enter__(self):
+        """ Checks out the shared session, logging in only if there is no valid one. """
+        with self._session_lock:
+            if self._si is None or self._session_expired:
+                self._login()
+            elif time.time() - self._last_used > self._keepalive_interval:
+                self._keep_alive()
+            self._get_checkouts().append(self._session_generation)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        generation = self._get_checkouts().pop()
+        self._last_used = time.time()
+        if isinstance(exc_value, (vim.fault.NotAuthenticated, exceptions.APIClientConnectionLostError)):
+            self._expire_session(generation)
+
+    def _get_checkouts(self):
+        """ Generations of the session checked out by the current greenlet, innermost last. """
+        checkouts = getattr(self._checkouts, 'generations', None)
+        if checkouts is None:
+            checkouts = self._checkouts.generations = []
+        return checkouts
+
+    def _expire_session(self, generation):
+        with self._session_lock:
+            if generation == self._session_generation and not self._session_expired:
+                logger.info('vCenter session is no longer valid, it will be renewed on next use')
+                self._session_expired = True
+
+    def _renew_session(self, generation):
+        with self._session_lock:
+            if generation == self._session_generation:
+                self._login()
+
+    def keep_session_alive(self):
+        """ Probes the session whenever it was idle for keepalive_interval, so that vCenter doesn't expire it. """
+        while True:
+            gevent.sleep(self._keepalive_interval)
+            with self._session_lock:
+                if self._si is None or self._session_expired or \
+                        time.time() - self._last_used < self._keepalive_interval:
+                    continue
+                generation = self._session_generation
+                try:
+                    self._keep_alive()
+                except Exception as exc:
+                    logger.error('Unable to keep vCenter session alive: %s', exc)
+                    self._expire_session(generation)
+
+    def _login(self):
         self._si = SmartConnectNoSSL(
             host=self._vcenter_cfg.get('host'),
             user=self._vcenter_cfg.get('username'),
@@ -203,24 +396,139 @@ class VCenterAPIClient(VSphereAPIClient):
             port=self._vcenter_cfg.get('port'),
             preferredApiVersions=self._vcenter_cfg.get('preferred_api_versions')
         )
+        self.login_count += 1
+        logger.info('Logged in to vCenter (login #%d)', self.login_count)
+        # Managed object handles are bound to the session they were read with
         self._datacenter = self._get_datacenter(self._vcenter_cfg.get('datacenter'))
         self._dvs = self._get_dvswitch(self._vcenter_cfg.get('dvswitch'))
+        with self._portgroup_lock:
+            self._clear_portgroups()
+        self._session_generation += 1
+        self._session_expired = False
+        self._last_used = time.time()
 
-    def __exit__(self, *args):
-        Disconnect(self._si)
+    def _keep_alive(self):
+        try:
+            session = self._si.content.sessionManager.currentSession
+        except vim.fault.NotAuthenticated:
+            session = None
+        if session is None:
+            logger.info('vCenter session expired, logging in again')
+            self._login()
+        else:
+            self._last_used = time.time()
+
+    def _logout(self):
+        with self._session_lock:
+            if self._si is None:
+                return
+            try:
+                Disconnect(self._si)
+            except Exception:
+                pass
+            self._drop_session()
 
+    def _drop_session(self):
+        self._si = None
+        self._datacenter = None
+        self._dvs = None
+        self._clear_portgroups()
+
+    @renews_session
     def get_dpg_by_key(self, key):
-        for dpg in self._datacenter.network:
-            if isinstance(dpg, vim.dvs.DistributedVirtualPortgroup) and dpg.key == key:
-                return dpg
-        return None
+        return self._get_portgroup('_portgroups_by_key', key)
 
+    @renews_session
     def get_dpg_by_name(self, name):
-        for dpg in self._datacenter.network:
-            if isinstance(dpg, vim.dvs.DistributedVirtualPortgroup) and dpg.name == name:
-                return dpg
-        return None
+        return self._get_portgroup('_portgroups_by_name', name)
+
+    def _get_portgroup(self, index_name, value):
+        self._refresh_portgroups(force=False)
+        dpg = getattr(self, index_name).get(value)
+        # A portgroup missing from the index may have just been created, which is worth asking vCenter about
+        if dpg is None and self._refresh_portgroups(force=True):
+            dpg = getattr(self, index_name).get(value)
+        return dpg
+
+    def _clear_portgroups(self):
+        self._portgroup_props = {}
+        self._portgroups_by_key = {}
+        self._portgroups_by_name = {}
+        self._portgroup_collector = None
+        self._portgroup_version = None
+        self._portgroups_refreshed_at = 0
+
+    def _load_portgroups(self):
+        """ Subscribes to portgroups of the DVS; the first update set indexes all of them. """
+        self._clear_portgroups()
+        if self._dvs is None:
+            logger.error('DVSwitch %s not found, unable to index portgroups', self._vcenter_cfg.get('dvswitch'))
+            return
+        # Changes are read from a dedicated collector, so they don't interfere with other filters
+        self._portgroup_collector = self._si.content.propertyCollector.CreatePropertyCollector()
+        self._portgroup_collector.CreateFilter(make_portgroup_filter_spec(self._dvs), partialUpdates=True)
+        self._portgroup_version = ''
+        self._wait_for_portgroup_updates()
+        logger.info('Indexed %d portgroups of DVSwitch', len(self._portgroup_props))
+
+    def _refresh_portgroups(self, force):
+        """ Applies portgroup changes, at most once per PORTGROUP_REFRESH_INTERVAL unless forced; returns if it did. """
+        with self._portgroup_lock:
+            if self._portgroup_collector is None:
+                self._load_portgroups()
+                return True
+            if not force and time.time() - self._portgroups_refreshed_at < PORTGROUP_REFRESH_INTERVAL:
+                return False
+            self._wait_for_portgroup_updates()
+            return True
 
+    def _wait_for_portgroup_updates(self):
+        wait_options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+        while True:
+            update_set = self._portgroup_collector.WaitForUpdatesEx(self._portgroup_version, wait_options)
+            self._portgroups_refreshed_at = time.time()
+            if not update_set:
+                return
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    self._apply_portgroup_update(object_update)
+            self._portgroup_version = update_set.version
+            if not update_set.truncated:
+                return
+
+    def _apply_portgroup_update(self, object_update):
+        if object_update.kind == 'leave':
+            self._unindex_portgroup(object_update.obj)
+            self._portgroup_props.pop(object_update.obj, None)
+            return
+        changes = {}
+        for change in object_update.changeSet:
+            changes[change.name] = change.val if change.op == 'assign' else None
+        self._index_portgroup(object_update.obj, changes)
+
+    def _index_portgroup(self, dpg, changes):
+        self._unindex_portgroup(dpg)
+        properties = self._portgroup_props.setdefault(dpg, {})
+        properties.update(changes)
+        if properties.get('key') is not None:
+            self._portgroups_by_key[properties['key']] = dpg
+        if properties.get('name') is not None:
+            self._portgroups_by_name[properties['name']] = dpg
+
+    def _unindex_portgroup(self, dpg):
+        properties = self._portgroup_props.get(dpg, {})
+        if self._portgroups_by_key.get(properties.get('key')) is dpg:
+            self._portgroups_by_key.pop(properties['key'])
+        if self._portgroups_by_name.get(properties.get('name')) is dpg:
+            self._portgroups_by_name.pop(properties['name'])
+
+    def _is_vlan_override_allowed(self, portgroup):
+        allowed = self._portgroup_props.get(portgroup, {}).get('config.policy.vlanOverrideAllowed')
+        if allowed is None:
+            allowed = portgroup.config.policy.vlanOverrideAllowed
+        return allowed
+
+    @renews_session
     def set_vlan_id(self, vcenter_port):
         dv_port = self.fetch_port_from_dvs(vcenter_port.port_key)
         if not dv_port:
@@ -232,6 +540,7 @@ class VCenterAPIClient(VSphereAPIClient):
         fault_message = 'Failed to set VLAN ID: %d for port: %s' % (vcenter_port.vlan_id, vcenter_port.port_key)
         return wait_for_task(task, success_message, fault_message)
 
+    @renews_session
     def get_vlan_id(self, vcenter_port):
         logger.info('Reading VLAN ID of port %s', vcenter_port.port_key)
         dv_port = self.fetch_port_from_dvs(vcenter_port.port_key)
@@ -242,6 +551,7 @@ class VCenterAPIClient(VSphereAPIClient):
         logger.info('Port: %s has no VLAN ID', vcenter_port.port_key)
         return None
 
+    @renews_session
     def restore_vlan_id(self, vcenter_port):
         logger.info('Restoring VLAN ID of port %s to inherited value', vcenter_port.port_key)
         dv_port = self.fetch_port_from_dvs(vcenter_port.port_key)
@@ -251,6 +561,54 @@ class VCenterAPIClient(VSphereAPIClient):
         fault_message = 'Failed to restore VLAN ID for port: %s' % (vcenter_port.port_key,)
         wait_for_task(task, success_message, fault_message)
 
+    @renews_session
+    def get_vlan_ids(self, vcenter_ports):
+        """ Returns {port_key: vlan_id or None} for ports found on the DVS, using a single port fetch. """
+        dv_ports = self.fetch_ports_from_dvs([vcenter_port.port_key for vcenter_port in vcenter_ports])
+        vlan_ids = {}
+        for port_key, dv_port in list(dv_ports.items()):
+            vlan = dv_port.config.setting.vlan
+            vlan_ids[port_key] = None if vlan.inherited else vlan.vlanId
+        logger.info('Read VLAN IDs of %d ports: %s', len(vlan_ids), vlan_ids)
+        return vlan_ids
+
+    @renews_session
+    def set_vlan_ids(self, vcenter_ports):
+        """ Returns {port_key: (state, error_msg)}. """
+        return self._reconfigure_vlan_ids({vcenter_port.port_key: vcenter_port.vlan_id
+                                           for vcenter_port in vcenter_ports})
+
+    @renews_session
+    def restore_vlan_ids(self, vcenter_ports):
+        """ Returns {port_key: (state, error_msg)}. """
+        return self._reconfigure_vlan_ids({vcenter_port.port_key: None for vcenter_port in vcenter_ports})
+
+    def _reconfigure_vlan_ids(self, vlan_ids):
+        """ Applies {port_key: vlan_id} in one task; when it fails, ports are retried one by one to find the culprits. """
+        dv_ports = self.fetch_ports_from_dvs(list(vlan_ids))
+        results = {}
+        for port_key in vlan_ids:
+            if port_key not in dv_ports:
+                logger.error('Port %s not found on DVSwitch', port_key)
+                results[port_key] = ('error', 'Port not found')
+        dv_port_specs = [make_dv_port_spec(dv_port, vlan_ids[port_key]) for port_key, dv_port in list(dv_ports.items())]
+        if not dv_port_specs:
+            return results
+        logger.info('Setting vCenter VLAN IDs of %d ports: %s', len(dv_port_specs),
+                    {spec.key: vlan_ids[spec.key] for spec in dv_port_specs})
+        task = self._dvs.ReconfigureDVPort_Task(port=dv_port_specs)
+        success_message = 'Successfully reconfigured VLAN IDs of ports: %s' % ', '.join(sorted(dv_ports))
+        fault_message = 'Failed to reconfigure VLAN IDs of ports: %s' % ', '.join(sorted(dv_ports))
+        state, error_msg = wait_for_task(task, success_message, fault_message)
+        if state == 'success' or len(dv_port_specs) == 1:
+            for port_key in dv_ports:
+                results[port_key] = (state, error_msg)
+            return results
+        for port_key in dv_ports:
+            results.update(self._reconfigure_vlan_ids({port_key: vlan_ids[port_key]}))
+        return results
+
+    @renews_session
     def get_all_vms(self):
         flat_vm_list = list(itertools.chain.from_iterable(ds.vm for ds in self._datacenter.datastore))
         return [vm for vm in flat_vm_list if isinstance(vm, vim.VirtualMachine)]
@@ -261,6 +619,7 @@ class VCenterAPIClient(VSphereAPIClient):
     def _get_dvswitch(self, name):
         return self._get_object([vim.dvs.VmwareDistributedVirtualSwitch], name)
 
+    @renews_session
     def fetch_port_from_dvs(self, port_key):
         criteria = vim.dvs.PortCriteria()
         criteria.portKey = port_key
@@ -269,9 +628,27 @@ class VCenterAPIClient(VSphereAPIClient):
         except StopIteration:
             return None
 
-    @staticmethod
-    def enable_vlan_override(portgroup):
-        if portgroup.config.policy.vlanOverrideAllowed:
+    @renews_session
+    def get_proxy_host_uuids(self, port_keys):
+        """ Returns {port_key: uuid of the port's proxyHost or None}, using a single port fetch. """
+        proxy_host_uuids = {}
+        for port_key, dv_port in list(self.fetch_ports_from_dvs(port_keys).items()):
+            proxy_host = dv_port.proxyHost
+            proxy_host_uuids[port_key] = proxy_host.hardware.systemInfo.uuid if proxy_host is not None else None
+        return proxy_host_uuids
+
+    @renews_session
+    def fetch_ports_from_dvs(self, port_keys):
+        if not port_keys:
+            return {}
+        criteria = vim.dvs.PortCriteria()
+        criteria.portKey = list(port_keys)
+        requested_keys = set(port_keys)
+        return {port.key: port for port in self._dvs.FetchDVPorts(criteria) if port.key in requested_keys}
+
+    @renews_session
+    def enable_vlan_override(self, portgroup):
+        if self._is_vlan_override_allowed(portgroup):
             logger.info('VLAN Override for portgroup %s already allowed.', portgroup.name)
             return
         pg_config_spec = make_pg_config_vlan_override(portgroup)
@@ -280,20 +657,25 @@ class VCenterAPIClient(VSphereAPIClient):
         fault_message = 'Enabling VLAN override on portgroup {} failed: %s'.format(portgroup.name)
         wait_for_task(task, success_message, fault_message)
 
+    @renews_session
     def can_remove_vm(self, uuid):
         return not self._get_vm_by_uuid(uuid)
 
+    @renews_session
     def can_rename_vm(self, vm_model, new_name):
         vmware_vm = self._get_object([vim.VirtualMachine], new_name)
         return vmware_vm and (vmware_vm.summary.runtime.host.hardware.systemInfo.uuid == vm_model.host_uuid)
 
+    @renews_session
     def can_remove_vmi(self, vnc_vmi):
         vm_uuid = get_vm_uuid_for_vmi(vnc_vmi)
         return self.can_remove_vm(uuid=vm_uuid)
 
+    @renews_session
     def can_rename_vmi(self, vmi_model, new_name):
         return self.can_rename_vm(vmi_model.vm_model, new_name)
 
+    @renews_session
     def is_vm_removed(self, vm_name, host_uuid):
         logger.info('Checking if VM: %s was removed', vm_name)
         start_time = time.time()
@@ -324,6 +706,24 @@ class VCenterAPIClient(VSphereAPIClient):
         with self:
             pass
 
+
+def make_portgroup_filter_spec(dvs):
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+        name='dvsToPortgroup',
+        type=vim.DistributedVirtualSwitch,
+        path='portgroup',
+        skip=False)
+    object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=dvs, skip=True, selectSet=[traversal_spec])
+    property_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.dvs.DistributedVirtualPortgroup,
+        all=False)
+    property_spec.pathSet.extend(PORTGROUP_PROPERTY_FILTERS)
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [object_spec]
+    filter_spec.propSet = [property_spec]
+    return filter_spec
+
+
 def make_dv_port_spec(dv_port, vlan_id=None):
     dv_port_config_spec = vim.dvs.DistributedVirtualPort.ConfigSpec()
     dv_port_config_spec.key = dv_port.key
@@ -377,6 +777,104 @@ def get_key_from_task(task):
     return int(task.info.key.split('-')[1])
 
 
+def split_into_pages(items, page_size):
+    return [items[i:i + page_size] for i in range(0, len(items), page_size)]
+
+
+class VNCObjectCache(object):
+    """ LRU cache of VNC objects read by VNCAPIClient, keyed by (type, uuid) with (type, fq_name) aliases. """
+
+    def __init__(self, ttl, max_size, clock=time.time):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._uuids_by_fq_name = {}
+        self._fq_names_by_uuid = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self._ttl > 0 and self._max_size > 0
+
+    def get(self, obj_type, uuid=None, fq_name=None):
+        key = self._make_key(obj_type, uuid, fq_name)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, obj = entry
+        if expires_at <= self._clock():
+            self.expirations += 1
+            self.misses += 1
+            self._remove(key)
+            return None
+        self._entries.pop(key)
+        self._entries[key] = entry
+        self.hits += 1
+        return obj
+
+    def put(self, obj_type, uuid, obj, fq_name=None):
+        if not self.enabled:
+            return
+        key = (obj_type, uuid)
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock() + self._ttl, obj)
+        if fq_name is not None:
+            fq_name_key = (obj_type, tuple(fq_name))
+            self._uuids_by_fq_name[fq_name_key] = key
+            self._fq_names_by_uuid.setdefault(key, set()).add(fq_name_key)
+        while len(self._entries) > self._max_size:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate(self, obj_type, uuid=None, fq_name=None):
+        """ Drops the entry and returns the object it held, if any. """
+        key = self._make_key(obj_type, uuid, fq_name)
+        if key is None:
+            return None
+        return self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._uuids_by_fq_name.clear()
+        self._fq_names_by_uuid.clear()
+
+    def get_stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def _make_key(self, obj_type, uuid, fq_name):
+        if uuid is not None:
+            return (obj_type, uuid)
+        if fq_name is not None:
+            return self._uuids_by_fq_name.get((obj_type, tuple(fq_name)))
+        return None
+
+    def _remove(self, key):
+        _, obj = self._entries.pop(key, (None, None))
+        for fq_name_key in self._fq_names_by_uuid.pop(key, ()):
+            self._uuids_by_fq_name.pop(fq_name_key, None)
+        return obj
+
+
+def get_ref_uuids(obj, ref_field):
+    """ Returns (uuid, fq_name) pairs of refs/back_refs stored in ref_field of a VNC object. """
+    refs = getattr(obj, 'get_' + ref_field)()
+    if not isinstance(refs, list):
+        return []
+    return [(ref.get('uuid'), ref.get('to')) for ref in refs]
+
+
 @api_client_error_translator(raises_connection_error, "Connection to "
                                                       "Contrail Config API "
                                                       "lost.")
@@ -398,17 +896,24 @@ class VNCAPIClient(object):
         self.id_perms = vnc_api.IdPermsType()
         self.id_perms.set_creator('vcenter-manager')
         self.id_perms.set_enable(True)
+        self._list_page_size = vnc_cfg.get('list_page_size') or VNC_LIST_PAGE_SIZE
+        self._cache = VNCObjectCache(
+            ttl=vnc_cfg.get('cache_ttl', VNC_CACHE_TTL),
+            max_size=vnc_cfg.get('cache_size', VNC_CACHE_SIZE),
+        )
 
     def delete_vm(self, uuid):
         logger.info('Attempting to delete Virtual Machine %s from VNC...', uuid)
         try:
-            vm = self.read_vm(uuid)
+            vm = self._read_uncached('virtual_machine', self.vnc_lib.virtual_machine_read, uuid)
             for vmi_ref in vm.get_virtual_machine_interface_back_refs() or []:
                 self.delete_vmi(vmi_ref.get('uuid'))
             self.vnc_lib.virtual_machine_delete(id=uuid)
             logger.info('Virtual Machine %s removed from VNC', uuid)
         except NoIdError:
             logger.error('Virtual Machine %s not found in VNC. Unable to delete', uuid)
+        finally:
+            self._cache.invalidate('virtual_machine', uuid=uuid)
 
     def update_vm(self, vnc_vm):
         try:
@@ -419,68 +924,87 @@ class VNCAPIClient(object):
             self._create_vm(vnc_vm)
 
     def _update_vm(self, vnc_vm):
+        self._cache.invalidate('virtual_machine', uuid=vnc_vm.uuid)
         self.vnc_lib.virtual_machine_update(vnc_vm)
         logger.info('Virtual Machine %s updated in VNC', vnc_vm.name)
 
     def _create_vm(self, vnc_vm):
+        self._cache.invalidate('virtual_machine', uuid=vnc_vm.uuid)
         self.vnc_lib.virtual_machine_create(vnc_vm)
         logger.info('Virtual Machine %s created in VNC', vnc_vm.name)
 
     def get_all_vms(self):
-        vms_data = self.vnc_lib.virtual_machines_list().get('virtual-machines')
         vms = []
-        for vm_data in vms_data:
-            try:
-                vnc_vm = self.read_vm(vm_data['uuid'])
-                if vnc_vm.id_perms.creator == ID_PERMS_CREATOR:
-                    vms.append(vnc_vm)
-            except Exception as exc:
-                logger.error('Unexpected exception %s during pulling VM from VNC', exc, exc_info=True)
+        for vm_uuids in self._list_vm_uuid_pages():
+            vnc_vms = self.vnc_lib.virtual_machines_list(obj_uuids=vm_uuids, detail=True)
+            vms.extend(vnc_vm for vnc_vm in vnc_vms
+                       if vnc_vm.id_perms and vnc_vm.id_perms.creator == ID_PERMS_CREATOR)
         return vms
 
     def get_all_vm_uuids(self):
-        vms_data = self.vnc_lib.virtual_machines_list().get('virtual-machines')
         vm_uuids = []
-        for vm_data in vms_data:
-            try:
-                vnc_vm = self.read_vm(vm_data['uuid'])
-                if vnc_vm.id_perms.creator == ID_PERMS_CREATOR:
-                    vm_uuids.append(vm_data['uuid'])
-            except Exception as exc:
-                logger.error('Unexpected exception %s during pulling VM uuid from VNC', exc, exc_info=True)
+        for page in self._list_vm_uuid_pages():
+            vms_data = self.vnc_lib.virtual_machines_list(obj_uuids=page, fields=['id_perms'])
+            vm_uuids.extend(vm_data['uuid'] for vm_data in vms_data.get('virtual-machines')
+                            if (vm_data.get('id_perms') or {}).get('creator') == ID_PERMS_CREATOR)
         return vm_uuids
 
+    def _list_vm_uuid_pages(self):
+        vms_data = self.vnc_lib.virtual_machines_list().get('virtual-machines')
+        return split_into_pages([vm_data['uuid'] for vm_data in vms_data], self._list_page_size)
+
     def get_vmi_uuids_by_vm_uuid(self, vm_uuid):
-        vm = self.read_vm(vm_uuid)
+        vm = self._read_uncached('virtual_machine', self.vnc_lib.virtual_machine_read, vm_uuid)
         return [vmi_ref['uuid'] for vmi_ref in vm.get_virtual_machine_interface_back_refs() or ()]
 
+    def get_vmi_uuids_by_vm_uuids(self, vm_uuids):
+        vmi_uuids = {vm_uuid: [] for vm_uuid in vm_uuids}
+        for page in split_into_pages(list(vmi_uuids), self._list_page_size):
+            vmis_data = self.vnc_lib.virtual_machine_interfaces_list(
+                back_ref_id=page, fields=['virtual_machine_refs']
+            ).get('virtual-machine-interfaces')
+            for vmi_data in vmis_data:
+                for vm_ref in vmi_data.get('virtual_machine_refs') or ():
+                    if vm_ref['uuid'] in vmi_uuids:
+                        vmi_uuids[vm_ref['uuid']].append(vmi_data['uuid'])
+        return vmi_uuids
+
     def read_vm(self, uuid):
-        return self.vnc_lib.virtual_machine_read(id=uuid)
+        return self._cached_read('virtual_machine', self.vnc_lib.virtual_machine_read, uuid=uuid)
 
     def update_vmi(self, vnc_vmi):
         logger.info('Attempting to update Virtual Machine Interface %s in VNC', vnc_vmi.name)
         try:
-            old_vmi = self.vnc_lib.virtual_machine_interface_read(id=vnc_vmi.uuid)
-            self._update_vmi_vn(old_vmi, vnc_vmi)
+            old_vmi = self._read_uncached('virtual_machine_interface', self.vnc_lib.virtual_machine_interface_read,
+                                          vnc_vmi.uuid)
+            recreated = self._update_vmi_vn(old_vmi, vnc_vmi)
             self._rename_vmi(old_vmi, vnc_vmi)
+            self._invalidate_vmi(old_vmi)
             self.vnc_lib.virtual_machine_interface_update(old_vmi)
         except NoIdError:
             logger.info('Virtual Machine Interface %s not found in VNC - creating', vnc_vmi.name)
             self.create_vmi(vnc_vmi)
-        return self.vnc_lib.virtual_machine_interface_read(id=vnc_vmi.uuid)
+            return
+        if not recreated:
+            # The update doesn't change back_refs, so reading Instance IPs next needs no round trip
+            self._cache.put('virtual_machine_interface', old_vmi.uuid, old_vmi)
+
+    def _read_vmi(self, uuid):
+        return self._cached_read('virtual_machine_interface', self.vnc_lib.virtual_machine_interface_read, uuid=uuid)
 
     def _update_vmi_vn(self, old_vmi, new_vmi):
         new_vn_fq_name = self._get_vn_fq_name_for_vmi(new_vmi)
         old_vn_fq_name = self._get_vn_fq_name_for_vmi(old_vmi)
         if new_vn_fq_name == old_vn_fq_name:
             logger.info('No network change detected.')
-            return
+            return False
 
         logger.info('Network change detected. Updating Interface %s info in VNC.', new_vmi.name)
         self.delete_vmi(old_vmi.uuid)
         logger.info('Deleted VMI %s from VNC with old network %s', old_vmi.uuid, old_vn_fq_name[2])
         self.create_vmi(new_vmi)
         logger.info('Created VMI %s in VNC with new network %s', new_vmi.uuid, new_vn_fq_name[2])
+        return True
 
     def _delete_instance_ip_of(self, vnc_vmi):
         logger.info('Deleting old Instance IP for Interface %s', vnc_vmi.name)
@@ -492,6 +1016,7 @@ class VNCAPIClient(object):
         old_vmi.set_display_name(new_vmi.display_name)
 
     def create_vmi(self, vnc_vmi):
+        self._invalidate_vmi(vnc_vmi)
         try:
             self.vnc_lib.virtual_machine_interface_create(vnc_vmi)
             logger.info('Virtual Machine Interface %s created in VNC', vnc_vmi.name)
@@ -500,8 +1025,9 @@ class VNCAPIClient(object):
 
     def delete_vmi(self, uuid):
         logger.info('Deleting Virtual Machine Interface %s from VNC...', uuid)
-        vmi = self.read_vmi(uuid)
-        if not vmi:
+        try:
+            vmi = self._read_uncached('virtual_machine_interface', self.vnc_lib.virtual_machine_interface_read, uuid)
+        except NoIdError:
             logger.error('Virtual Machine Interface %s not found in VNC. Unable to delete', uuid)
             return
 
@@ -513,6 +1039,7 @@ class VNCAPIClient(object):
             self._detach_service_instances_from_instance_ip(instance_ip_ref['uuid'])
             self.delete_instance_ip(instance_ip_ref.get('uuid'))
 
+        self._invalidate_vmi(vmi)
         self.vnc_lib.virtual_machine_interface_delete(id=uuid)
         logger.info('Virtual Machine Interface %s removed from VNC', uuid)
 
@@ -522,7 +1049,7 @@ class VNCAPIClient(object):
 
     def read_vmi(self, uuid):
         try:
-            return self.vnc_lib.virtual_machine_interface_read(id=uuid)
+            return self._read_vmi(uuid)
         except NoIdError:
             logger.error('Could not find VMI %s in VNC', uuid)
         return None
@@ -545,7 +1072,7 @@ class VNCAPIClient(object):
 
     def read_vn(self, fq_name):
         try:
-            return self.vnc_lib.virtual_network_read(fq_name)
+            return self._cached_read('virtual_network', self.vnc_lib.virtual_network_read, fq_name=fq_name)
         except NoIdError:
             logger.error('VN %s not found in VNC', fq_name[2])
         return None
@@ -608,6 +1135,8 @@ class VNCAPIClient(object):
             return instance_ip
         try:
             instance_ip = vmi_model.vnc_instance_ip
+            self._invalidate_instance_ip(instance_ip)
+            self._cache.invalidate('virtual_machine_interface', uuid=vmi_model.uuid)
             self.vnc_lib.instance_ip_create(instance_ip)
             logger.info("Created Instance IP: %s with IP: %s", instance_ip.name, instance_ip.instance_ip_address)
             return self._read_instance_ip(vmi_model)
@@ -616,6 +1145,9 @@ class VNCAPIClient(object):
 
     def delete_instance_ip(self, uuid):
         logger.info('Deleting Instance IP: %s... from VNC', uuid)
+        cached_instance_ip = self._cache.invalidate('instance_ip', uuid=uuid)
+        if cached_instance_ip is not None:
+            self._invalidate_instance_ip(cached_instance_ip)
         try:
             self.vnc_lib.instance_ip_delete(id=uuid)
             logger.info('Removed Instance IP %s from VNC', uuid)
@@ -636,7 +1168,7 @@ class VNCAPIClient(object):
 
     def _read_instance_ip_by_uuid(self, ip_uuid):
         try:
-            return self.vnc_lib.instance_ip_read(id=ip_uuid)
+            return self._cached_read('instance_ip', self.vnc_lib.instance_ip_read, uuid=ip_uuid)
         except NoIdError:
             return None
 
@@ -650,6 +1182,7 @@ class VNCAPIClient(object):
             self.vnc_lib.floating_ip_update(fip)
 
     def _detach_service_instances_from_instance_ip(self, instance_ip_uuid):
+        self._cache.invalidate('instance_ip', uuid=instance_ip_uuid)
         instance_ip = self.vnc_lib.instance_ip_read(id=instance_ip_uuid)
         service_refs = instance_ip.get_service_instance_back_refs()
         if service_refs is None:
@@ -659,6 +1192,44 @@ class VNCAPIClient(object):
             service_instance.del_instance_ip(instance_ip)
             self.vnc_lib.service_instance_update(service_instance)
 
+    def get_cache_stats(self):
+        return self._cache.get_stats()
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def _cached_read(self, obj_type, read, uuid=None, fq_name=None):
+        obj = self._cache.get(obj_type, uuid=uuid, fq_name=fq_name)
+        if obj is not None:
+            return obj
+        if uuid is not None:
+            obj = read(id=uuid)
+        else:
+            obj = read(fq_name)
+            uuid = obj.uuid
+        self._cache.put(obj_type, uuid, obj, fq_name=fq_name)
+        return obj
+
+    def _read_uncached(self, obj_type, read, uuid):
+        """ For callers that modify the object or act on its back_refs, which the cached copy may miss. """
+        self._cache.invalidate(obj_type, uuid=uuid)
+        return read(id=uuid)
+
+    def _invalidate_vmi(self, vnc_vmi):
+        """ Creating/deleting a VMI also changes back_refs of the VM and VN it refers to. """
+        self._cache.invalidate('virtual_machine_interface', uuid=vnc_vmi.uuid)
+        self._invalidate_refs(vnc_vmi, 'virtual_machine_refs', 'virtual_machine')
+        self._invalidate_refs(vnc_vmi, 'virtual_network_refs', 'virtual_network')
+
+    def _invalidate_instance_ip(self, instance_ip):
+        self._cache.invalidate('instance_ip', uuid=instance_ip.uuid)
+        self._invalidate_refs(instance_ip, 'virtual_machine_interface_refs', 'virtual_machine_interface')
+        self._invalidate_refs(instance_ip, 'virtual_network_refs', 'virtual_network')
+
+    def _invalidate_refs(self, obj, ref_field, obj_type):
+        for uuid, fq_name in get_ref_uuids(obj, ref_field):
+            self._cache.invalidate(obj_type, uuid=uuid, fq_name=fq_name)
+
 
 def construct_ipam(project):
     return vnc_api.NetworkIpam(
@@ -710,11 +1281,20 @@ def construct_project():
 class VRouterAPIClient(object):
     """ A client for Contrail VRouter Agent REST API. """
 
-    def __init__(self):
+    def __init__(self, vrouter_cfg=None):
+        vrouter_cfg = vrouter_cfg or {}
         self.vrouter_api = ContrailVRouterApi()
-        self.vrouter_host = 'http://localhost'
-        self.vrouter_port = '9091'
-        self.port_files_path = '/var/lib/contrail/ports/'
+        self.agent_url = (vrouter_cfg.get('agent_url') or VROUTER_AGENT_URL).rstrip('/')
+        self.port_files_path = vrouter_cfg.get('port_files_path') or VROUTER_PORT_FILES_PATH
+        self.port_file_index = PortFileIndex(self.port_files_path)
+        self.port_state_cache = PortStateCache(
+            vrouter_cfg.get('port_verify_interval') or VROUTER_PORT_VERIFY_INTERVAL)
+        self._timeout = (vrouter_cfg.get('connect_timeout') or VROUTER_CONNECT_TIMEOUT,
+                         vrouter_cfg.get('read_timeout') or VROUTER_READ_TIMEOUT)
+        # One keep-alive session, so that reads reuse connections to the agent
+        self._session = requests.Session()
+        pool_size = vrouter_cfg.get('pool_size') or VROUTER_POOL_SIZE
+        self._session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
 
     def add_port(self, vmi_model):
         """ Add port to VRouter Agent. """
@@ -739,12 +1319,21 @@ class VRouterAPIClient(object):
             )
             self.vrouter_api.add_port(**parameters)
             logger.info('Added port to vRouter with parameters: %s', parameters)
+            self.port_state_cache.record(vmi_model.uuid, {
+                'instance-id': parameters['vm_uuid_str'],
+                'vn-id': parameters['vn_id'],
+                'rx-vlan-id': parameters['rx_vlan'],
+                'tx-vlan-id': parameters['vlan'],
+                'ip-address': parameters['ip_address'],
+            })
         except Exception as e:
             logger.error('There was a problem with vRouter API Client: %s', e)
+            self.port_state_cache.forget(vmi_model.uuid)
 
     def delete_port(self, vmi_uuid):
         """ Delete port from VRouter Agent. """
         try:
+            self.port_state_cache.forget(vmi_uuid)
             self.vrouter_api.delete_port(vmi_uuid)
             logger.info('Removed port from vRouter with uuid: %s', vmi_uuid)
         except Exception as e:
@@ -766,24 +1355,152 @@ class VRouterAPIClient(object):
 
     def read_port(self, vmi_uuid):
         try:
-            request_url = '{host}:{port}/port/{uuid}'.format(host=self.vrouter_host,
-                                                             port=self.vrouter_port,
-                                                             uuid=vmi_uuid)
-            response = requests.get(request_url)
+            request_url = '{url}/port/{uuid}'.format(url=self.agent_url, uuid=vmi_uuid)
+            response = self._session.get(request_url, timeout=self._timeout)
             if response.status_code == requests.codes.ok:
                 port_properties = json.loads(response.content)
                 logger.info('Read vRouter port with uuid: %s, port properties: %s', vmi_uuid, port_properties)
                 return port_properties
+        except requests.ConnectionError as e:
+            self._handle_agent_unreachable(e)
         except Exception as e:
             logger.error('There was a problem with vRouter API Client: %s', e)
         logger.info('Unable to read vRouter port with uuid: %s', vmi_uuid)
         return None
 
+    def read_all_ports(self):
+        """ Returns {port uuid: port properties} read with one request; None when the agent can't list ports. """
+        try:
+            response = self._session.get(self.agent_url + VROUTER_PORT_LIST_PATH, timeout=self._timeout)
+            if response.status_code == requests.codes.ok:
+                ports = json.loads(response.content)
+                if isinstance(ports, list):
+                    logger.info('Read %d vRouter ports', len(ports))
+                    vrouter_ports = {port['id']: port for port in ports}
+                    self._check_port_list(vrouter_ports)
+                    return vrouter_ports
+        except requests.ConnectionError as e:
+            self._handle_agent_unreachable(e)
+        except Exception as e:
+            logger.error('There was a problem with vRouter API Client: %s', e)
+        logger.info('Unable to list vRouter ports')
+        return None
+
+    def _check_port_list(self, vrouter_ports):
+        lost_uuids = [uuid for uuid in self.port_state_cache.get_uuids() if uuid not in vrouter_ports]
+        if lost_uuids:
+            # The agent's port list started over without ports pushed to it, so it was restarted
+            logger.info('vRouter Agent lost %d pushed ports, e.g. %s', len(lost_uuids), lost_uuids[0])
+            self.port_state_cache.invalidate()
+
+    def _handle_agent_unreachable(self, exc):
+        # Most likely the agent is restarting, after which ports it reports may differ from the ones pushed
+        logger.error('vRouter Agent is unreachable: %s', exc)
+        self.port_state_cache.invalidate()
+
     def get_all_port_uuids(self):
-        if not os.path.exists(self.port_files_path):
-            return ()
-        port_uuids = []
-        for file_name in os.listdir(self.port_files_path):
-            if os.path.isfile(os.path.join(self.port_files_path, file_name)):
-                port_uuids.append(file_name)
-        return port_uuids
+        # Without a PortFileMonitor watching the directory the index can't be trusted, so rescan
+        if not self.port_file_index.watched:
+            self.port_file_index.rescan()
+        return self.port_file_index.get_uuids()
+
+    def port_file_exists(self, vmi_uuid):
+        return os.path.isfile(os.path.join(self.port_files_path, vmi_uuid))
+
+
+def scan_port_files(path):
+    """ Returns names of the regular files in path, read with one directory scan. """
+    scandir = getattr(os, 'scandir', None)
+    try:
+        if scandir is None:
+            # Works in Python 2.7
+            return set(name for name in os.listdir(path) if os.path.isfile(os.path.join(path, name)))
+        entries = scandir(path)
+        try:
+            return set(entry.name for entry in entries if entry.is_file())
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+    except OSError:
+        # No port directory means no ports
+        return set()
+
+
+class PortFileIndex(object):
+    """ In-memory set of the port UUIDs that have a file in the vRouter Agent's port directory. """
+
+    def __init__(self, path):
+        self.path = path
+        self.watched = False
+        self._uuids = set()
+
+    def rescan(self):
+        """ Replaces the index with the directory's contents; returns UUIDs whose files are gone. """
+        uuids = scan_port_files(self.path)
+        removed = self._uuids - uuids
+        self._uuids = uuids
+        return removed
+
+    def add(self, uuid):
+        self._uuids.add(uuid)
+
+    def remove(self, uuid):
+        """ Returns True when uuid was indexed. """
+        if uuid not in self._uuids:
+            return False
+        self._uuids.discard(uuid)
+        return True
+
+    def get_uuids(self):
+        return frozenset(self._uuids)
+
+    def __contains__(self, uuid):
+        return uuid in self._uuids
+
+    def __len__(self):
+        return len(self._uuids)
+
+
+def make_port_state(vrouter_port):
+    return {key: vrouter_port.get(key) for key in VROUTER_PORT_STATE_KEYS}
+
+
+class PortStateCache(object):
+    """ State of the vRouter ports last pushed to or read from the agent, trusted for verify_interval seconds. """
+
+    def __init__(self, verify_interval=VROUTER_PORT_VERIFY_INTERVAL):
+        self._verify_interval = verify_interval
+        self._ports = {}
+        # Bumped whenever the agent may have lost track of the pushed ports, e.g. restarted
+        self.generation = 0
+
+    def record(self, uuid, vrouter_port):
+        self._ports[uuid] = (make_port_state(vrouter_port), time.time())
+
+    def forget(self, uuid):
+        self._ports.pop(uuid, None)
+
+    def get(self, uuid):
+        """ Returns the cached port state, or None when it is unknown or due for verification with the agent. """
+        entry = self._ports.get(uuid)
+        if entry is None:
+            return None
+        vrouter_port, recorded_at = entry
+        if time.time() - recorded_at >= self._verify_interval:
+            return None
+        return vrouter_port
+
+    def get_uuids(self):
+        return list(self._ports)
+
+    def invalidate(self):
+        if self._ports:
+            logger.info('Dropping cached state of %d vRouter ports', len(self._ports))
+        self._ports.clear()
+        self.generation += 1
+
+    def __contains__(self, uuid):
+        return self.get(uuid) is not None
+
+    def __len__(self):
+        return len(self._ports)
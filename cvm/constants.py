@@ -1,5 +1,4 @@
 from __future__ import division
-from past.utils import old_div
 from vnc_api.vnc_api import IdPermsType
 
 EVENTS_TO_OBSERVE = [
@@ -25,6 +24,19 @@ VM_PROPERTY_FILTERS = [
     'guest.toolsRunningStatus',
     'summary.runtime.host',
 ]
+VM_INVENTORY_PROPERTIES = VM_PROPERTY_FILTERS + [
+    'config.template',
+    'config.hardware.device',
+]
+HOST_INVENTORY_PROPERTIES = [
+    'hardware.systemInfo.uuid',
+    'name',
+]
+PORTGROUP_PROPERTY_FILTERS = [
+    'key',
+    'name',
+    'config.policy.vlanOverrideAllowed',
+]
 VM_UPDATE_FILTERS = [
     'guest.toolsRunningStatus',
     'guest.net',
@@ -47,12 +59,46 @@ ID_PERMS_CREATOR = 'vcenter-manager'
 ID_PERMS = IdPermsType(creator=ID_PERMS_CREATOR, enable=True)
 
 SET_VLAN_ID_RETRY_LIMIT = 2
+VLAN_WORKERS = 4
+VLAN_WORKER_BATCH_SIZE = 50
+VLAN_WORKER_RETRY_LIMIT = 5
+VLAN_WORKER_BACKOFF = 2  # 2s, doubled after each failed attempt
+VLAN_WORKER_LATENCY_SAMPLES = 1000
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_INTERVAL = 60  # 60s
+SNAPSHOT_MAX_AGE = 3600  # 1h
 WAIT_FOR_PORT_RETRY_TIME = 1  # 1s
-WAIT_FOR_PORT_RETRY_LIMIT = int(old_div(30,WAIT_FOR_PORT_RETRY_TIME))  # Timeout after 30s
+WAIT_FOR_PORT_TIMEOUT = 30  # 30s
 
 WAIT_FOR_UPDATE_TIMEOUT = 60
 SUPERVISOR_TIMEOUT = 80
 
 HISTORY_COLLECTOR_PAGE_SIZE = 1000
+INVENTORY_PAGE_SIZE = 500
+COALESCE_MAX_UPDATE_SETS = 100
+EVENT_WORKERS = 4
+SYNC_POOL_SIZE = 16
+SYNC_BACKEND_LIMITS = {'vnc': 8, 'vcenter': 4, 'vrouter': 8}
+VNC_LIST_PAGE_SIZE = 200
+VNC_CACHE_TTL = 30  # 30s
+VNC_CACHE_SIZE = 4096
+VCENTER_KEEPALIVE_INTERVAL = 300  # 5min
+PORTGROUP_REFRESH_INTERVAL = 1  # 1s
+VROUTER_AGENT_URL = 'http://localhost:9091'
+VROUTER_PORT_LIST_PATH = '/port'
+VROUTER_CONNECT_TIMEOUT = 1  # 1s
+VROUTER_READ_TIMEOUT = 5  # 5s
+VROUTER_POOL_SIZE = 8
+VROUTER_PORT_FILES_PATH = '/var/lib/contrail/ports/'
+PORT_FILES_POLL_INTERVAL = 60  # 1min
+VROUTER_PORT_VERIFY_INTERVAL = 300  # 5min
+# Port properties compared between a VMI and its vRouter port
+VROUTER_PORT_STATE_KEYS = ('instance-id', 'vn-id', 'rx-vlan-id', 'tx-vlan-id', 'ip-address')
+# How a vRouter port differs from its VMI, each class handled by the cheapest agent operation
+PORT_CHANGE_CREATE = 'create'
+PORT_CHANGE_IDENTITY = 'identity'
+PORT_CHANGE_IP = 'ip'
+PORT_CHANGE_VLAN = 'vlan'
+PORT_CHANGE_IP_AND_VLAN = 'ip+vlan'
 
 VMFS = 'vmfs'
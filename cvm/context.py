@@ -3,7 +3,6 @@ import logging
 import random
 import socket
 
-import gevent.lock
 import gevent.queue
 
 from cfgm_common.uve.nodeinfo.ttypes import NodeStatus, NodeStatusUVE
@@ -22,7 +21,13 @@ from cvm import database as db
 from cvm import constants as const
 from cvm.event_listener import EventListener
 from cvm.models import VlanIdPool
-from cvm.monitors import VMwareMonitor
+from cvm.monitors import (
+    DatabaseSnapshotWriter,
+    PortFileMonitor,
+    UpdateSetCoalescer,
+    VlanIdWorkerPool,
+    VMwareMonitor,
+)
 from cvm.supervisor import Supervisor
 
 logger = logging.getLogger("cvm")
@@ -42,7 +47,7 @@ class CVMContext(object):
     def __init__(self, config):
         self.config = config
 
-        self.lock = gevent.lock.BoundedSemaphore()
+        self.lock = controllers.SharedLock()
         self.database = db.Database()
         self.update_set_queue = gevent.queue.Queue()
         self.vlan_id_pool = VlanIdPool(
@@ -54,6 +59,10 @@ class CVMContext(object):
         self.vmware_monitor = None
         self.event_listener = None
         self.supervisor = None
+        self.vlan_id_worker_pool = None
+        self.sync_executor = None
+        self.snapshot_writer = None
+        self.port_file_monitor = None
         self.clients = {}
         self.services = {}
         self.handlers = {}
@@ -61,11 +70,16 @@ class CVMContext(object):
     def build(self):
         self._build_clients()
         self._build_services()
+        self._build_sync_executor()
+        self._build_vlan_id_worker_pool()
         self._build_handlers()
         self._build_controller()
 
         self.vmware_monitor = VMwareMonitor(
-            self.vmware_controller, self.update_set_queue
+            self.vmware_controller,
+            self.update_set_queue,
+            coalescer=UpdateSetCoalescer(),
+            workers=self.config["esxi"].get("event_workers") or const.EVENT_WORKERS,
         )
         self.event_listener = EventListener(
             self.vmware_controller,
@@ -76,6 +90,8 @@ class CVMContext(object):
         self.supervisor = Supervisor(
             self.event_listener, self.clients["esxi_api_client"]
         )
+        self._build_snapshot_writer()
+        self._build_port_file_monitor()
 
     def load_introspect_config(self):
         sandesh_config = self.config["sandesh"]
@@ -153,7 +169,10 @@ class CVMContext(object):
 
     def _build_controller(self):
         self.vmware_controller = controllers.VmwareController(
-            update_handler=self.update_handler, lock=self.lock, **self.services
+            update_handler=self.update_handler,
+            lock=self.lock,
+            sync_executor=self.sync_executor,
+            **self.services
         )
 
     def _build_handlers(self):
@@ -192,6 +211,56 @@ class CVMContext(object):
             "vlan_id_service": vlan_id_service,
         }
 
+    def _build_sync_executor(self):
+        sync_cfg = self.config.get("sync") or {}
+        backend_limits = {
+            backend: sync_cfg[backend + "_concurrency"]
+            for backend in const.SYNC_BACKEND_LIMITS
+            if sync_cfg.get(backend + "_concurrency")
+        }
+        self.sync_executor = services.SyncExecutor(
+            pool_size=sync_cfg.get("pool_size") or const.SYNC_POOL_SIZE,
+            backend_limits=backend_limits,
+        )
+        for service in self.services.values():
+            service.use_sync_executor(self.sync_executor)
+
+    def _build_snapshot_writer(self):
+        snapshot_cfg = self.config.get("snapshot") or {}
+        path = snapshot_cfg.get("path")
+        if not path:
+            return
+        snapshot = db.read_snapshot(
+            path, snapshot_cfg.get("max_age") or const.SNAPSHOT_MAX_AGE
+        )
+        if snapshot is not None:
+            self.database.load_snapshot(snapshot)
+        self.snapshot_writer = DatabaseSnapshotWriter(
+            self.database,
+            self.clients["esxi_api_client"],
+            self.lock,
+            path,
+            interval=snapshot_cfg.get("interval") or const.SNAPSHOT_INTERVAL,
+        )
+
+    def _build_port_file_monitor(self):
+        vrouter_cfg = self.config.get("vrouter") or {}
+        self.port_file_monitor = PortFileMonitor(
+            self.clients["vrouter_api_client"],
+            self.services["vrouter_port_service"],
+            self.lock,
+            poll_interval=vrouter_cfg.get("port_files_poll_interval")
+            or const.PORT_FILES_POLL_INTERVAL,
+        )
+
+    def _build_vlan_id_worker_pool(self):
+        vlan_id_service = self.services["vlan_id_service"]
+        self.vlan_id_worker_pool = VlanIdWorkerPool(
+            vlan_id_service,
+            size=self.config["vcenter"].get("vlan_workers") or const.VLAN_WORKERS,
+        )
+        vlan_id_service.defer_vcenter_updates(self.vlan_id_worker_pool)
+
     def _build_clients(self):
         esxi_cfg, vcenter_cfg, vnc_cfg = (
             self.config["esxi"],
@@ -201,7 +270,7 @@ class CVMContext(object):
         esxi_api_client = clients.ESXiAPIClient(esxi_cfg)
         vcenter_api_client = clients.VCenterAPIClient(vcenter_cfg)
         vnc_api_client = clients.VNCAPIClient(vnc_cfg)
-        vrouter_api_client = clients.VRouterAPIClient()
+        vrouter_api_client = clients.VRouterAPIClient(self.config.get("vrouter"))
         self.clients = {
             "esxi_api_client": esxi_api_client,
             "vcenter_api_client": vcenter_api_client,
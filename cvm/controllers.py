@@ -1,18 +1,22 @@
 from builtins import object
+import contextlib
 import logging
 from abc import ABCMeta, abstractmethod
 
+import gevent.event
+import gevent.lock
 from pyVmomi import vim, vmodl
 from future.utils import with_metaclass
 
 from cvm import exceptions
+from cvm.services import SyncExecutor
 
 logger = logging.getLogger(__name__)
 
 
 class VmwareController(object):
     def __init__(self, vm_service, vn_service, vmi_service,
-                 vrouter_port_service, vlan_id_service, update_handler, lock):
+                 vrouter_port_service, vlan_id_service, update_handler, lock, sync_executor=None):
         self._vm_service = vm_service
         self._vn_service = vn_service
         self._vmi_service = vmi_service
@@ -20,35 +24,145 @@ class VmwareController(object):
         self._vlan_id_service = vlan_id_service
         self._update_handler = update_handler
         self._lock = lock
+        self._sync_executor = sync_executor if sync_executor is not None else SyncExecutor(pool_size=1)
 
     def sync(self):
         logger.info('Synchronizing CVM...')
+        phases = (
+            ('get_vms_from_vmware', self._vm_service.get_vms_from_vmware),
+            ('update_vns', self._vn_service.update_vns),
+            ('update_vmis', self._vmi_service.update_vmis),
+            ('delete_unused_vms_in_vnc', self._vm_service.delete_unused_vms_in_vnc),
+            ('delete_unused_vmis_in_vnc', self._vmi_service.delete_unused_vmis_in_vnc),
+            ('update_vlan_ids', self._vlan_id_service.update_vlan_ids),
+            ('sync_ports', self._vrouter_port_service.sync_ports),
+            ('delete_stale_vrouter_ports', self._vrouter_port_service.delete_stale_vrouter_ports),
+        )
         with self._lock:
-            self._vm_service.get_vms_from_vmware()
-            self._vn_service.update_vns()
-            self._vmi_service.update_vmis()
-            self._vm_service.delete_unused_vms_in_vnc()
-            self._vmi_service.delete_unused_vmis_in_vnc()
-            self._vlan_id_service.update_vlan_ids()
-            self._vrouter_port_service.sync_ports()
-            self._vrouter_port_service.delete_stale_vrouter_ports()
+            for name, phase in phases:
+                with self._sync_executor.phase(name):
+                    phase()
         logger.info('Synchronization complete')
 
-    def handle_update(self, update_set):
+    def resync(self):
+        """ Reconciles existing models with the ESXi inventory; returns False when a full sync is needed instead. """
+        logger.info('Resynchronizing CVM...')
         with self._lock:
+            with self._sync_executor.phase('diff_vms_with_vmware'):
+                diff = self._vm_service.diff_vms_with_vmware()
+            if diff is None:
+                logger.error('Unable to trust the inventory diff, falling back to full synchronization')
+                return False
+            vanished_uuids = {vm_model.uuid for vm_model in diff.vanished}
+            rebuilt_uuids = {vm_model.uuid for vm_model, _ in diff.changed}.union(
+                record.uuid for record in diff.added)
+            phases = (
+                ('resync_vms', lambda: self._vm_service.resync_vms(diff)),
+                ('remove_vanished_vms', lambda: self._remove_vms(diff.vanished)),
+                ('update_vns', self._vn_service.update_vns),
+                ('update_vmis', self._vmi_service.update_vmis),
+                ('delete_unused_vms_in_vnc', lambda: self._vm_service.delete_unused_vms_in_vnc(vanished_uuids)),
+                ('delete_unused_vmis_in_vnc', lambda: self._vmi_service.delete_unused_vmis_in_vnc(rebuilt_uuids)),
+                ('update_vlan_ids', self._vlan_id_service.update_vlan_ids),
+                ('sync_ports', self._vrouter_port_service.sync_ports),
+                ('delete_stale_vrouter_ports', self._vrouter_port_service.delete_stale_vrouter_ports),
+            )
+            for name, phase in phases:
+                with self._sync_executor.phase(name):
+                    phase()
+        logger.info('Resynchronization complete')
+        return True
+
+    def _remove_vms(self, vm_models):
+        for vm_model in vm_models:
+            try:
+                self._vmi_service.remove_vmis_for_vm_model(vm_model.name)
+                self._vm_service.remove_vm(vm_model.name)
+            except exceptions.CVMError:
+                raise
+            except Exception as exc:
+                logger.error('Unexpected exception %s during removing vanished %s', exc, vm_model, exc_info=True)
+
+    def get_sync_phase_times(self):
+        return dict(self._sync_executor.phase_times)
+
+    def handle_update(self, update_set):
+        with self._lock.shared():
             self._update_handler.handle_update(update_set)
 
 
+class SharedLock(object):
+    """ Held by any number of greenlets through shared(), or by one greenlet exclusively through with. """
+
+    def __init__(self):
+        self._exclusive = gevent.lock.BoundedSemaphore()
+        self._holders = 0
+        self._released = gevent.event.Event()
+        self._released.set()
+
+    def __enter__(self):
+        self._exclusive.acquire()
+        self._released.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._exclusive.release()
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._exclusive:
+            self._holders += 1
+            self._released.clear()
+        try:
+            yield self
+        finally:
+            self._holders -= 1
+            if not self._holders:
+                self._released.set()
+
+
 class UpdateHandler(object):
     def __init__(self, handlers):
         self._handlers = handlers
+        self._event_handlers = [handler for handler in handlers if isinstance(handler, AbstractEventHandler)]
+        self._routes_by_name = {}
+        self._routes_by_event_class = {}
 
     def handle_update(self, update_set):
         for property_filter_update in update_set.filterSet:
             for object_update in property_filter_update.objectSet:
                 for property_change in object_update.changeSet:
-                    for handler in self._handlers:
-                        handler.handle_change(object_update.obj, property_change)
+                    self._handle_change(object_update.obj, property_change)
+
+    def _handle_change(self, obj, property_change):
+        name = getattr(property_change, 'name', None)
+        value = getattr(property_change, 'val', None)
+        if not value:
+            return
+        handlers, is_event_property = self._get_routes_by_name(name)
+        for handler in handlers:
+            handler.handle_value(obj, value)
+        if is_event_property:
+            events = sorted(value, key=lambda e: e.key) if isinstance(value, list) else [value]
+            for event in events:
+                for handler in self._get_routes_by_event_class(event.__class__):
+                    handler.handle_event(event)
+
+    def _get_routes_by_name(self, name):
+        routes = self._routes_by_name.get(name)
+        if routes is None:
+            handlers = [handler for handler in self._handlers
+                        if not isinstance(handler, AbstractEventHandler) and name.startswith(handler.PROPERTY_NAME)]
+            is_event_property = name.startswith(AbstractEventHandler.PROPERTY_NAME)
+            routes = self._routes_by_name[name] = (handlers, is_event_property)
+        return routes
+
+    def _get_routes_by_event_class(self, event_class):
+        handlers = self._routes_by_event_class.get(event_class)
+        if handlers is None:
+            handlers = [handler for handler in self._event_handlers if issubclass(event_class, handler.EVENTS)]
+            self._routes_by_event_class[event_class] = handlers
+        return handlers
 
 
 class AbstractChangeHandler(with_metaclass(ABCMeta, object)):
@@ -65,14 +179,17 @@ class AbstractChangeHandler(with_metaclass(ABCMeta, object)):
         value = getattr(property_change, 'val', None)
         if value:
             if name.startswith(self.PROPERTY_NAME):
-                try:
-                    self._handle_change(obj, value)
-                except vmodl.fault.ManagedObjectNotFound:
-                    self._log_managed_object_not_found(value)
-                except exceptions.CVMError:
-                    raise
-                except Exception as exc:
-                    logger.error('Unexpected exception: %s during handling %s', exc, value, exc_info=True)
+                self.handle_value(obj, value)
+
+    def handle_value(self, obj, value):
+        try:
+            self._handle_change(obj, value)
+        except vmodl.fault.ManagedObjectNotFound:
+            self._log_managed_object_not_found(value)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception: %s during handling %s', exc, value, exc_info=True)
 
     @abstractmethod
     def _log_managed_object_not_found(self, value):
@@ -120,20 +237,23 @@ class AbstractEventHandler(with_metaclass(ABCMeta, AbstractChangeHandler)):
 
     def _handle_change(self, obj, value):
         if isinstance(value, self.EVENTS):
-            logger.info('Detected event: %s for VM: %s', type(value), value.vm.name)
-            try:
-                self._handle_event(value)
-            except vmodl.fault.ManagedObjectNotFound:
-                self._log_managed_object_not_found(value)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception: %s during handling %s for VM: %s',
-                             exc, value, value.vm.name, exc_info=True)
+            self.handle_event(value)
         if isinstance(value, list):
             for change in sorted(value, key=lambda e: e.key):
                 self._handle_change(obj, change)
 
+    def handle_event(self, event):
+        logger.info('Detected event: %s for VM: %s', type(event), event.vm.name)
+        try:
+            self._handle_event(event)
+        except vmodl.fault.ManagedObjectNotFound:
+            self._log_managed_object_not_found(event)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception: %s during handling %s for VM: %s',
+                         exc, event, event.vm.name, exc_info=True)
+
     @abstractmethod
     def _handle_event(self, event):
         pass
@@ -159,12 +279,15 @@ class VmUpdatedHandler(AbstractEventHandler):
     def _handle_event(self, event):
         if not self._validate_event(event):
             return
-        vmware_vm = event.vm.vm
-        self._vm_service.update(vmware_vm)
-        self._vn_service.update_vns()
-        self._vmi_service.update_vmis()
-        self._vlan_id_service.update_vlan_ids()
-        self._vrouter_port_service.sync_ports()
+        vm_model = self._vm_service.update(event.vm.vm)
+        if vm_model is None:
+            return
+        # Only pending work of this VM, which no other event worker touches, see VMwareMonitor
+        vm_uuids = {vm_model.uuid}
+        self._vn_service.update_vns(vm_uuids)
+        self._vmi_service.update_vmis(vm_uuids)
+        self._vlan_id_service.update_vlan_ids(vm_uuids)
+        self._vrouter_port_service.sync_ports(vm_uuids)
 
 
 class VmRegisteredHandler(AbstractEventHandler):
@@ -173,14 +296,15 @@ class VmRegisteredHandler(AbstractEventHandler):
     def _handle_event(self, event):
         if not self._validate_event(event):
             return
-        vmware_vm = event.vm.vm
-        self._vm_service.update(vmware_vm)
-        self._vn_service.update_vns()
-        self._vmi_service.register_vmis()
-        self._vlan_id_service.update_vlan_ids()
-        self._vrouter_port_service.sync_ports()
-        vm_uuid = vmware_vm.config.instanceUuid
-        self._vmi_service.delete_unused_vm_vmis_in_vnc(vm_uuid)
+        vm_model = self._vm_service.update(event.vm.vm)
+        if vm_model is None:
+            return
+        vm_uuids = {vm_model.uuid}
+        self._vn_service.update_vns(vm_uuids)
+        self._vmi_service.register_vmis(vm_uuids)
+        self._vlan_id_service.update_vlan_ids(vm_uuids)
+        self._vrouter_port_service.sync_ports(vm_uuids)
+        self._vmi_service.delete_unused_vm_vmis_in_vnc(vm_model.uuid)
 
 
 class VmRenamedHandler(AbstractEventHandler):
@@ -193,7 +317,8 @@ class VmRenamedHandler(AbstractEventHandler):
         new_name = event.newName
         self._vm_service.rename_vm(old_name, new_name)
         self._vmi_service.rename_vmis(new_name)
-        self._vrouter_port_service.sync_ports()
+        vm_model = self._vm_service.get_vm_model_by_name(new_name)
+        self._vrouter_port_service.sync_ports({vm_model.uuid})
 
     def _validate_event(self, event):
         old_name = event.oldName
@@ -211,11 +336,14 @@ class VmReconfiguredHandler(AbstractEventHandler):
             device = device_spec.device
             if isinstance(device, vim.vm.device.VirtualEthernetCard):
                 logger.info('Detected VmReconfiguredEvent with %s device', type(device))
-                self._vm_service.update_vm_models_interfaces(vmware_vm)
-                self._vn_service.update_vns()
-                self._vmi_service.update_vmis()
-                self._vlan_id_service.update_vlan_ids()
-                self._vrouter_port_service.sync_ports()
+                vm_model = self._vm_service.update_vm_models_interfaces(vmware_vm)
+                if vm_model is None:
+                    continue
+                vm_uuids = {vm_model.uuid}
+                self._vn_service.update_vns(vm_uuids)
+                self._vmi_service.update_vmis(vm_uuids)
+                self._vlan_id_service.update_vlan_ids(vm_uuids)
+                self._vrouter_port_service.sync_ports(vm_uuids)
             else:
                 logger.info('Detected VmReconfiguredEvent with unsupported %s device type', type(device))
 
@@ -235,10 +363,11 @@ class VmRemovedHandler(AbstractEventHandler):
         if not self._validate_event(event):
             return
         vm_name = event.vm.name
+        vm_uuids = {self._vm_service.get_vm_model_by_name(vm_name).uuid}
         self._vmi_service.remove_vmis_for_vm_model(vm_name)
-        self._vlan_id_service.update_vlan_ids()
+        self._vlan_id_service.update_vlan_ids(vm_uuids)
         self._vm_service.remove_vm(vm_name)
-        self._vrouter_port_service.sync_ports()
+        self._vrouter_port_service.sync_ports(vm_uuids)
 
     def _validate_event(self, event):
         vm_name = event.vm.name
@@ -249,9 +378,10 @@ class GuestNetHandler(AbstractChangeHandler):
     PROPERTY_NAME = 'guest.net'
 
     def _handle_change(self, obj, value):
-        for nic_info in value:
-            self._vmi_service.update_nic(nic_info)
-        self._vrouter_port_service.sync_ports()
+        vmi_models = [self._vmi_service.update_nic(nic_info) for nic_info in value]
+        vm_uuids = set(vmi_model.vm_model.uuid for vmi_model in vmi_models if vmi_model is not None)
+        if vm_uuids:
+            self._vrouter_port_service.sync_ports(vm_uuids)
 
     def _log_managed_object_not_found(self, value):
         logger.error('One VM was deleted/moved from ESXi during its GuestNetHandling handling')
@@ -278,9 +408,9 @@ class PowerStateHandler(AbstractChangeHandler):
     def _handle_change(self, obj, value):
         if not self._validate_vm(obj):
             return
-        self._vm_service.update_power_state(obj, value)
-        self._vrouter_port_service.sync_port_states()
-        self._vlan_id_service.update_vcenter_vlans()
+        vm_uuids = {self._vm_service.update_power_state(obj, value).uuid}
+        self._vrouter_port_service.sync_port_states(vm_uuids)
+        self._vlan_id_service.update_vcenter_vlans(vm_uuids)
 
     def _validate_vm(self, vmware_vm):
         return self._is_vm_in_database(name=vmware_vm.name)
@@ -1,35 +1,199 @@
 from builtins import object
+import collections
+import contextlib
+import json
 import logging
+import os
+import time
 
-from cvm.constants import VMFS
+import gevent.lock
+import six
+
+from cvm.constants import SNAPSHOT_FORMAT_VERSION, VMFS
 from cvm.models import (VirtualMachineInterfaceModel, VirtualMachineModel,
                         VirtualNetworkModel)
 
 logger = logging.getLogger(__name__)
 
+PENDING_WORK_SETS = ('vmis_to_update', 'vmis_to_delete', 'vlans_to_update', 'vlans_to_restore',
+                     'ports_to_update', 'ports_to_delete')
+
+
+def get_work_key(item):
+    return getattr(item, 'uuid', item)
+
+
+def get_work_owner(item):
+    """ Returns uuid of the VM that work on item belongs to, if any. """
+    vm_model = getattr(item, 'vm_model', None)
+    return getattr(vm_model, 'uuid', None)
+
+
+class WorkSet(object):
+    """ Insertion-ordered pending work keyed by uuid; adding a queued entry again only replaces its item. """
+
+    def __init__(self, items=(), lock=None):
+        # key -> [item, attempts, first enqueued at, owner VM uuid, claimed]
+        self._entries = collections.OrderedDict()
+        self._lock = lock if lock is not None else gevent.lock.RLock()
+        self.extend(items)
+
+    def add(self, item, owner=None):
+        owner = owner if owner is not None else get_work_owner(item)
+        entry = self._entries.get(get_work_key(item))
+        if entry is None:
+            self._entries[get_work_key(item)] = [item, 0, time.time(), owner, False]
+        else:
+            entry[0] = item
+            entry[3] = owner if owner is not None else entry[3]
+
+    append = add
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def discard(self, item):
+        """ Drops the entry unless it was replaced by another item while this one was being processed. """
+        key = get_work_key(item)
+        entry = self._entries.get(key)
+        if entry is not None and (entry[0] is item or entry[0] == item):
+            del self._entries[key]
+
+    def pending(self, owners=None):
+        """ Returns unclaimed items in order (of owners only, if given), counting this as one more attempt of each. """
+        items = []
+        for entry in self._select(owners):
+            entry[1] += 1
+            items.append(entry[0])
+        return items
+
+    def select(self, owners=None):
+        """ Returns unclaimed items in order (of owners only, if given), without counting an attempt. """
+        return [entry[0] for entry in self._select(owners)]
+
+    def _select(self, owners):
+        return [entry for entry in list(self._entries.values())
+                if not entry[4] and (owners is None or entry[3] in owners)]
+
+    @contextlib.contextmanager
+    def claim(self, owners=None):
+        """ Yields pending items for the caller alone to process; the ones not discarded by then are handed back. """
+        with self._lock:
+            entries = self._select(owners)
+            for entry in entries:
+                entry[1] += 1
+                entry[4] = True
+            keys = [get_work_key(entry[0]) for entry in entries]
+        try:
+            yield [entry[0] for entry in entries]
+        finally:
+            with self._lock:
+                for key in keys:
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        entry[4] = False
+
+    def get_attempts(self, item):
+        entry = self._entries.get(get_work_key(item))
+        return entry[1] if entry is not None else 0
+
+    def get_enqueued_at(self, item):
+        entry = self._entries.get(get_work_key(item))
+        return entry[2] if entry is not None else None
+
+    def stats(self):
+        if not self._entries:
+            return 0, 0, 0.0
+        oldest = min(entry[2] for entry in self._entries.values())
+        return len(self._entries), max(entry[1] for entry in self._entries.values()), time.time() - oldest
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, item):
+        return get_work_key(item) in self._entries
+
+    def __iter__(self):
+        return iter([entry[0] for entry in self._entries.values()])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, (WorkSet, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'WorkSet(%r)' % list(self)
+
 
 class Database(object):
 
     def __init__(self):
+        # Guards models and their indexes; pending_lock only guards claiming entries of the work sets.
+        self._lock = gevent.lock.RLock()
+        self.pending_lock = gevent.lock.RLock()
         self.vm_models = {}
         self.vn_models = {}
         self.vmi_models = {}
-        self.vmis_to_update = []
-        self.vmis_to_delete = []
-        self.vlans_to_update = []
-        self.vlans_to_restore = []
-        self.ports_to_update = []
-        self.ports_to_delete = []
+        self.vmis_to_update = WorkSet(lock=self.pending_lock)
+        self.vmis_to_delete = WorkSet(lock=self.pending_lock)
+        self.vlans_to_update = WorkSet(lock=self.pending_lock)
+        self.vlans_to_restore = WorkSet(lock=self.pending_lock)
+        self.ports_to_update = WorkSet(lock=self.pending_lock)
+        self.ports_to_delete = WorkSet(lock=self.pending_lock)
+        self._clear_indexes()
+        self._snapshot_vms = {}
+        self._snapshot_vmis = {}
+
+    def _clear_indexes(self):
+        self._vm_uuids_by_name = {}
+        self._vm_uuids_by_old_name = {}
+        self._vn_keys_by_uuid = {}
+        self._vmi_uuids_by_vm_uuid = {}
+        self._vmi_uuids_by_vn_uuid = {}
+        self._vmi_uuids_by_vlan_id = {}
+        # Keys under which each model is currently indexed, so that
+        # re-saving a renamed/moved model can drop its stale entries.
+        self._indexed_vm_names = {}
+        self._indexed_vn_uuids = {}
+        self._indexed_vmi_refs = {}
+        self._indexed_vlan_ids = {}
 
     def save(self, obj):
+        with self._lock:
+            self._save(obj)
+
+    def _save(self, obj):
         if isinstance(obj, VirtualMachineModel):
             self.vm_models[obj.uuid] = obj
+            self._index_vm_model(obj)
+            obj.on_rename = self._reindex_vm_model
             logger.info('Saved Virtual Machine model for %s', obj.name)
         if isinstance(obj, VirtualNetworkModel):
             self.vn_models[obj.key] = obj
+            self._index_vn_model(obj)
             logger.info('Saved Virtual Network model for %s', obj.name)
         if isinstance(obj, VirtualMachineInterfaceModel):
             self.vmi_models[obj.uuid] = obj
+            self._index_vmi_model(obj)
             logger.info('Saved Virtual Machine Interface model for %s', obj.display_name)
 
     def get_all_vm_models(self):
@@ -42,22 +206,21 @@ class Database(object):
         return vm_model
 
     def get_vm_model_by_name(self, name):
-        try:
-            return [vm_model for vm_model in list(self.vm_models.values()) if vm_model.name == name][0]
-        except IndexError:
-            logger.info('Could not find VM model with name %s.', name)
-            return self._get_vm_model_by_old_name(name)
+        vm_model = self.vm_models.get(self._vm_uuids_by_name.get(name))
+        if vm_model is not None:
+            return vm_model
+        logger.info('Could not find VM model with name %s.', name)
+        return self._get_vm_model_by_old_name(name)
 
     def _get_vm_model_by_old_name(self, old_name):
         # Sometimes during stress tests VmRemoved event comes with old name, despite rename
         # Renaming yVM-test-gtiltsxwws to /vmfs/volumes/23c13506-c7f8ba2b/yVM-test-gtiltsxwws/yVM-test-gtiltsxwws.vmx
         # Detected event: <class 'pyVmomi.VmomiSupport.vim.event.VmRemovedEvent'> for VM: yVM-test-gtiltsxwws
         logger.info('Looking for VM model with old name: %s', old_name)
-        for vm_model in list(self.vm_models.values()):
-            if VMFS in vm_model.name and '{0}/{0}'.format(old_name) in vm_model.name:
-                return vm_model
-        logger.info('Could not find VM model with old name %s.', old_name)
-        return None
+        vm_model = self.vm_models.get(self._vm_uuids_by_old_name.get(old_name))
+        if vm_model is None:
+            logger.info('Could not find VM model with old name %s.', old_name)
+        return vm_model
 
     def get_vn_model_by_key(self, key):
         vn_model = self.vn_models.get(key, None)
@@ -66,11 +229,10 @@ class Database(object):
         return vn_model
 
     def get_vn_model_by_uuid(self, uuid):
-        try:
-            return [vn_model for vn_model in list(self.vn_models.values()) if vn_model.uuid == uuid][0]
-        except IndexError:
+        vn_model = self.vn_models.get(self._vn_keys_by_uuid.get(uuid))
+        if vn_model is None:
             logger.info('Could not find VN model with UUID %s.', uuid)
-            return None
+        return vn_model
 
     def get_all_vn_models(self):
         return list(self.vn_models.values())
@@ -82,42 +244,261 @@ class Database(object):
         return self.vmi_models.get(uuid, None)
 
     def get_vmi_models_by_vm_uuid(self, uuid):
-        return [vmi_model for vmi_model in list(self.vmi_models.values()) if vmi_model.vm_model.uuid == uuid]
+        return [self.vmi_models[vmi_uuid] for vmi_uuid in self._vmi_uuids_by_vm_uuid.get(uuid, ())]
 
     def get_vmi_models_by_vn_uuid(self, uuid):
-        return [vmi_model for vmi_model in list(self.vmi_models.values()) if vmi_model.vn_model.uuid == uuid]
+        return [self.vmi_models[vmi_uuid] for vmi_uuid in self._vmi_uuids_by_vn_uuid.get(uuid, ())]
 
     def delete_vm_model(self, uid):
-        try:
-            self.vm_models.pop(uid)
-        except KeyError:
-            logger.info('Could not delete VM model with uuid %s.', uid)
+        with self._lock:
+            try:
+                vm_model = self.vm_models.pop(uid)
+                vm_model.on_rename = None
+                self._unindex_vm_model(uid)
+            except KeyError:
+                logger.info('Could not delete VM model with uuid %s.', uid)
 
     def delete_vn_model(self, key):
-        try:
-            self.vn_models.pop(key)
-        except KeyError:
-            logger.info('Could not find VN model with key %s. Nothing to delete.', key)
+        with self._lock:
+            try:
+                self.vn_models.pop(key)
+                self._unindex_vn_model(key)
+            except KeyError:
+                logger.info('Could not find VN model with key %s. Nothing to delete.', key)
 
     def delete_vmi_model(self, uuid):
-        try:
-            self.vmi_models.pop(uuid)
-        except KeyError:
-            logger.info('Could not find VMI model with uuid %s. Nothing to delete.', uuid)
+        with self._lock:
+            try:
+                self.vmi_models.pop(uuid)
+                self._unindex_vmi_model(uuid)
+            except KeyError:
+                logger.info('Could not find VMI model with uuid %s. Nothing to delete.', uuid)
 
     def is_vlan_available(self, new_vmi_model, vlan_id):
-        vmi_models = [vmi_model for vmi_model in self.get_all_vmi_models()
-                      if vmi_model.vcenter_port.vlan_id == vlan_id
-                      and vmi_model.uuid != new_vmi_model.uuid]
-        return not bool(vmi_models)
+        vmi_uuids = self._vmi_uuids_by_vlan_id.get(vlan_id, ())
+        return not any(vmi_uuid != new_vmi_model.uuid for vmi_uuid in vmi_uuids)
+
+    def set_vlan_id(self, vmi_model, vlan_id):
+        with self._lock:
+            vmi_model.vcenter_port.vlan_id = vlan_id
+            if vmi_model.uuid in self.vmi_models:
+                self._index_vlan_id(vmi_model)
+
+    def release_vlan_id(self, vmi_model):
+        with self._lock:
+            if self._indexed_vlan_ids.get(vmi_model.uuid) == vmi_model.vcenter_port.vlan_id:
+                self._unindex_vlan_id(vmi_model.uuid)
 
     def clear_database(self):
-        self.vm_models = {}
-        self.vn_models = {}
-        self.vmi_models = {}
-        self.vmis_to_update = []
-        self.vmis_to_delete = []
-        self.vlans_to_update = []
-        self.vlans_to_restore = []
-        self.ports_to_update = []
-        self.ports_to_delete = []
+        with self._lock, self.pending_lock:
+            self.vm_models = {}
+            self.vn_models = {}
+            self.vmi_models = {}
+            self.vmis_to_update = WorkSet(lock=self.pending_lock)
+            self.vmis_to_delete = WorkSet(lock=self.pending_lock)
+            self.vlans_to_update = WorkSet(lock=self.pending_lock)
+            self.vlans_to_restore = WorkSet(lock=self.pending_lock)
+            self.ports_to_update = WorkSet(lock=self.pending_lock)
+            self.ports_to_delete = WorkSet(lock=self.pending_lock)
+            self._clear_indexes()
+
+    def get_pending_work_stats(self):
+        """ Returns {work set name: (size, max attempts, age of the oldest entry in seconds)}. """
+        with self.pending_lock:
+            return {name: getattr(self, name).stats() for name in PENDING_WORK_SETS}
+
+    def make_snapshot(self, updates_version=None):
+        """ Returns plain data describing models, VLAN assignments and instance IPs, for a later warm start. """
+        with self._lock:
+            return {
+                'format': SNAPSHOT_FORMAT_VERSION,
+                'created_at': time.time(),
+                'updates_version': updates_version,
+                'vms': {vm_model.uuid: {'name': vm_model.name} for vm_model in self.vm_models.values()},
+                'vns': {vn_model.key: {'uuid': vn_model.uuid, 'name': vn_model.name}
+                        for vn_model in self.vn_models.values()},
+                'vmis': {vmi_model.uuid: make_vmi_snapshot(vmi_model) for vmi_model in self.vmi_models.values()},
+            }
+
+    def load_snapshot(self, snapshot):
+        """ Keeps snapshot records so that the next sync can skip work for objects that did not change. """
+        self._snapshot_vms = snapshot['vms']
+        self._snapshot_vmis = snapshot['vmis']
+        logger.info('Loaded snapshot with %d VMs and %d VMIs taken at updates version %s',
+                    len(self._snapshot_vms), len(self._snapshot_vmis), snapshot.get('updates_version'))
+
+    def drop_snapshot(self):
+        self._snapshot_vms = {}
+        self._snapshot_vmis = {}
+
+    def verify_snapshot(self, vnc_vmi_uuids):
+        """ Drops snapshot records of VMs and VMIs not in vnc_vmi_uuids, {VM uuid: uuids of its VMIs in VNC}. """
+        vm_count, vmi_count = len(self._snapshot_vms), len(self._snapshot_vmis)
+        vnc_vmis = set((vm_uuid, vmi_uuid) for vm_uuid, vmi_uuids in vnc_vmi_uuids.items() for vmi_uuid in vmi_uuids)
+        self._snapshot_vms = {uuid: record for uuid, record in self._snapshot_vms.items() if uuid in vnc_vmi_uuids}
+        self._snapshot_vmis = {uuid: record for uuid, record in self._snapshot_vmis.items()
+                               if (record['vm_uuid'], uuid) in vnc_vmis}
+        logger.info('Dropped snapshot records of %d VMs and %d VMIs missing from VNC',
+                    vm_count - len(self._snapshot_vms), vmi_count - len(self._snapshot_vmis))
+
+    def get_snapshot_vm_uuids(self):
+        return list(self._snapshot_vms)
+
+    def get_snapshot_vm(self, uuid):
+        return self._snapshot_vms.get(uuid)
+
+    def get_snapshot_vmi(self, uuid):
+        return self._snapshot_vmis.get(uuid)
+
+    def check_consistency(self):
+        """ Compares secondary indexes against a full rebuild and returns found mismatches. """
+        # Only indexes are rebuilt, so that the models stay bound to this Database
+        expected = Database()
+        for vm_model in list(self.vm_models.values()):
+            expected._index_vm_model(vm_model)
+        for vn_model in list(self.vn_models.values()):
+            expected._index_vn_model(vn_model)
+        for vmi_model in list(self.vmi_models.values()):
+            expected._index_vmi_model(vmi_model)
+        errors = []
+        for index_name in ('_vm_uuids_by_name', '_vm_uuids_by_old_name', '_vn_keys_by_uuid',
+                           '_vmi_uuids_by_vm_uuid', '_vmi_uuids_by_vn_uuid', '_vmi_uuids_by_vlan_id'):
+            actual_index = {key: value for key, value in list(getattr(self, index_name).items()) if value}
+            expected_index = {key: value for key, value in list(getattr(expected, index_name).items()) if value}
+            if actual_index != expected_index:
+                errors.append('%s: expected %s, got %s' % (index_name, expected_index, actual_index))
+        for error in errors:
+            logger.error('Database index inconsistency: %s', error)
+        return errors
+
+    def _index_vm_model(self, vm_model):
+        self._unindex_vm_model(vm_model.uuid)
+        name = vm_model.name
+        self._indexed_vm_names[vm_model.uuid] = name
+        self._vm_uuids_by_name[name] = vm_model.uuid
+        old_name = get_old_name_from_vmfs_path(name)
+        if old_name is not None:
+            self._vm_uuids_by_old_name[old_name] = vm_model.uuid
+
+    def _reindex_vm_model(self, vm_model):
+        with self._lock:
+            if self.vm_models.get(vm_model.uuid) is vm_model:
+                self._index_vm_model(vm_model)
+
+    def _unindex_vm_model(self, uuid):
+        name = self._indexed_vm_names.pop(uuid, None)
+        if name is None:
+            return
+        if self._vm_uuids_by_name.get(name) == uuid:
+            self._vm_uuids_by_name.pop(name)
+        old_name = get_old_name_from_vmfs_path(name)
+        if old_name is not None and self._vm_uuids_by_old_name.get(old_name) == uuid:
+            self._vm_uuids_by_old_name.pop(old_name)
+
+    def _index_vn_model(self, vn_model):
+        self._unindex_vn_model(vn_model.key)
+        self._indexed_vn_uuids[vn_model.key] = vn_model.uuid
+        self._vn_keys_by_uuid[vn_model.uuid] = vn_model.key
+
+    def _unindex_vn_model(self, key):
+        uuid = self._indexed_vn_uuids.pop(key, None)
+        if uuid is not None and self._vn_keys_by_uuid.get(uuid) == key:
+            self._vn_keys_by_uuid.pop(uuid)
+
+    def _index_vmi_model(self, vmi_model):
+        self._unindex_vmi_model(vmi_model.uuid)
+        vm_uuid = vmi_model.vm_model.uuid if vmi_model.vm_model is not None else None
+        vn_uuid = vmi_model.vn_model.uuid if vmi_model.vn_model is not None else None
+        self._indexed_vmi_refs[vmi_model.uuid] = (vm_uuid, vn_uuid)
+        if vm_uuid is not None:
+            self._vmi_uuids_by_vm_uuid.setdefault(vm_uuid, set()).add(vmi_model.uuid)
+        if vn_uuid is not None:
+            self._vmi_uuids_by_vn_uuid.setdefault(vn_uuid, set()).add(vmi_model.uuid)
+        self._index_vlan_id(vmi_model)
+
+    def _unindex_vmi_model(self, uuid):
+        vm_uuid, vn_uuid = self._indexed_vmi_refs.pop(uuid, (None, None))
+        discard_from_index(self._vmi_uuids_by_vm_uuid, vm_uuid, uuid)
+        discard_from_index(self._vmi_uuids_by_vn_uuid, vn_uuid, uuid)
+        self._unindex_vlan_id(uuid)
+
+    def _index_vlan_id(self, vmi_model):
+        self._unindex_vlan_id(vmi_model.uuid)
+        vlan_id = vmi_model.vcenter_port.vlan_id
+        if vlan_id is None:
+            return
+        vmi_uuids = self._vmi_uuids_by_vlan_id.setdefault(vlan_id, set())
+        if vmi_uuids:
+            logger.error('VLAN ID %s assigned to VMI %s is already used by VMI(s) %s',
+                         vlan_id, vmi_model.uuid, ', '.join(sorted(vmi_uuids)))
+        vmi_uuids.add(vmi_model.uuid)
+        self._indexed_vlan_ids[vmi_model.uuid] = vlan_id
+
+    def _unindex_vlan_id(self, uuid):
+        vlan_id = self._indexed_vlan_ids.pop(uuid, None)
+        discard_from_index(self._vmi_uuids_by_vlan_id, vlan_id, uuid)
+
+
+def make_vmi_snapshot(vmi_model):
+    vnc_instance_ip = vmi_model.vnc_instance_ip
+    return {
+        'display_name': vmi_model.display_name,
+        'vm_uuid': vmi_model.vm_model.uuid if vmi_model.vm_model is not None else None,
+        'vn_uuid': vmi_model.vn_model.uuid if vmi_model.vn_model is not None else None,
+        'port_key': vmi_model.vcenter_port.port_key,
+        'vlan_id': vmi_model.vcenter_port.vlan_id,
+        'vlan_success': vmi_model.vcenter_port.vlan_success,
+        'ip_address': vnc_instance_ip.instance_ip_address if vnc_instance_ip is not None else None,
+    }
+
+
+def write_snapshot(path, snapshot):
+    """ Writes snapshot next to path and renames it into place, so readers never see a partial file. """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(',', ':'))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.rename(tmp_path, path)
+    # The rename itself is durable only once the directory entry is written
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_snapshot(path, max_age):
+    """ Returns the snapshot stored at path, or None when it is missing, unreadable, foreign or too old. """
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (IOError, OSError, ValueError) as exc:
+        logger.info('No usable snapshot at %s: %s', path, exc)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT_VERSION:
+        logger.error('Ignoring snapshot at %s with unsupported format', path)
+        return None
+    if time.time() - snapshot.get('created_at', 0) > max_age:
+        logger.info('Ignoring snapshot at %s older than %ss', path, max_age)
+        return None
+    return snapshot
+
+
+def discard_from_index(index, key, value):
+    values = index.get(key)
+    if values is None:
+        return
+    values.discard(value)
+    if not values:
+        index.pop(key)
+
+
+def get_old_name_from_vmfs_path(name):
+    # /vmfs/volumes/<datastore>/<old_name>/<old_name>.vmx -> <old_name>
+    if not isinstance(name, six.string_types) or VMFS not in name:
+        return None
+    parts = name.split('/')
+    if len(parts) < 2 or not parts[-1].startswith(parts[-2]):
+        return None
+    return parts[-2]
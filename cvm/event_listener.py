@@ -26,8 +26,19 @@ class EventListener(object):
                 self._update_set_queue.put(update_set)
 
     def _sync(self):
+        if self._database.get_all_vm_models() and self._controller.resync():
+            self._log_pending_work()
+            return
         self._database.clear_database()
         self._controller.sync()
+        self._database.drop_snapshot()
+        self._log_pending_work()
+
+    def _log_pending_work(self):
+        for name, (size, attempts, age) in sorted(self._database.get_pending_work_stats().items()):
+            if size:
+                logger.warning('%d entries left in %s after synchronization; '
+                               'up to %d attempts, oldest queued %.0fs ago', size, name, attempts, age)
 
     def _safe_wait_for_update(self, to_supervisor):
         to_supervisor.put('START_WAIT_FOR_UPDATES')
@@ -1,9 +1,11 @@
 from builtins import range
 from builtins import object
+import array
 import logging
 import uuid
 from collections import deque
 
+import gevent.lock
 from pyVmomi import vim  # pylint: disable=no-name-in-module
 from vnc_api.vnc_api import (InstanceIp, MacAddressesType, VirtualMachine,
                              VirtualMachineInterface)
@@ -23,33 +25,124 @@ def find_vrouter_uuid(host):
     return None
 
 
+class SnapshotRecord(object):
+    """ Immutable plain data copied out of PropertyCollector results; never touches managed objects. """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        values = dict(zip(self.__slots__, args), **kwargs)
+        for field in self.__slots__:
+            object.__setattr__(self, field, values.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def _values(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__))
+
+
+class HostRecord(SnapshotRecord):
+    __slots__ = ('uuid', 'name')
+
+
+class PortRecord(SnapshotRecord):
+    __slots__ = ('device_key', 'mac_address', 'port_key', 'portgroup_key')
+
+    @property
+    def signature(self):
+        return self.mac_address, self.port_key, self.portgroup_key
+
+
+class VmRecord(SnapshotRecord):
+    """ vmware_vm is kept only as a reference to pass back to explicit client calls; models keep moref instead. """
+    __slots__ = ('vmware_vm', 'moref', 'properties', 'ports', 'host', 'template', 'uuid', 'name')
+
+    def __init__(self, *args, **kwargs):
+        super(VmRecord, self).__init__(*args, **kwargs)
+        properties = dict(self.properties or ())
+        object.__setattr__(self, 'uuid', properties.get('config.instanceUuid'))
+        object.__setattr__(self, 'name', properties.get('name'))
+
+    @property
+    def vm_properties(self):
+        return dict(self.properties)
+
+    @property
+    def host_uuid(self):
+        return self.host.uuid if self.host is not None else None
+
+    @property
+    def port_signature(self):
+        return sorted(port.signature for port in self.ports)
+
+
+def make_port_records(devices):
+    return tuple(PortRecord(device_key=device.key,
+                            mac_address=device.macAddress,
+                            port_key=device.backing.port.portKey,
+                            portgroup_key=device.backing.port.portgroupKey)
+                 for device in devices
+                 if isinstance(device.backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo))
+
+
+def make_vm_record(vmware_vm, vm_properties, devices, host=None, template=False):
+    return VmRecord(vmware_vm=vmware_vm,
+                    moref=vmware_vm._moId,  # pylint: disable=protected-access
+                    properties=tuple(sorted(vm_properties.items())),
+                    ports=make_port_records(devices or []),
+                    host=host,
+                    template=bool(template))
+
+
 class VirtualMachineModel(object):
-    def __init__(self, vmware_vm, vm_properties):
-        self.vmware_vm = vmware_vm
-        self.vm_properties = vm_properties
-        self.devices = vmware_vm.config.hardware.device
-        host = vm_properties['summary.runtime.host']
-        self.host_uuid = host.hardware.systemInfo.uuid
+    def __init__(self, vm_record):
+        self.moref = vm_record.moref
+        self.vm_properties = vm_record.vm_properties
+        self.port_records = vm_record.ports
+        self.host_uuid = vm_record.host_uuid
         self.property_filter = None
+        # Set by the Database holding this model, so that renames re-index it
+        self.on_rename = None
         self.ports = self._read_ports()
         self.vmi_models = self._construct_interfaces()
 
-    def update(self, vmware_vm, vm_properties):
-        self.vmware_vm = vmware_vm
-        self.vm_properties = vm_properties
-        self.devices = vmware_vm.config.hardware.device
-        host = vm_properties['summary.runtime.host']
-        self.host_uuid = host.hardware.systemInfo.uuid
+    def update(self, vm_record):
+        self.moref = vm_record.moref
+        self.vm_properties = vm_record.vm_properties
+        self.port_records = vm_record.ports
+        self.host_uuid = vm_record.host_uuid
         self.ports = self._read_ports()
 
     def rename(self, name):
         self.vm_properties['name'] = name
+        if self.on_rename is not None:
+            self.on_rename(self)
 
-    def update_interfaces(self, vmware_vm):
-        self.devices = vmware_vm.config.hardware.device
+    def update_interfaces(self, vm_record):
+        self.port_records = vm_record.ports
         self.ports = self._read_ports()
         self.vmi_models = self._construct_interfaces()
 
+    @property
+    def port_signature(self):
+        return sorted(port.signature for port in self.port_records)
+
     def is_tools_running_status_changed(self, tools_running_status):
         return tools_running_status != self.vm_properties['guest.toolsRunningStatus']
 
@@ -63,19 +156,15 @@ class VirtualMachineModel(object):
         self.vm_properties['runtime.powerState'] = power_state
 
     def _read_ports(self):
-        try:
-            return [VCenterPort(device)
-                    for device in self.devices
-                    if isinstance(device.backing, vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo)]
-        except AttributeError:
-            logger.error('Could not read ports for %s.', self.name)
-        return None
+        return [VCenterPort(port_record) for port_record in self.port_records]
 
     def _construct_interfaces(self):
         return [VirtualMachineInterfaceModel(self, None, port)
                 for port in self.ports]
 
     def destroy_property_filter(self):
+        if self.property_filter is None:
+            return
         self.property_filter.DestroyPropertyFilter()
 
     @property
@@ -136,6 +225,10 @@ class VirtualNetworkModel(object):
 
 
 class VirtualMachineInterfaceModel(object):
+    # Derived identifiers are cached together with the inputs they were derived from
+    __slots__ = ('vm_model', 'vn_model', 'vcenter_port', '_ip_address', 'vnc_instance_ip', 'parent',
+                 'security_group', '_uuid_source', '_uuid', '_display_name_source', '_display_name')
+
     def __init__(self, vm_model, vn_model, vcenter_port):
         self.vm_model = vm_model
         self.vn_model = vn_model
@@ -144,11 +237,18 @@ class VirtualMachineInterfaceModel(object):
         self.vnc_instance_ip = None
         self.parent = None
         self.security_group = None
-        self._vnc_vmi = None
+        self._uuid_source = None
+        self._uuid = None
+        self._display_name_source = None
+        self._display_name = None
 
     @property
     def uuid(self):
-        return self.create_uuid(self.vcenter_port.mac_address)
+        mac_address = self.vcenter_port.mac_address
+        if mac_address != self._uuid_source or self._uuid is None:
+            self._uuid = self.create_uuid(mac_address)
+            self._uuid_source = mac_address
+        return self._uuid
 
     @property
     def ip_address(self):
@@ -156,19 +256,15 @@ class VirtualMachineInterfaceModel(object):
 
     @property
     def display_name(self):
-        if self.vn_model and self.vm_model:
-            return 'vmi-{}-{}'.format(self.vn_model.name, self.vm_model.name)
-        return None
-
-    @property
-    def vnc_vmi(self):
-        return self._construct_new_vnc_vmi()
-
-    @vnc_vmi.setter
-    def vnc_vmi(self, vmi):
-        self._vnc_vmi = vmi
-
-    def _construct_new_vnc_vmi(self):
+        if not (self.vn_model and self.vm_model):
+            return None
+        names = (self.vn_model.name, self.vm_model.name)
+        if names != self._display_name_source:
+            self._display_name = 'vmi-{}-{}'.format(*names)
+            self._display_name_source = names
+        return self._display_name
+
+    def construct_vnc_vmi(self):
         vmi = VirtualMachineInterface(name=self.uuid,
                                       display_name=self.display_name,
                                       parent_obj=self.parent,
@@ -207,7 +303,7 @@ class VirtualMachineInterfaceModel(object):
         )
         instance_ip.set_uuid(instance_ip_uuid)
         instance_ip.set_virtual_network(self.vn_model.vnc_vn)
-        instance_ip.set_virtual_machine_interface(self.vnc_vmi)
+        instance_ip.set_virtual_machine_interface(self._construct_vnc_vmi_ref())
 
         if self.vn_model.vnc_vn.get_external_ipam():
             logger.info('VN %s uses external IPAM - setting IP address to: %s',
@@ -216,6 +312,12 @@ class VirtualMachineInterfaceModel(object):
 
         self.vnc_instance_ip = instance_ip
 
+    def _construct_vnc_vmi_ref(self):
+        """ Only fq_name and uuid of the referred VMI are needed, so no VM, MAC or security group refs. """
+        vmi = VirtualMachineInterface(name=self.uuid, parent_obj=self.parent)
+        vmi.set_uuid(self.uuid)
+        return vmi
+
     def remove_from_vm_model(self):
         self.vm_model.vmi_models.remove(self)
 
@@ -237,39 +339,142 @@ class VirtualMachineInterfaceModel(object):
 
 
 class VlanIdPool(object):
+    """ Constant-time VLAN ID allocator: never used IDs go first (lowest first), then freed ones in FIFO order. """
+    _USED = 0
+    _FRESH = 1
+    _RECYCLED = 2
+
     def __init__(self, start, end):
-        self._available_ids = deque(list(range(start, end + 1)))
+        self._lock = gevent.lock.RLock()
+        self._reset(start, end)
+
+    def _reset(self, start, end):
+        self._start = start
+        self._end = end
+        self._states = bytearray([self._FRESH]) * (end - start + 1)
+        self._generations = array.array('L', [0]) * (end - start + 1)
+        self._cursor = 0
+        self._recycled = deque()
 
     def reserve(self, vlan_id):
-        try:
-            self._available_ids.remove(vlan_id)
-            logger.info('Reserved VLAN %s', vlan_id)
-        except ValueError:
-            pass
+        with self._lock:
+            self._reserve(vlan_id)
+
+    def _reserve(self, vlan_id):
+        index = self._index(vlan_id)
+        if index is None or self._states[index] == self._USED:
+            return
+        self._states[index] = self._USED
+        logger.info('Reserved VLAN %s', vlan_id)
 
     def get_available(self):
-        try:
-            vlan_id = self._available_ids.popleft()
-            logger.info('Reserved VLAN %s', vlan_id)
-            return vlan_id
-        except IndexError:
+        with self._lock:
+            return self._get_available()
+
+    def _get_available(self):
+        index = self._pop_fresh()
+        if index is None:
+            index = self._pop_recycled()
+        if index is None:
             raise Exception('No viable VLAN ID')
+        self._states[index] = self._USED
+        vlan_id = index + self._start
+        logger.info('Reserved VLAN %s', vlan_id)
+        return vlan_id
 
     def free(self, vlan_id):
-        if vlan_id not in self._available_ids:
-            self._available_ids.append(vlan_id)
+        with self._lock:
+            self._free(vlan_id)
+
+    def _free(self, vlan_id):
+        if vlan_id is None:
+            return
+        index = self._index(vlan_id)
+        if index is None:
+            logger.error('Unable to free VLAN %s out of range %s-%s', vlan_id, self._start, self._end)
+            return
+        if self._states[index] == self._USED:
+            self._states[index] = self._RECYCLED
+            self._generations[index] += 1
+            self._recycled.append((index, self._generations[index]))
         logger.info('Freed VLAN %s', vlan_id)
 
     def is_available(self, vlan_id):
-        return vlan_id in self._available_ids
+        with self._lock:
+            index = self._index(vlan_id)
+            return index is not None and self._states[index] != self._USED
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'start': self._start,
+                'end': self._end,
+                'cursor': self._cursor,
+                'reserved': [index + self._start for index, state in enumerate(self._states)
+                             if state == self._USED],
+                'recycled': [index + self._start for index, generation in self._recycled
+                             if self._is_recycled_entry_valid(index, generation)],
+            }
+
+    def restore(self, snapshot):
+        """ Restores allocations of a snapshot within the configured range, skipping IDs out of it. """
+        with self._lock:
+            self._reset(self._start, self._end)
+            if (snapshot['start'], snapshot['end']) == (self._start, self._end):
+                self._cursor = snapshot['cursor']
+                for index in range(self._cursor):
+                    self._states[index] = self._USED
+            else:
+                logger.warning('VLAN range %s-%s of the snapshot differs from configured %s-%s, '
+                               'restoring only reserved and recycled IDs', snapshot['start'], snapshot['end'],
+                               self._start, self._end)
+            for vlan_id in snapshot['reserved']:
+                if self._index(vlan_id) is None:
+                    logger.error('Unable to reserve VLAN %s out of range %s-%s', vlan_id, self._start, self._end)
+                    continue
+                self._reserve(vlan_id)
+            for vlan_id in snapshot['recycled']:
+                index = self._index(vlan_id)
+                if index is None:
+                    logger.error('Unable to free VLAN %s out of range %s-%s', vlan_id, self._start, self._end)
+                    continue
+                self._states[index] = self._USED
+                self._free(vlan_id)
+
+    def _index(self, vlan_id):
+        if vlan_id is None or not self._start <= vlan_id <= self._end:
+            return None
+        return vlan_id - self._start
+
+    def _pop_fresh(self):
+        while self._cursor < len(self._states):
+            index = self._cursor
+            self._cursor += 1
+            if self._states[index] == self._FRESH:
+                return index
+        return None
+
+    def _pop_recycled(self):
+        while self._recycled:
+            index, generation = self._recycled.popleft()
+            if self._is_recycled_entry_valid(index, generation):
+                return index
+        return None
+
+    def _is_recycled_entry_valid(self, index, generation):
+        # Entries are removed lazily: reserving a recycled ID or freeing it
+        # again leaves the old queue entry behind, so it has to be skipped.
+        return self._states[index] == self._RECYCLED and self._generations[index] == generation
 
 
 class VCenterPort(object):
-    def __init__(self, device):
-        self.device = device
-        self.mac_address = device.macAddress
-        self.port_key = device.backing.port.portKey
-        self.portgroup_key = device.backing.port.portgroupKey
+    __slots__ = ('device_key', 'mac_address', 'port_key', 'portgroup_key', 'vlan_id', 'vlan_success')
+
+    def __init__(self, port_record):
+        self.device_key = port_record.device_key
+        self.mac_address = port_record.mac_address
+        self.port_key = port_record.port_key
+        self.portgroup_key = port_record.portgroup_key
         self.vlan_id = None
         self.vlan_success = False
 
@@ -1,15 +1,552 @@
 from builtins import object
+from builtins import range
+import collections
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import itertools
 import logging
+import os
+import struct
+import time
+
+import gevent
+import gevent.event
+import gevent.queue
+import gevent.socket
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+from cvm import database as db
+from cvm import exceptions
+from cvm.constants import (VLAN_WORKERS, VLAN_WORKER_BATCH_SIZE, VLAN_WORKER_RETRY_LIMIT,
+                           VLAN_WORKER_BACKOFF, VLAN_WORKER_LATENCY_SAMPLES,
+                           COALESCE_MAX_UPDATE_SETS, SNAPSHOT_INTERVAL, PORT_FILES_POLL_INTERVAL)
 
 logger = logging.getLogger(__name__)
 
 
 class VMwareMonitor(object):
-    def __init__(self, vmware_controller, update_set_queue):
+    def __init__(self, vmware_controller, update_set_queue, coalescer=None, workers=1):
         self._controller = vmware_controller
         self._update_set_queue = update_set_queue
+        self._coalescer = coalescer
+        self._workers = workers
 
     def monitor(self):
+        if self._workers <= 1:
+            while True:
+                self._controller.handle_update(self._get_update_set())
+        shard_queues = [gevent.queue.JoinableQueue() for _ in range(self._workers)]
+        greenlets = [gevent.spawn(self._dispatch, shard_queues)]
+        greenlets.extend(gevent.spawn(self._work, shard_queue) for shard_queue in shard_queues)
+        try:
+            gevent.joinall(greenlets, raise_error=True)
+        finally:
+            gevent.killall(greenlets)
+
+    def _get_update_set(self):
+        update_set = self._update_set_queue.get()
+        if self._coalescer is not None:
+            update_set = self._coalescer.coalesce([update_set] + self._drain_queue())
+        return update_set
+
+    def _drain_queue(self):
+        update_sets = []
+        while len(update_sets) < COALESCE_MAX_UPDATE_SETS - 1:
+            try:
+                update_sets.append(self._update_set_queue.get_nowait())
+            except gevent.queue.Empty:
+                break
+        return update_sets
+
+    def _dispatch(self, shard_queues):
         while True:
-            update_set = self._update_set_queue.get()
-            self._controller.handle_update(update_set)
+            update_set = self._get_update_set()
+            entries_by_shard = shard_update_set(update_set, len(shard_queues))
+            if entries_by_shard is None:
+                # Some event can't be matched to its VM's shard, so handle the whole set alone
+                for shard_queue in shard_queues:
+                    shard_queue.join()
+                shard_queues[0].put(update_set)
+                shard_queues[0].join()
+                continue
+            for index, entries in sorted(entries_by_shard.items()):
+                shard_queues[index].put(make_update_set(update_set.version, entries))
+
+    def _work(self, shard_queue):
+        while True:
+            update_set = shard_queue.get()
+            try:
+                self._controller.handle_update(update_set)
+            finally:
+                shard_queue.task_done()
+
+
+def shard_update_set(update_set, shards):
+    """
+    Splits changes into {shard: [(obj, change)]} so that all changes of one VM land in the same shard.
+
+    Returns None if an event names a VM without referencing it, since its shard can't be told.
+    """
+    entries_by_shard = collections.defaultdict(list)
+    for filter_update in update_set.filterSet:
+        for object_update in filter_update.objectSet:
+            obj = object_update.obj
+            for change in object_update.changeSet:
+                name = getattr(change, 'name', None) or ''
+                if not name.startswith(UpdateSetCoalescer.EVENT_PROPERTY_NAME):
+                    entries_by_shard[hash(obj) % shards].append((obj, change))
+                    continue
+                for event in get_events(change.val):
+                    vm = getattr(event, 'vm', None)
+                    if vm is not None and vm.vm is None:
+                        return None
+                    entries_by_shard[hash(get_event_vm(event)) % shards].append((obj, make_change(name, event)))
+    return entries_by_shard
+
+
+class UpdateSetCoalescer(object):
+    """ Merges queued update sets into one, dropping property changes and events superseded by later ones. """
+    EVENT_PROPERTY_NAME = 'latestPage'
+
+    def __init__(self):
+        self.coalesced_update_sets = 0
+        self.dropped_changes = 0
+
+    def coalesce(self, update_sets):
+        entries = []
+        last_property_change = {}
+        last_vm_event = {}
+        seen_event_keys = set()
+        dropped = 0
+
+        def drop(index):
+            entries[index] = None
+            return 1
+
+        for update_set in update_sets:
+            for filter_update in update_set.filterSet:
+                for object_update in filter_update.objectSet:
+                    obj = object_update.obj
+                    for change in object_update.changeSet:
+                        name = getattr(change, 'name', None) or ''
+                        if not name.startswith(self.EVENT_PROPERTY_NAME):
+                            # Only the latest value of a property matters, at the position it arrived
+                            previous = last_property_change.get((obj, name))
+                            if previous is not None:
+                                dropped += drop(previous)
+                            last_property_change[(obj, name)] = len(entries)
+                            entries.append((obj, change))
+                            continue
+                        for event in get_events(change.val):
+                            if event.key in seen_event_keys:
+                                dropped += 1
+                                continue
+                            seen_event_keys.add(event.key)
+                            vm = get_event_vm(event)
+                            previous = last_vm_event.get(vm) if vm is not None else None
+                            if previous is not None and is_superseded_reconfigure(entries[previous][1].val, event):
+                                if has_ethernet_device_change(event) or not has_ethernet_device_change(
+                                        entries[previous][1].val):
+                                    dropped += drop(previous)
+                                else:
+                                    dropped += 1
+                                    continue
+                            if vm is not None:
+                                last_vm_event[vm] = len(entries)
+                            entries.append((obj, make_change(name, event)))
+
+        self.coalesced_update_sets += len(update_sets)
+        self.dropped_changes += dropped
+        if dropped:
+            logger.info('Coalesced %d update sets, dropped %d superseded changes', len(update_sets), dropped)
+        return make_update_set(update_sets[-1].version, [entry for entry in entries if entry is not None])
+
+
+def get_events(value):
+    if isinstance(value, list):
+        return sorted(value, key=lambda e: e.key)
+    if value is None:
+        return []
+    return [value]
+
+
+def get_event_vm(event):
+    vm = getattr(event, 'vm', None)
+    if vm is None:
+        return None
+    return vm.vm if vm.vm is not None else vm.name
+
+
+def is_superseded_reconfigure(previous_event, event):
+    return isinstance(previous_event, vim.event.VmReconfiguredEvent) and \
+        isinstance(event, vim.event.VmReconfiguredEvent)
+
+
+def has_ethernet_device_change(event):
+    device_changes = event.configSpec.deviceChange or []
+    return any(isinstance(device_spec.device, vim.vm.device.VirtualEthernetCard) for device_spec in device_changes)
+
+
+def make_change(name, value):
+    change = vmodl.query.PropertyCollector.Change()
+    change.name = name
+    change.op = 'assign'
+    change.val = value
+    return change
+
+
+def make_update_set(version, entries):
+    update_set = vmodl.query.PropertyCollector.UpdateSet()
+    update_set.version = version
+    filter_update = vmodl.query.PropertyCollector.FilterUpdate()
+    for obj, change in entries:
+        object_update = vmodl.query.PropertyCollector.ObjectUpdate()
+        object_update.kind = 'modify'
+        if obj is not None:
+            object_update.obj = obj
+        object_update.changeSet = [change]
+        filter_update.objectSet.append(object_update)
+    update_set.filterSet = [filter_update]
+    return update_set
+
+
+class VlanIdTask(object):
+    def __init__(self, action, vmi_model, enqueued_at, attempt=0, seq=0):
+        self.action = action
+        self.vmi_model = vmi_model
+        self.enqueued_at = enqueued_at
+        self.attempt = attempt
+        self.seq = seq
+
+
+class VlanIdWorkerPool(object):
+    """ Programs vCenter VLANs on worker greenlets, so that event handling does not wait for vCenter tasks. """
+    UPDATE = 'update'
+    RESTORE = 'restore'
+
+    def __init__(self, vlan_id_service, size=VLAN_WORKERS, batch_size=VLAN_WORKER_BATCH_SIZE,
+                 retry_limit=VLAN_WORKER_RETRY_LIMIT, backoff=VLAN_WORKER_BACKOFF):
+        self._vlan_id_service = vlan_id_service
+        self._size = size
+        self._batch_size = batch_size
+        self._retry_limit = retry_limit
+        self._backoff = backoff
+        # VMI uuid -> its tasks in order; only the first one of each VMI may be taken
+        self._tasks = {}
+        self._queued = 0
+        # action -> heap of (seq, VMI uuid) of first tasks, stale entries are skipped when taken
+        self._ready = {self.UPDATE: [], self.RESTORE: []}
+        self._seq = itertools.count()
+        self._in_flight = set()
+        # VMI uuid -> retry task waiting for its backoff
+        self._delayed = {}
+        self._has_tasks = gevent.event.Event()
+        self._latencies = collections.deque(maxlen=VLAN_WORKER_LATENCY_SAMPLES)
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def submit_update(self, vmi_models):
+        self._submit(self.UPDATE, vmi_models)
+
+    def submit_restore(self, vmi_models):
+        self._submit(self.RESTORE, vmi_models)
+
+    def run(self):
+        workers = [gevent.spawn(self._work) for _ in range(self._size)]
+        gevent.joinall(workers, raise_error=True)
+
+    def get_stats(self):
+        latencies = list(self._latencies)
+        return {
+            'queue_depth': self._queued + len(self._delayed),
+            'in_flight': len(self._in_flight),
+            'completed': self.completed,
+            'retried': self.retried,
+            'failed': self.failed,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_max': max(latencies) if latencies else 0.0,
+        }
+
+    def _submit(self, action, vmi_models):
+        now = time.time()
+        for vmi_model in vmi_models:
+            retry = self._delayed.pop(vmi_model.uuid, None)
+            if retry is not None:
+                logger.info('Dropping retry of %s of VLAN ID for %s, superseded by %s',
+                            retry.action, vmi_model, action)
+            self._enqueue(VlanIdTask(action, vmi_model, now))
+        if vmi_models:
+            self._has_tasks.set()
+
+    def _enqueue(self, task):
+        task.seq = next(self._seq)
+        uuid = task.vmi_model.uuid
+        self._tasks.setdefault(uuid, collections.deque()).append(task)
+        self._queued += 1
+        self._schedule(uuid)
+
+    def _schedule(self, uuid):
+        """ Makes the first task of a VMI available to workers, unless the VMI is busy. """
+        tasks = self._tasks.get(uuid)
+        if not tasks or uuid in self._in_flight or uuid in self._delayed:
+            return
+        heapq.heappush(self._ready[tasks[0].action], (tasks[0].seq, uuid))
+
+    def _peek(self, action):
+        """ Returns seq of the oldest task of action that can be taken, dropping stale heap entries. """
+        ready = self._ready[action]
+        while ready:
+            seq, uuid = ready[0]
+            tasks = self._tasks.get(uuid)
+            if tasks and tasks[0].seq == seq and uuid not in self._in_flight and uuid not in self._delayed:
+                return seq
+            heapq.heappop(ready)
+        return None
+
+    def _work(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                self._has_tasks.clear()
+                self._has_tasks.wait()
+                continue
+            self._process(batch)
+
+    def _take_batch(self):
+        """ Takes up to batch_size tasks of one action, never two for the same VMI or one overtaking another. """
+        seqs = [(seq, action) for action, seq in ((action, self._peek(action)) for action in self._ready)
+                if seq is not None]
+        if not seqs:
+            return []
+        action = min(seqs)[1]
+        batch = []
+        while len(batch) < self._batch_size and self._peek(action) is not None:
+            _, uuid = heapq.heappop(self._ready[action])
+            tasks = self._tasks[uuid]
+            batch.append(tasks.popleft())
+            if not tasks:
+                del self._tasks[uuid]
+            self._queued -= 1
+            self._in_flight.add(uuid)
+        return batch
+
+    def _process(self, batch):
+        vmi_models = [task.vmi_model for task in batch]
+        try:
+            if batch[0].action == self.UPDATE:
+                failed_vmi_models = self._vlan_id_service.set_vcenter_vlans(vmi_models)
+            else:
+                failed_vmi_models = self._vlan_id_service.restore_vcenter_vlans(vmi_models)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during %s of vCenter VLANs', exc, batch[0].action, exc_info=True)
+            failed_vmi_models = vmi_models
+        finally:
+            for vmi_model in vmi_models:
+                self._in_flight.discard(vmi_model.uuid)
+
+        failed_uuids = set(vmi_model.uuid for vmi_model in failed_vmi_models)
+        now = time.time()
+        for task in batch:
+            if task.vmi_model.uuid in failed_uuids:
+                self._retry(task)
+            else:
+                self.completed += 1
+                self._latencies.append(now - task.enqueued_at)
+            # Tasks waiting for this VMI can be taken now
+            self._schedule(task.vmi_model.uuid)
+        self._has_tasks.set()
+
+    def _retry(self, task):
+        if task.attempt + 1 >= self._retry_limit:
+            self.failed += 1
+            logger.error('Giving up %s of VLAN ID for %s after %d attempts',
+                         task.action, task.vmi_model, task.attempt + 1)
+            return
+        uuid = task.vmi_model.uuid
+        if uuid in self._tasks:
+            logger.info('Not retrying %s of VLAN ID for %s, superseded by a newer task', task.action, task.vmi_model)
+            return
+        self.retried += 1
+        retry = VlanIdTask(task.action, task.vmi_model, task.enqueued_at, task.attempt + 1)
+        # Newer tasks of this VMI supersede the retry instead of overtaking it, see _submit
+        self._delayed[uuid] = retry
+        delay = self._backoff * 2 ** task.attempt
+        logger.info('Retrying %s of VLAN ID for %s in %ss', task.action, task.vmi_model, delay)
+        gevent.spawn_later(delay, self._requeue, retry)
+
+    def _requeue(self, task):
+        uuid = task.vmi_model.uuid
+        if self._delayed.get(uuid) is not task:
+            return
+        del self._delayed[uuid]
+        self._enqueue(task)
+        self._has_tasks.set()
+
+
+class DatabaseSnapshotWriter(object):
+    """ Periodically persists a Database snapshot, so that a restarted process can start warm. """
+
+    def __init__(self, database, esxi_api_client, lock, path, interval=SNAPSHOT_INTERVAL):
+        self._database = database
+        self._esxi_api_client = esxi_api_client
+        self._lock = lock
+        self._path = path
+        self._interval = interval
+        self.last_written_at = None
+
+    def run(self):
+        while True:
+            gevent.sleep(self._interval)
+            try:
+                self.write()
+            except exceptions.CVMError:
+                raise
+            except Exception as exc:
+                logger.error('Unexpected exception %s during writing Database snapshot', exc, exc_info=True)
+
+    def write(self):
+        with self._lock.shared():
+            snapshot = self._database.make_snapshot(self._esxi_api_client.get_updates_version())
+        start = time.time()
+        db.write_snapshot(self._path, snapshot)
+        self.last_written_at = time.time()
+        logger.info('Wrote Database snapshot with %d VMIs to %s in %.3fs',
+                    len(snapshot['vmis']), self._path, self.last_written_at - start)
+
+
+class InotifyWatch(object):
+    """ Linux inotify watch of one directory, read cooperatively with gevent. """
+
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_MOVE_SELF
+
+    _event = struct.Struct('iIII')
+    _libc = None
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    @classmethod
+    def open(cls, path):
+        """ Returns a watch of path, or None when inotify or the directory is not available. """
+        libc = cls._load_libc()
+        if libc is None or not os.path.isdir(path):
+            return None
+        fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        if fd < 0:
+            logger.warning('Unable to initialize inotify: %s', os.strerror(ctypes.get_errno()))
+            return None
+        if libc.inotify_add_watch(fd, path.encode('utf-8'), cls.MASK) < 0:
+            logger.warning('Unable to watch %s with inotify: %s', path, os.strerror(ctypes.get_errno()))
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                libc.inotify_init1, libc.inotify_add_watch  # pylint: disable=pointless-statement
+            except (OSError, AttributeError):
+                libc = False
+            cls._libc = libc
+        return cls._libc or None
+
+    def read(self):
+        """ Waits for events and returns them as (mask, file name) pairs. """
+        gevent.socket.wait_read(self._fd)
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as exc:
+            if exc.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PortFileMonitor(object):
+    """ Keeps the vRouter port file index current and restores ports whose files are removed out of band. """
+
+    def __init__(self, vrouter_api_client, vrouter_port_service, lock, poll_interval=PORT_FILES_POLL_INTERVAL):
+        self._index = vrouter_api_client.port_file_index
+        self._vrouter_port_service = vrouter_port_service
+        self._lock = lock
+        self._poll_interval = poll_interval
+
+    def run(self):
+        while True:
+            watch = InotifyWatch.open(self._index.path)
+            if watch is None:
+                self._rescan()
+                gevent.sleep(self._poll_interval)
+                continue
+            try:
+                self._follow(watch)
+            finally:
+                self._index.watched = False
+                watch.close()
+
+    def _follow(self, watch):
+        logger.info('Watching vRouter port files in %s', self._index.path)
+        self._index.watched = True
+        # Scan only once the watch is in place, so that no change slips in between
+        self._rescan()
+        while True:
+            removed = set()
+            for mask, name in watch.read():
+                if mask & InotifyWatch.IN_Q_OVERFLOW:
+                    removed.update(self._index.rescan())
+                elif mask & (InotifyWatch.IN_DELETE_SELF | InotifyWatch.IN_MOVE_SELF | InotifyWatch.IN_IGNORED):
+                    logger.warning('vRouter port file directory %s is gone, polling for it', self._index.path)
+                    self._handle_removed(removed)
+                    return
+                elif mask & InotifyWatch.IN_ISDIR or not name:
+                    continue
+                elif mask & (InotifyWatch.IN_CREATE | InotifyWatch.IN_MOVED_TO):
+                    self._index.add(name)
+                    removed.discard(name)
+                elif self._index.remove(name):
+                    removed.add(name)
+            self._handle_removed(removed)
+
+    def _rescan(self):
+        self._handle_removed(self._index.rescan())
+
+    def _handle_removed(self, port_uuids):
+        if not port_uuids:
+            return
+        logger.info('vRouter port files removed: %s', sorted(port_uuids))
+        try:
+            with self._lock.shared():
+                self._vrouter_port_service.restore_ports(port_uuids)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during restoring vRouter ports', exc, exc_info=True)
@@ -2,23 +2,99 @@ from builtins import str
 from builtins import next
 from builtins import range
 from builtins import object
+import collections
+import contextlib
+import functools
 import ipaddress
 import logging
+import sys
 import time
 
+import gevent
+import gevent.lock
+import six
 from pyVmomi import vmodl  # pylint: disable=no-name-in-module
 from vnc_api.gen.resource_xsd import PermType2
 
 from cvm import exceptions
 from cvm.constants import (CONTRAIL_VM_NAME, VM_UPDATE_FILTERS,
                            VNC_ROOT_DOMAIN, VNC_VCENTER_PROJECT,
-                           WAIT_FOR_PORT_RETRY_TIME, WAIT_FOR_PORT_RETRY_LIMIT,
-                           SET_VLAN_ID_RETRY_LIMIT)
+                           WAIT_FOR_PORT_RETRY_TIME, WAIT_FOR_PORT_TIMEOUT,
+                           SET_VLAN_ID_RETRY_LIMIT, SYNC_POOL_SIZE,
+                           SYNC_BACKEND_LIMITS, PORT_CHANGE_CREATE, PORT_CHANGE_IDENTITY,
+                           PORT_CHANGE_IP, PORT_CHANGE_VLAN, PORT_CHANGE_IP_AND_VLAN)
+from cvm.database import get_work_owner
 from cvm.models import (VirtualMachineInterfaceModel, VirtualMachineModel,
                         VirtualNetworkModel)
 
 logger = logging.getLogger(__name__)
 
+InventoryDiff = collections.namedtuple('InventoryDiff', ['added', 'changed', 'unchanged', 'vanished'])
+
+
+class SyncExecutor(object):
+    """ Runs a step over many items on worker greenlets, capped by the limit of the backend it talks to. """
+
+    def __init__(self, pool_size=SYNC_POOL_SIZE, backend_limits=None):
+        self._pool_size = pool_size
+        self._backend_limits = dict(SYNC_BACKEND_LIMITS, **(backend_limits or {}))
+        # One semaphore per backend, so that its limit holds across concurrent and nested maps
+        self._semaphores = {}
+        self._holders = collections.defaultdict(set)
+        self.phase_times = collections.OrderedDict()
+
+    def _get_limit(self, backend):
+        return max(min(self._pool_size, self._backend_limits.get(backend, self._pool_size)), 1)
+
+    def _get_semaphore(self, backend):
+        semaphore = self._semaphores.get(backend)
+        if semaphore is None:
+            semaphore = self._semaphores[backend] = gevent.lock.BoundedSemaphore(self._get_limit(backend))
+        return semaphore
+
+    def map(self, func, items, backend):
+        """ Calls func on every item; the first exception stops taking new ones and is re-raised with its traceback. """
+        items = list(items)
+        holders = self._holders[backend]
+        if gevent.getcurrent() in holders:
+            # Called from an item of the same backend, which already holds a slot the inner items share
+            for item in items:
+                func(item)
+            return
+        semaphore = self._get_semaphore(backend)
+        remaining = iter(items)
+        errors = []
+
+        def work():
+            for item in remaining:
+                if errors:
+                    return
+                with semaphore:
+                    holders.add(gevent.getcurrent())
+                    try:
+                        func(item)
+                    except Exception:
+                        errors.append(sys.exc_info())
+                    finally:
+                        holders.discard(gevent.getcurrent())
+
+        size = min(self._get_limit(backend), len(items))
+        if size <= 1:
+            work()
+        else:
+            gevent.joinall([gevent.spawn(work) for _ in range(size)], raise_error=True)
+        if errors:
+            six.reraise(*errors[0])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = time.time() - start
+            logger.info('Sync phase %s took %.3fs', name, self.phase_times[name])
+
 
 class Service(object):
     def __init__(self, database, vnc_api_client, esxi_api_client,
@@ -32,29 +108,39 @@ class Service(object):
         self._project = self._vnc_api_client.read_or_create_project()
         self._default_security_group = self._vnc_api_client.read_or_create_security_group()
         self._ipam = self._vnc_api_client.read_or_create_ipam()
+        self._sync_executor = SyncExecutor(pool_size=1)
+
+    def use_sync_executor(self, sync_executor):
+        """ Spreads per-item work of this service over sync_executor instead of running it in a loop. """
+        self._sync_executor = sync_executor
 
 
 class VirtualMachineInterfaceService(Service):
-    def update_vmis(self):
-        for vmi_model in list(self._database.vmis_to_update):
-            try:
-                logger.info('Updating %s', vmi_model)
-                self._update_vmi(vmi_model)
-                self._database.vmis_to_update.remove(vmi_model)
-                logger.info('Updated %s', vmi_model)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during updating VMI', exc, exc_info=True)
+    def update_vmis(self, vm_uuids=None):
+        with self._database.vmis_to_update.claim(vm_uuids) as vmi_models:
+            self._sync_executor.map(self._update_pending_vmi, vmi_models, backend='vnc')
+        with self._database.vmis_to_delete.claim(vm_uuids) as vmi_models:
+            self._sync_executor.map(self._delete_pending_vmi, vmi_models, backend='vnc')
 
-        for vmi_model in list(self._database.vmis_to_delete):
-            try:
-                self._delete(vmi_model)
-                self._database.vmis_to_delete.remove(vmi_model)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during deleting VMI', exc, exc_info=True)
+    def _update_pending_vmi(self, vmi_model):
+        try:
+            logger.info('Updating %s', vmi_model)
+            self._update_vmi(vmi_model)
+            self._database.vmis_to_update.discard(vmi_model)
+            logger.info('Updated %s', vmi_model)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during updating VMI', exc, exc_info=True)
+
+    def _delete_pending_vmi(self, vmi_model):
+        try:
+            self._delete(vmi_model)
+            self._database.vmis_to_delete.discard(vmi_model)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during deleting VMI', exc, exc_info=True)
 
     def _update_vmis_vn(self, vmi_model):
         new_vn_model = self._database.get_vn_model_by_key(vmi_model.vcenter_port.portgroup_key)
@@ -67,18 +153,30 @@ class VirtualMachineInterfaceService(Service):
 
         if vmi_model.vn_model != new_vn_model:
             if vmi_model.vn_model is not None:
-                self._database.ports_to_delete.append(vmi_model.uuid)
+                self._delete_vrouter_port(vmi_model)
             vmi_model.vn_model = new_vn_model
 
     def _update_vmi(self, vmi_model):
         self._add_default_vnc_info_to(vmi_model)
         self._update_vmis_vn(vmi_model)
         self._assign_vlan_id(vmi_model)
-        self._update_in_vnc(vmi_model)
-        self._add_instance_ip_to(vmi_model)
+        if not self._restore_from_snapshot(vmi_model):
+            self._update_in_vnc(vmi_model)
+            self._add_instance_ip_to(vmi_model)
         self._update_vrouter_port(vmi_model)
         self._database.save(vmi_model)
 
+    def _restore_from_snapshot(self, vmi_model):
+        record = self._database.get_snapshot_vmi(vmi_model.uuid)
+        if not is_vmi_unchanged_since(record, vmi_model):
+            return False
+        logger.info('%s is unchanged since the snapshot, skipping VNC update', vmi_model)
+        vmi_model.construct_instance_ip()
+        if vmi_model.vnc_instance_ip is not None and record['ip_address']:
+            vmi_model.vnc_instance_ip.set_instance_ip_address(record['ip_address'])
+            vmi_model.update_ip_address(record['ip_address'])
+        return True
+
     def _assign_vlan_id(self, vmi_model):
         self._database.vlans_to_update.append(vmi_model)
 
@@ -87,7 +185,7 @@ class VirtualMachineInterfaceService(Service):
         vmi_model.security_group = self._default_security_group
 
     def _update_in_vnc(self, vmi_model):
-        self._vnc_api_client.update_vmi(vmi_model.vnc_vmi)
+        self._vnc_api_client.update_vmi(vmi_model.construct_vnc_vmi())
 
     def _add_instance_ip_to(self, vmi_model):
         vmi_model.construct_instance_ip()
@@ -104,17 +202,19 @@ class VirtualMachineInterfaceService(Service):
         self._database.ports_to_update.append(vmi_model)
 
     def update_nic(self, nic_info):
+        """ Returns the VMI model of nic_info, if there is one. """
         vmi_model = self._database.get_vmi_model_by_uuid(VirtualMachineInterfaceModel.create_uuid(nic_info.macAddress))
         if not vmi_model:
-            return
+            return None
         if not vmi_model.vn_model.vnc_vn.external_ipam:
-            return
+            return vmi_model
 
         try:
             for ip_address in nic_info.ipAddress:
                 self._update_ip_address(vmi_model, ip_address)
         except AttributeError:
             pass
+        return vmi_model
 
     def _update_ip_address(self, vmi_model, ip_address):
         if not isinstance(ipaddress.ip_address(str(ip_address)),
@@ -132,7 +232,7 @@ class VirtualMachineInterfaceService(Service):
         self._delete_from_vnc(vmi_model)
         self._restore_vlan_id(vmi_model)
         self._database.delete_vmi_model(vmi_model.uuid)
-        self._delete_vrouter_port(vmi_model.uuid)
+        self._delete_vrouter_port(vmi_model)
 
     def _delete_from_vnc(self, vmi_model):
         self._vnc_api_client.delete_vmi(vmi_model.uuid)
@@ -140,8 +240,8 @@ class VirtualMachineInterfaceService(Service):
     def _restore_vlan_id(self, vmi_model):
         self._database.vlans_to_restore.append(vmi_model)
 
-    def _delete_vrouter_port(self, uuid):
-        self._database.ports_to_delete.append(uuid)
+    def _delete_vrouter_port(self, vmi_model):
+        self._database.ports_to_delete.append(vmi_model.uuid, owner=get_work_owner(vmi_model))
 
     def remove_vmis_for_vm_model(self, vm_name):
         vm_model = self._database.get_vm_model_by_name(vm_name)
@@ -160,9 +260,10 @@ class VirtualMachineInterfaceService(Service):
                 self._local_remove(vmi_model)
 
     def _local_remove(self, vmi_model):
+        self._database.release_vlan_id(vmi_model)
         self._vlan_id_pool.free(vmi_model.vcenter_port.vlan_id)
         self._database.delete_vmi_model(vmi_model.uuid)
-        self._delete_vrouter_port(vmi_model.uuid)
+        self._delete_vrouter_port(vmi_model)
 
     def _full_remove(self, vmi_model):
         self._local_remove(vmi_model)
@@ -178,28 +279,50 @@ class VirtualMachineInterfaceService(Service):
                     self._update_in_vnc(vmi_model)
                 self._update_vrouter_port(vmi_model)
 
-    def register_vmis(self):
-        for vmi_model in list(self._database.vmis_to_update):
-            logger.info('Updating %s', vmi_model)
-            self._update_vmi(vmi_model)
-            self._database.vmis_to_update.remove(vmi_model)
-            logger.info('Updated %s', vmi_model)
+    def register_vmis(self, vm_uuids=None):
+        with self._database.vmis_to_update.claim(vm_uuids) as vmi_models:
+            for vmi_model in vmi_models:
+                logger.info('Updating %s', vmi_model)
+                self._update_vmi(vmi_model)
+                self._database.vmis_to_update.discard(vmi_model)
+                logger.info('Updated %s', vmi_model)
 
-    def delete_unused_vmis_in_vnc(self):
-        for vm_model in self._database.get_all_vm_models():
+    def delete_unused_vmis_in_vnc(self, vm_uuids=None):
+        if vm_uuids is None:
+            vm_models = self._database.get_all_vm_models()
+        else:
+            vm_models = [vm_model for vm_model in map(self._database.get_vm_model_by_uuid, vm_uuids) if vm_model]
+        if not vm_models:
+            return
+        try:
+            vnc_vmi_uuids = self._vnc_api_client.get_vmi_uuids_by_vm_uuids(
+                [vm_model.uuid for vm_model in vm_models]
+            )
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during reading VMIs from VNC', exc, exc_info=True)
+            return
+
+        def delete_unused_vmis(vm_model):
             try:
-                self.delete_unused_vm_vmis_in_vnc(vm_model.uuid)
+                self._delete_unused_vmis_in_vnc(vm_model, vnc_vmi_uuids.get(vm_model.uuid, ()))
             except exceptions.CVMError:
                 raise
             except Exception as exc:
                 logger.error('Unexpected exception %s during deleting stale VMIs from VNC', exc, exc_info=True)
 
+        self._sync_executor.map(delete_unused_vmis, vm_models, backend='vnc')
+
     def delete_unused_vm_vmis_in_vnc(self, vm_uuid):
         vm_model = self._database.get_vm_model_by_uuid(vm_uuid)
+        vnc_vmi_uuids = self._vnc_api_client.get_vmi_uuids_by_vm_uuid(vm_uuid)
+        self._delete_unused_vmis_in_vnc(vm_model, vnc_vmi_uuids)
+
+    def _delete_unused_vmis_in_vnc(self, vm_model, vnc_vmi_uuids):
         vmi_model_uuids = set(
             vmi_model.uuid for vmi_model in vm_model.vmi_models
         )
-        vnc_vmi_uuids = self._vnc_api_client.get_vmi_uuids_by_vm_uuid(vm_uuid)
         for vnc_vmi_uuid in vnc_vmi_uuids:
             try:
                 if vnc_vmi_uuid not in vmi_model_uuids:
@@ -213,22 +336,12 @@ class VirtualMachineInterfaceService(Service):
 
 class VirtualMachineService(Service):
     def update(self, vmware_vm):
-        vm_properties = self.get_vm_vmware_properties(vmware_vm)
-        if is_contrail_vm_name(vm_properties['name']):
-            return
-        try:
-            vm_uuid = vmware_vm.config.instanceUuid
-        except AttributeError:
-            logger.error('VM: %s has no vCenter uuid', vm_properties.get('name'))
-            return
-        vm_model = self._database.get_vm_model_by_uuid(vm_uuid)
-        if vm_model:
-            self._update(vm_model, vmware_vm, vm_properties)
-            return
-        self._create(vmware_vm, vm_properties)
-
-    def get_vm_vmware_properties(self, vmware_vm):
-        return self._esxi_api_client.read_vm_properties(vmware_vm)
+        """ Returns the updated VM model, or None when vmware_vm isn't handled. """
+        vm_record = self._esxi_api_client.read_vm_record(vmware_vm)
+        if vm_record is None:
+            logger.error('VM: %s could not be read from ESXi', vmware_vm)
+            return None
+        return self.update_from_record(vm_record)
 
     def get_vm_model_by_uuid(self, vm_uuid):
         return self._database.get_vm_model_by_uuid(vm_uuid)
@@ -236,21 +349,39 @@ class VirtualMachineService(Service):
     def get_vm_model_by_name(self, vm_name):
         return self._database.get_vm_model_by_name(vm_name)
 
-    def _update(self, vm_model, vmware_vm, vm_properties):
+    def update_from_record(self, vm_record):
+        if is_contrail_vm_name(vm_record.name):
+            return None
+        if vm_record.uuid is None:
+            logger.error('VM: %s has no vCenter uuid', vm_record.name)
+            return None
+        if vm_record.template:
+            logger.info('VM: %s is a template.', vm_record.name)
+            return None
+        vm_model = self._database.get_vm_model_by_uuid(vm_record.uuid)
+        if vm_model:
+            self._update(vm_model, vm_record)
+            return vm_model
+        return self._create(vm_record)
+
+    def _update(self, vm_model, vm_record):
         logger.info('Updating %s', vm_model)
-        vm_model.update(vmware_vm, vm_properties)
+        vm_model.update(vm_record)
         logger.info('Updated %s', vm_model)
         for vmi_model in vm_model.vmi_models:
             self._database.vmis_to_update.append(vmi_model)
         self._database.save(vm_model)
 
-    def _create(self, vmware_vm, vm_properties):
-        vm_model = VirtualMachineModel(vmware_vm, vm_properties)
+    def _create(self, vm_record):
+        vm_model = VirtualMachineModel(vm_record)
         self._database.vmis_to_update += vm_model.vmi_models
-        self._add_property_filter_for_vm(vm_model, vmware_vm, VM_UPDATE_FILTERS)
-        self._update_in_vnc(vm_model.vnc_vm)
+        self._add_property_filter_for_vm(vm_model, vm_record.vmware_vm, VM_UPDATE_FILTERS)
+        record = self._database.get_snapshot_vm(vm_model.uuid)
+        if record is None or record['name'] != vm_model.name:
+            self._update_in_vnc(vm_model.vnc_vm)
         logger.info('Created %s', vm_model)
         self._database.save(vm_model)
+        return vm_model
 
     def _add_property_filter_for_vm(self, vm_model, vmware_vm, filters):
         property_filter = self._esxi_api_client.add_filter(vmware_vm, filters)
@@ -266,22 +397,109 @@ class VirtualMachineService(Service):
         vnc_vm.set_perms2(perms2)
 
     def get_vms_from_vmware(self):
-        vmware_vms = self._esxi_api_client.get_all_vms()
-        for vmware_vm in vmware_vms:
-            try:
-                self.update(vmware_vm)
-            except vmodl.fault.ManagedObjectNotFound:
-                logger.error('One VM was moved out of ESXi during CVM sync')
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during syncing VM', exc, exc_info=True)
+        inventory = self._esxi_api_client.read_vm_inventory()
+        self._verify_snapshot()
+        self._sync_executor.map(self._sync_vm, inventory, backend='vnc')
+
+    def _verify_snapshot(self):
+        """ Keeps only snapshot records of VMs and VMIs that still exist in VNC, so that no missing one is skipped. """
+        vm_uuids = self._database.get_snapshot_vm_uuids()
+        if not vm_uuids:
+            return
+        try:
+            vnc_vm_uuids = set(self._vnc_api_client.get_all_vm_uuids())
+            vnc_vmi_uuids = self._vnc_api_client.get_vmi_uuids_by_vm_uuids(
+                [vm_uuid for vm_uuid in vm_uuids if vm_uuid in vnc_vm_uuids])
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during verifying the snapshot, dropping it', exc, exc_info=True)
+            self._database.drop_snapshot()
+            return
+        self._database.verify_snapshot(vnc_vmi_uuids)
 
-    def delete_unused_vms_in_vnc(self):
+    def diff_vms_with_vmware(self):
+        """ Compares VM models with the current ESXi inventory; returns None when the result can't be trusted. """
+        if self._database.check_consistency():
+            return None
+        try:
+            inventory = self._esxi_api_client.read_vm_inventory()
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during reading VM inventory for resync', exc, exc_info=True)
+            return None
+
+        records = {}
+        for record in inventory:
+            if record.uuid is None or record.template or is_contrail_vm_name(record.name):
+                continue
+            records[record.uuid] = record
+
+        diff = InventoryDiff(added=[], changed=[], unchanged=[], vanished=[])
+        for vm_uuid, record in records.items():
+            vm_model = self._database.get_vm_model_by_uuid(vm_uuid)
+            if vm_model is None:
+                diff.added.append(record)
+            elif record.vm_properties != vm_model.vm_properties or record.port_signature != vm_model.port_signature:
+                diff.changed.append((vm_model, record))
+            else:
+                diff.unchanged.append((vm_model, record))
+        diff.vanished.extend(vm_model for vm_model in self._database.get_all_vm_models()
+                             if vm_model.uuid not in records)
+        logger.info('Resync diff: %d added, %d changed, %d unchanged, %d vanished VMs',
+                    len(diff.added), len(diff.changed), len(diff.unchanged), len(diff.vanished))
+        return diff
+
+    def resync_vms(self, diff):
+        """ Rebuilds only added and changed VMs; unchanged ones are just bound to the new ESXi session. """
+        for vm_model in self._database.get_all_vm_models():
+            # Property filters lived on the collector of the previous session
+            vm_model.property_filter = None
+        for vm_model, record in diff.unchanged:
+            vm_model.moref = record.moref
+            self._add_property_filter_for_vm(vm_model, record.vmware_vm, VM_UPDATE_FILTERS)
+        self._sync_executor.map(self._resync_vm, diff.changed, backend='vnc')
+        self._sync_executor.map(self._sync_vm, diff.added, backend='vnc')
+
+    def _resync_vm(self, changed_vm):
+        vm_model, record = changed_vm
+        try:
+            ports_changed = record.port_signature != vm_model.port_signature
+            logger.info('Resyncing %s', vm_model)
+            vm_model.update(record)
+            if ports_changed:
+                self._update_interfaces(vm_model, record)
+            else:
+                self._database.vmis_to_update.extend(vm_model.vmi_models)
+            self._add_property_filter_for_vm(vm_model, record.vmware_vm, VM_UPDATE_FILTERS)
+            self._database.save(vm_model)
+        except vmodl.fault.ManagedObjectNotFound:
+            logger.error('One VM was moved out of ESXi during CVM resync')
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during resyncing VM', exc, exc_info=True)
+
+    def _sync_vm(self, record):
+        try:
+            self.update_from_record(record)
+        except vmodl.fault.ManagedObjectNotFound:
+            logger.error('One VM was moved out of ESXi during CVM sync')
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during syncing VM', exc, exc_info=True)
+
+    def delete_unused_vms_in_vnc(self, vm_uuids=None):
+        if vm_uuids is not None and not vm_uuids:
+            return
         logger.info('Deleting stale information in VNC...')
         try:
             with self._vcenter_api_client:
                 vnc_vm_uuids = self._vnc_api_client.get_all_vm_uuids()
+                if vm_uuids is not None:
+                    vnc_vm_uuids = [uuid for uuid in vnc_vm_uuids if uuid in vm_uuids]
                 vcenter_vms = self._vcenter_api_client.get_all_vms()
 
                 vcenter_vm_uuids = set()
@@ -301,16 +519,18 @@ class VirtualMachineService(Service):
             logger.error('Unexpected exception %s during deleting unused VMs from VNC', exc, exc_info=True)
 
     def _delete_stale_vms_from_vnc(self, vms_to_remove):
-        for uuid in vms_to_remove:
-            try:
-                attached_vmis = self._vnc_api_client.get_vmi_uuids_by_vm_uuid(uuid)
-                self._database.ports_to_delete.extend(attached_vmis)
-                logger.info('Deleting stale VM from VNC - uuid: %s', uuid)
-                self._vnc_api_client.delete_vm(uuid=uuid)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during removing VM from VNC', exc, exc_info=True)
+        self._sync_executor.map(self._delete_stale_vm_from_vnc, vms_to_remove, backend='vnc')
+
+    def _delete_stale_vm_from_vnc(self, uuid):
+        try:
+            attached_vmis = self._vnc_api_client.get_vmi_uuids_by_vm_uuid(uuid)
+            self._database.ports_to_delete.extend(attached_vmis)
+            logger.info('Deleting stale VM from VNC - uuid: %s', uuid)
+            self._vnc_api_client.delete_vm(uuid=uuid)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during removing VM from VNC', exc, exc_info=True)
 
     def remove_vm(self, name):
         vm_model = self._database.get_vm_model_by_name(name)
@@ -346,9 +566,17 @@ class VirtualMachineService(Service):
         self._database.save(vm_model)
 
     def update_vm_models_interfaces(self, vmware_vm):
-        vm_model = self._database.get_vm_model_by_uuid(vmware_vm.config.instanceUuid)
+        vm_record = self._esxi_api_client.read_vm_record(vmware_vm)
+        if vm_record is None:
+            logger.error('VM: %s could not be read from ESXi', vmware_vm)
+            return None
+        vm_model = self._database.get_vm_model_by_uuid(vm_record.uuid)
+        self._update_interfaces(vm_model, vm_record)
+        return vm_model
+
+    def _update_interfaces(self, vm_model, vm_record):
         old_vmi_models = {vmi_model.uuid: vmi_model for vmi_model in vm_model.vmi_models}
-        vm_model.update_interfaces(vmware_vm)
+        vm_model.update_interfaces(vm_record)
         new_vmi_models = {vmi_model.uuid: vmi_model for vmi_model in vm_model.vmi_models}
 
         for uuid, new_vmi_model in list(new_vmi_models.items()):
@@ -368,35 +596,51 @@ class VirtualMachineService(Service):
                 self._database.ports_to_update.append(vmi_model)
                 self._database.vlans_to_update.append(vmi_model)
             self._database.save(vm_model)
+        return vm_model
 
 
 def is_contrail_vm_name(name):
     return CONTRAIL_VM_NAME in name
 
 
+def is_vmi_unchanged_since(record, vmi_model):
+    return (record is not None and
+            record['display_name'] == vmi_model.display_name and
+            record['vm_uuid'] == vmi_model.vm_model.uuid and
+            vmi_model.vn_model is not None and record['vn_uuid'] == vmi_model.vn_model.uuid and
+            record['port_key'] == vmi_model.vcenter_port.port_key)
+
+
 class VirtualNetworkService(Service):
-    def update_vns(self):
-        for vmi_model in list(self._database.vmis_to_update):
-            try:
-                portgroup_key = vmi_model.vcenter_port.portgroup_key
-                if self._database.get_vn_model_by_key(portgroup_key) is not None:
-                    continue
-                logger.info('Fetching new portgroup for key: %s', portgroup_key)
-                with self._vcenter_api_client:
-                    dpg = self._vcenter_api_client.get_dpg_by_key(portgroup_key)
-                    fq_name = [VNC_ROOT_DOMAIN, VNC_VCENTER_PROJECT, dpg.name]
-                    vnc_vn = self._vnc_api_client.read_vn(fq_name)
-                    if dpg and vnc_vn:
-                        self._create_vn_model(dpg, vnc_vn)
-                    else:
-                        logger.error('Unable to fetch new portgroup for key: %s', portgroup_key)
-                        self._database.vmis_to_update.remove(vmi_model)
+    def update_vns(self, vm_uuids=None):
+        vmi_models_by_portgroup_key = collections.OrderedDict()
+        for vmi_model in self._database.vmis_to_update.select(vm_uuids):
+            portgroup_key = vmi_model.vcenter_port.portgroup_key
+            if portgroup_key in vmi_models_by_portgroup_key or \
+                    self._database.get_vn_model_by_key(portgroup_key) is None:
+                vmi_models_by_portgroup_key.setdefault(portgroup_key, []).append(vmi_model)
+        self._sync_executor.map(self._update_vn, list(vmi_models_by_portgroup_key.items()), backend='vcenter')
+
+    def _update_vn(self, portgroup):
+        portgroup_key, vmi_models = portgroup
+        try:
+            logger.info('Fetching new portgroup for key: %s', portgroup_key)
+            with self._vcenter_api_client:
+                dpg = self._vcenter_api_client.get_dpg_by_key(portgroup_key)
+                fq_name = [VNC_ROOT_DOMAIN, VNC_VCENTER_PROJECT, dpg.name]
+                vnc_vn = self._vnc_api_client.read_vn(fq_name)
+                if dpg and vnc_vn:
+                    self._create_vn_model(dpg, vnc_vn)
+                else:
+                    logger.error('Unable to fetch new portgroup for key: %s', portgroup_key)
+                    for vmi_model in vmi_models:
+                        self._database.vmis_to_update.discard(vmi_model)
                         self._database.vmis_to_delete.append(vmi_model)
                         vmi_model.remove_from_vm_model()
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during updating VN Model', exc, exc_info=True)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during updating VN Model', exc, exc_info=True)
 
     def _create_vn_model(self, dpg, vnc_vn):
         logger.info('Fetched new portgroup key: %s name: %s', dpg.key, vnc_vn.name)
@@ -407,60 +651,133 @@ class VirtualNetworkService(Service):
 
 
 class VRouterPortService(Service):
-    def sync_ports(self):
-        self._delete_ports()
-        self._update_ports()
-        self.sync_port_states()
-
-    def sync_port_states(self):
-        ports = list(self._database.ports_to_update)
-        for vmi_model in ports:
-            try:
-                self._set_port_state(vmi_model)
-                self._database.ports_to_update.remove(vmi_model)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during syncing vRouter port', exc, exc_info=True)
+    def __init__(self, *args, **kwargs):
+        super(VRouterPortService, self).__init__(*args, **kwargs)
+        # Ports reconciled so far, by PORT_CHANGE_* class; None counts ports that were already up to date
+        self.port_change_counts = collections.Counter()
+
+    def sync_ports(self, vm_uuids=None):
+        with self._database.ports_to_delete.claim(vm_uuids) as port_uuids:
+            self._sync_executor.map(self._delete_pending_port, port_uuids, backend='vrouter')
+        with self._database.ports_to_update.claim(vm_uuids) as vmi_models:
+            self._update_ports(vmi_models)
+            # Ports of powered off VMs are created disabled and no longer pending
+            self._sync_port_states([vmi_model for vmi_model in vmi_models
+                                    if vmi_model in self._database.ports_to_update])
+
+    def sync_port_states(self, vm_uuids=None):
+        with self._database.ports_to_update.claim(vm_uuids) as vmi_models:
+            self._sync_port_states(vmi_models)
+
+    def _sync_port_states(self, vmi_models):
+        self._sync_executor.map(self._sync_port_state, vmi_models, backend='vrouter')
+
+    def _sync_port_state(self, vmi_model):
+        try:
+            self._set_port_state(vmi_model)
+            self._database.ports_to_update.discard(vmi_model)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during syncing vRouter port', exc, exc_info=True)
 
-    def _delete_ports(self):
-        uuids = list(self._database.ports_to_delete)
-        for uuid in uuids:
-            try:
-                self._delete_port(uuid)
-                self._database.ports_to_delete.remove(uuid)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during deleting vRouter port', exc, exc_info=True)
+    def _delete_pending_port(self, uuid):
+        try:
+            self._delete_port(uuid)
+            self._database.ports_to_delete.discard(uuid)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during deleting vRouter port', exc, exc_info=True)
 
     def _delete_port(self, uuid):
         self._vrouter_api_client.delete_port(uuid)
 
-    def _update_ports(self):
-        ports = list(self._database.ports_to_update)
-        for vmi_model in ports:
-            try:
-                vrouter_port = self._vrouter_api_client.read_port(vmi_model.uuid)
-                if not vrouter_port:
-                    self._create_port(vmi_model)
-                    continue
-                if self._port_needs_an_update(vrouter_port, vmi_model):
-                    self._update_port(vmi_model)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during updating vRouter port', exc, vmi_model.uuid, exc_info=True)
+    def _update_ports(self, vmi_models):
+        port_state_cache = self._vrouter_api_client.port_state_cache
+        generation = port_state_cache.generation
+        vrouter_ports = self._read_cached_ports(vmi_models)
+        uncached_vmi_models = [vmi_model for vmi_model in vmi_models if vmi_model.uuid not in vrouter_ports]
+        if len(uncached_vmi_models) > 1:
+            # One listing is cheaper than a read per port; missing entries are simply ports to create
+            all_vrouter_ports = self._vrouter_api_client.read_all_ports()
+            if port_state_cache.generation != generation:
+                # The listing showed the agent restarted, so the cached ports can't be trusted either
+                vrouter_ports, uncached_vmi_models = {}, vmi_models
+            if all_vrouter_ports is not None:
+                for vmi_model in uncached_vmi_models:
+                    vrouter_ports[vmi_model.uuid] = self._verify_port(vmi_model, all_vrouter_ports.get(vmi_model.uuid))
+        # Compare desired and actual state of all pending ports first, then apply the differences
+        port_changes = []
+        plan_port_change = functools.partial(self._plan_port_change, port_changes=port_changes,
+                                             vrouter_ports=vrouter_ports)
+        self._sync_executor.map(plan_port_change, vmi_models, backend='vrouter')
+        self._sync_executor.map(self._apply_port_change, port_changes, backend='vrouter')
+        self._report_port_changes(port_changes)
+
+    def _read_cached_ports(self, vmi_models):
+        """ Returns {uuid: port state} of vmi_models whose ports this process pushed or verified recently. """
+        vrouter_ports = {}
+        for vmi_model in vmi_models:
+            vrouter_port = self._vrouter_api_client.port_state_cache.get(vmi_model.uuid)
+            if vrouter_port is not None:
+                vrouter_ports[vmi_model.uuid] = vrouter_port
+        return vrouter_ports
+
+    def _verify_port(self, vmi_model, vrouter_port):
+        # What the agent reported is trusted until the next verification, like what was pushed to it
+        if vrouter_port:
+            self._vrouter_api_client.port_state_cache.record(vmi_model.uuid, vrouter_port)
+        return vrouter_port
+
+    def _plan_port_change(self, vmi_model, port_changes, vrouter_ports):
+        try:
+            if vmi_model.uuid in vrouter_ports:
+                vrouter_port = vrouter_ports[vmi_model.uuid]
+            else:
+                vrouter_port = self._verify_port(vmi_model, self._vrouter_api_client.read_port(vmi_model.uuid))
+            port_changes.append((vmi_model, self._classify_port_change(vrouter_port, vmi_model)))
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during reading vRouter port %s', exc, vmi_model.uuid, exc_info=True)
+
+    def _apply_port_change(self, port_change):
+        vmi_model, change = port_change
+        try:
+            if change == PORT_CHANGE_CREATE:
+                self._create_port(vmi_model)
+            elif change == PORT_CHANGE_IDENTITY:
+                self._recreate_port(vmi_model)
+            elif change is not None:
+                self._patch_port(vmi_model)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during updating vRouter port %s', exc, vmi_model.uuid, exc_info=True)
+
+    def _report_port_changes(self, port_changes):
+        changes = collections.Counter(change for _, change in port_changes)
+        self.port_change_counts.update(changes)
+        if port_changes:
+            logger.info('Reconciled %d vRouter ports: %d created, %d re-created, %d patched, %d unchanged',
+                        len(port_changes), changes[PORT_CHANGE_CREATE], changes[PORT_CHANGE_IDENTITY],
+                        changes[PORT_CHANGE_IP] + changes[PORT_CHANGE_VLAN] + changes[PORT_CHANGE_IP_AND_VLAN],
+                        changes[None])
 
     def _create_port(self, vmi_model):
         self._vrouter_api_client.add_port(vmi_model)
         if not vmi_model.vm_model.is_powered_on:
-            self._database.ports_to_update.remove(vmi_model)
+            self._database.ports_to_update.discard(vmi_model)
 
-    def _update_port(self, vmi_model):
+    def _recreate_port(self, vmi_model):
         self._vrouter_api_client.delete_port(vmi_model.uuid)
         self._vrouter_api_client.add_port(vmi_model)
 
+    def _patch_port(self, vmi_model):
+        # Adding a port the agent already has updates it in place, without tearing the interface down
+        self._vrouter_api_client.add_port(vmi_model)
+
     def _set_port_state(self, vmi_model):
         if vmi_model.vm_model.is_powered_on:
             self._vrouter_api_client.enable_port(vmi_model.uuid)
@@ -468,151 +785,280 @@ class VRouterPortService(Service):
             self._vrouter_api_client.disable_port(vmi_model.uuid)
 
     @staticmethod
-    def _port_needs_an_update(vrouter_port, vmi_model):
-        return (vrouter_port.get('instance-id') != vmi_model.vm_model.uuid or
-                vrouter_port.get('vn-id') != vmi_model.vn_model.uuid or
-                vrouter_port.get('rx-vlan-id') != vmi_model.vcenter_port.vlan_id or
-                vrouter_port.get('tx-vlan-id') != vmi_model.vcenter_port.vlan_id or
-                vrouter_port.get('ip-address') != vmi_model.vnc_instance_ip.instance_ip_address)
+    def _classify_port_change(vrouter_port, vmi_model):
+        """ Returns the PORT_CHANGE_* class of the difference between vrouter_port and vmi_model, or None. """
+        if not vrouter_port:
+            return PORT_CHANGE_CREATE
+        if (vrouter_port.get('instance-id') != vmi_model.vm_model.uuid or
+                vrouter_port.get('vn-id') != vmi_model.vn_model.uuid):
+            return PORT_CHANGE_IDENTITY
+        vlan_changed = (vrouter_port.get('rx-vlan-id') != vmi_model.vcenter_port.vlan_id or
+                        vrouter_port.get('tx-vlan-id') != vmi_model.vcenter_port.vlan_id)
+        ip_changed = vrouter_port.get('ip-address') != vmi_model.vnc_instance_ip.instance_ip_address
+        if ip_changed and vlan_changed:
+            return PORT_CHANGE_IP_AND_VLAN
+        if ip_changed:
+            return PORT_CHANGE_IP
+        if vlan_changed:
+            return PORT_CHANGE_VLAN
+        return None
 
     def delete_stale_vrouter_ports(self):
         logger.info('Deleting stale vRouter ports...')
         try:
             port_uuids = self._vrouter_api_client.get_all_port_uuids()
-            for port_uuid in port_uuids:
-                if self._database.get_vmi_model_by_uuid(port_uuid) is None:
-                    logger.info('Deleting stale vRouter port: %s', port_uuid)
-                    self._vrouter_api_client.delete_port(port_uuid)
+            stale_port_uuids = set(port_uuids).difference(self._database.vmi_models)
+            self._sync_executor.map(self._delete_stale_port, stale_port_uuids, backend='vrouter')
         except exceptions.CVMError:
             raise
         except Exception as exc:
             logger.error('Unexpected exception %s during deleting stale vRouter ports', exc, exc_info=True)
 
+    def _delete_stale_port(self, port_uuid):
+        logger.info('Deleting stale vRouter port: %s', port_uuid)
+        self._vrouter_api_client.delete_port(port_uuid)
+
+    def restore_ports(self, port_uuids):
+        """ Re-adds ports of known VMIs whose port files were removed behind the manager's back. """
+        vm_uuids = set()
+        for port_uuid in port_uuids:
+            vmi_model = self._database.get_vmi_model_by_uuid(port_uuid)
+            if vmi_model is None or port_uuid in self._database.ports_to_delete:
+                continue
+            if self._vrouter_api_client.port_file_exists(port_uuid):
+                # Re-created in the meantime, e.g. by _recreate_port
+                continue
+            self._vrouter_api_client.port_state_cache.forget(port_uuid)
+            logger.info('vRouter port file of %s was removed, restoring the port', vmi_model)
+            self._database.ports_to_update.add(vmi_model)
+            vm_uuids.add(get_work_owner(vmi_model))
+        if vm_uuids:
+            self.sync_ports(vm_uuids)
+
 
 class VlanIdService(Service):
-    def update_vlan_ids(self):
-        for vmi_model in list(self._database.vlans_to_update):
+    def __init__(self, *args, **kwargs):
+        super(VlanIdService, self).__init__(*args, **kwargs)
+        self._worker_pool = None
+
+    def defer_vcenter_updates(self, worker_pool):
+        """ Hands vCenter VLAN programming over to worker_pool instead of doing it inline. """
+        self._worker_pool = worker_pool
+
+    def update_vlan_ids(self, vm_uuids=None):
+        with self._database.vlans_to_update.claim(vm_uuids) as vmi_models:
+            self._update_vlan_ids(vmi_models)
+        with self._database.vlans_to_restore.claim(vm_uuids) as vmi_models:
+            self._restore_vlan_ids(vmi_models)
+
+    def _update_vlan_ids(self, vmi_models):
+        if not vmi_models:
+            return
+        try:
+            with self._vcenter_api_client:
+                current_vlan_ids = self._vcenter_api_client.get_vlan_ids(
+                    [vmi_model.vcenter_port for vmi_model in vmi_models])
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during reading vCenter VLANs', exc, exc_info=True)
+            return
+
+        updated_vmi_models = []
+        vmi_models_to_set = []
+        for vmi_model in vmi_models:
             try:
                 logger.info('Updating %s', vmi_model)
-                self._update_vlan_id(vmi_model)
-                self._database.vlans_to_update.remove(vmi_model)
-                logger.info('Updated %s', vmi_model)
+                port_key = vmi_model.vcenter_port.port_key
+                if port_key not in current_vlan_ids:
+                    logger.error('Port %s of %s not found in vCenter', port_key, vmi_model)
+                    continue
+                current_vlan_id = current_vlan_ids[port_key]
+                if current_vlan_id and self._database.is_vlan_available(vmi_model, current_vlan_id):
+                    self._preserve_old_vlan_id(current_vlan_id, vmi_model)
+                else:
+                    self._database.set_vlan_id(vmi_model, self._vlan_id_pool.get_available())
+                    vmi_models_to_set.append(vmi_model)
+                updated_vmi_models.append(vmi_model)
             except exceptions.CVMError:
                 raise
             except Exception as exc:
                 logger.error('Unexpected exception %s during updating vCenter VLAN', exc, exc_info=True)
 
-        for vmi_model in list(self._database.vlans_to_restore):
-            try:
-                self._restore_vlan_id(vmi_model)
-                self._database.vlans_to_restore.remove(vmi_model)
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception %s during restoring vCenter VLAN', exc, exc_info=True)
-
-    def _update_vlan_id(self, vmi_model):
-        with self._vcenter_api_client:
-            current_vlan_id = self._vcenter_api_client.get_vlan_id(vmi_model.vcenter_port)
-            if current_vlan_id:
-                self._preserve_old_vlan_id(current_vlan_id, vmi_model)
-            else:
-                self._assign_new_vlan_id(vmi_model)
+        self._update_vcenter_vlans(vmi_models_to_set)
+        for vmi_model in updated_vmi_models:
+            self._database.vlans_to_update.discard(vmi_model)
+            logger.info('Updated %s', vmi_model)
 
     def _preserve_old_vlan_id(self, current_vlan_id, vmi_model):
-        if self._database.is_vlan_available(vmi_model, current_vlan_id):
-            vmi_model.vcenter_port.vlan_id = current_vlan_id
-            vmi_model.vcenter_port.vlan_success = True
-            self._vlan_id_pool.reserve(current_vlan_id)
-        else:
-            self._assign_new_vlan_id(vmi_model)
-
-    def _assign_new_vlan_id(self, vmi_model):
-        vmi_model.vcenter_port.vlan_id = self._vlan_id_pool.get_available()
-        self._update_vcenter_vlan(vmi_model)
+        self._database.set_vlan_id(vmi_model, current_vlan_id)
+        vmi_model.vcenter_port.vlan_success = True
+        self._vlan_id_pool.reserve(current_vlan_id)
 
-    def _restore_vlan_id(self, vmi_model):
-        self._restore_vcenter_vlan_id(vmi_model)
-        self._vlan_id_pool.free(vmi_model.vcenter_port.vlan_id)
+    def _restore_vlan_ids(self, vmi_models):
+        if not vmi_models:
+            return
+        if self._worker_pool is not None:
+            for vmi_model in vmi_models:
+                self._database.vlans_to_restore.discard(vmi_model)
+            self._worker_pool.submit_restore(vmi_models)
+            return
+        try:
+            failed_vmi_models = self.restore_vcenter_vlans(vmi_models)
+        except exceptions.CVMError:
+            raise
+        except Exception as exc:
+            logger.error('Unexpected exception %s during restoring vCenter VLAN', exc, exc_info=True)
+            return
+        for vmi_model in vmi_models:
+            if vmi_model not in failed_vmi_models:
+                self._database.vlans_to_restore.discard(vmi_model)
 
-    def _restore_vcenter_vlan_id(self, vmi_model):
+    def restore_vcenter_vlans(self, vmi_models):
+        """ Restores inherited VLANs of the ports in vCenter; returns VMI models whose VLAN IDs are still in use. """
         with self._vcenter_api_client:
-            self._vcenter_api_client.restore_vlan_id(vmi_model.vcenter_port)
+            results = self._vcenter_api_client.restore_vlan_ids([vmi_model.vcenter_port for vmi_model in vmi_models])
+        failed_vmi_models = []
+        for vmi_model in vmi_models:
+            state, error_msg = results.get(vmi_model.vcenter_port.port_key, (None, None))
+            if state != 'success':
+                # The port may still carry the VLAN ID, so it can't be handed out again yet
+                logger.error('Restoring VLAN ID for %s failed: %s', vmi_model, error_msg)
+                failed_vmi_models.append(vmi_model)
+                continue
+            try:
+                self._database.release_vlan_id(vmi_model)
+                self._vlan_id_pool.free(vmi_model.vcenter_port.vlan_id)
+            except exceptions.CVMError:
+                raise
+            except Exception as exc:
+                logger.error('Unexpected exception %s during restoring vCenter VLAN', exc, exc_info=True)
+        return failed_vmi_models
 
-    def update_vcenter_vlans(self):
-        for vmi_model in list(self._database.vlans_to_update):
-            self._update_vcenter_vlan(vmi_model)
-            self._database.vlans_to_update.remove(vmi_model)
+    def update_vcenter_vlans(self, vm_uuids=None):
+        with self._database.vlans_to_update.claim(vm_uuids) as vmi_models:
+            self._update_vcenter_vlans(vmi_models)
+            for vmi_model in vmi_models:
+                self._database.vlans_to_update.discard(vmi_model)
 
-    def _update_vcenter_vlan(self, vmi_model):
-        if vmi_model.vcenter_port.vlan_success:
-            logger.info('VLAN ID is already set with success')
-            return
-        if not vmi_model.vm_model.is_powered_on:
-            logger.info('Unable to set VLAN ID for powered off VM')
+    def _update_vcenter_vlans(self, vmi_models):
+        pending = [vmi_model for vmi_model in vmi_models if self._needs_vcenter_vlan_update(vmi_model)]
+        if self._worker_pool is not None:
+            self._worker_pool.submit_update(pending)
             return
         for i in range(SET_VLAN_ID_RETRY_LIMIT):
+            if not pending:
+                return
             if i != 0:
-                logger.error('Task failed to complete, retrying...')
-            try:
-                with self._vcenter_api_client:
-                    logger.info('Updating VLAN ID of %s in vCenter', vmi_model.display_name)
-                    if self._wait_for_device_connected(vmi_model) and self._wait_for_proxy_host(vmi_model):
-                        state, error_msg = self._vcenter_api_client.set_vlan_id(vmi_model.vcenter_port)
-                        if state == 'success':
-                            vmi_model.vcenter_port.vlan_success = True
-                            return
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception: %s during setting VLAN ID for %s', exc, vmi_model, exc_info=exc)
-        logger.error('Unable to finish the task.')
-
-    @classmethod
-    def _wait_for_device_connected(cls, vmi_model):
-        port_key = vmi_model.vcenter_port.port_key
-        vm_name = vmi_model.vm_model.name
-        logger.info('Waiting for VM %s interface connected to port %s...', vm_name, port_key)
-        for _ in range(WAIT_FOR_PORT_RETRY_LIMIT):
+                logger.error('Task failed to complete for %d interfaces, retrying...', len(pending))
             try:
-                device = next(device for device
-                              in vmi_model.vm_model.vmware_vm.config.hardware.device
-                              if device.key == vmi_model.vcenter_port.device.key)
-                if device.connectable.connected:
-                    logger.info('VM %s interface is connected to port %s.', vm_name, port_key)
-                    return True
-            except StopIteration:
-                logger.error('For VM %s did not detect such interface', vm_name)
-                return False
+                pending = self.set_vcenter_vlans(pending)
             except exceptions.CVMError:
                 raise
             except Exception as exc:
-                logger.error('Unexpected exception: %s during waiting for VM %s interface connected to port %s',
-                             exc, vm_name, port_key, exc_info=exc)
-            logger.info('VM %s interface still is not connected to port %s.', vm_name, port_key)
-            time.sleep(WAIT_FOR_PORT_RETRY_TIME)
-        logger.info('Waiting for VM %s interface to be connected to port %s timed out', vm_name, port_key)
-        return False
-
-    def _wait_for_proxy_host(self, vmi_model):
-        port_key = vmi_model.vcenter_port.port_key
-        logger.info('Waiting for port %s proxyHost...', port_key)
-        for _ in range(WAIT_FOR_PORT_RETRY_LIMIT):
-            try:
-                dv_port = self._vcenter_api_client.fetch_port_from_dvs(port_key)
-                port_host_uuid = dv_port.proxyHost.hardware.systemInfo.uuid
-                if port_host_uuid == self._esxi_api_client.read_host_uuid():
-                    logger.info('proxyHost %s for port %s is ready.', dv_port.proxyHost.name, port_key)
-                    return True
-            except exceptions.CVMError:
-                raise
-            except Exception as exc:
-                logger.error('Unexpected exception: %s during waiting for port %s proxyHost',
-                             exc, port_key, exc_info=exc)
-            proxy_host_name = None
-            if dv_port.proxyHost is not None:
-                proxy_host_name = dv_port.proxyHost.name
-            logger.info('proxyHost for port %s still is not ready. Still refers to %s', port_key, proxy_host_name)
-            time.sleep(WAIT_FOR_PORT_RETRY_TIME)
-        logger.error('Waiting for proxyHost for port %s timed out', port_key)
-        return False
+                logger.error('Unexpected exception: %s during setting VLAN IDs', exc, exc_info=exc)
+        for vmi_model in pending:
+            logger.error('Unable to finish the task for %s.', vmi_model)
+
+    def set_vcenter_vlans(self, vmi_models):
+        """ Makes one attempt to program VLAN IDs in vCenter; returns VMI models that still need it. """
+        pending = [vmi_model for vmi_model in vmi_models if self._needs_vcenter_vlan_update(vmi_model)]
+        if not pending:
+            return []
+        with self._vcenter_api_client:
+            ready = self._wait_for_ports_ready(pending)
+            logger.info('Updating VLAN IDs of %s in vCenter',
+                        ', '.join(vmi_model.display_name for vmi_model in ready))
+            results = self._vcenter_api_client.set_vlan_ids(
+                [vmi_model.vcenter_port for vmi_model in ready]) if ready else {}
+        for vmi_model in ready:
+            state, error_msg = results.get(vmi_model.vcenter_port.port_key, (None, None))
+            if state == 'success':
+                vmi_model.vcenter_port.vlan_success = True
+            else:
+                logger.error('Setting VLAN ID for %s failed: %s', vmi_model, error_msg)
+        return [vmi_model for vmi_model in pending if not vmi_model.vcenter_port.vlan_success]
+
+    @staticmethod
+    def _needs_vcenter_vlan_update(vmi_model):
+        if vmi_model.vcenter_port.vlan_success:
+            logger.info('VLAN ID is already set with success')
+            return False
+        if not vmi_model.vm_model.is_powered_on:
+            logger.info('Unable to set VLAN ID for powered off VM')
+            return False
+        return True
+
+    def _wait_for_ports_ready(self, vmi_models):
+        """ Waits until interfaces are connected and their ports are bound to this host; returns the ready ones. """
+        logger.info('Waiting for interfaces of %s to be connected...',
+                    ', '.join(vmi_model.display_name for vmi_model in vmi_models))
+        deadline = time.time() + WAIT_FOR_PORT_TIMEOUT
+        waiting = list(vmi_models)
+        connected = set()
+        ready = []
+        host_uuid = self._esxi_api_client.read_host_uuid()
+        vm_morefs = []
+        for vmi_model in vmi_models:
+            if vmi_model.vm_model.moref not in vm_morefs:
+                vm_morefs.append(vmi_model.vm_model.moref)
+        watcher = self._esxi_api_client.create_property_watcher(vm_morefs, ['config.hardware.device'])
+        try:
+            timeout = 0
+            while waiting:
+                for vm_moref, changes in watcher.wait(timeout):
+                    if 'config.hardware.device' not in changes:
+                        continue
+                    devices = changes['config.hardware.device'] or []
+                    for vmi_model in [vmi_model for vmi_model in waiting if vmi_model.vm_model.moref == vm_moref]:
+                        if self._check_device_connected(vmi_model, devices, connected):
+                            continue
+                        logger.error('For VM %s did not detect such interface', vmi_model.vm_model.name)
+                        waiting.remove(vmi_model)
+
+                bound = [vmi_model for vmi_model in waiting if vmi_model.uuid in connected]
+                if bound:
+                    proxy_host_uuids = self._vcenter_api_client.get_proxy_host_uuids(
+                        [vmi_model.vcenter_port.port_key for vmi_model in bound])
+                    for vmi_model in bound:
+                        if proxy_host_uuids.get(vmi_model.vcenter_port.port_key) == host_uuid:
+                            logger.info('proxyHost for port %s is ready.', vmi_model.vcenter_port.port_key)
+                            waiting.remove(vmi_model)
+                            ready.append(vmi_model)
+
+                remaining = deadline - time.time()
+                if not waiting or remaining <= 0:
+                    break
+                # Only device connections are watched. proxyHost is not a managed object property, and runtime.host
+                # of a VM seen through ESXi is always this host, so connected ports are polled until vCenter binds them
+                if any(vmi_model.uuid in connected for vmi_model in waiting):
+                    timeout = min(remaining, WAIT_FOR_PORT_RETRY_TIME)
+                else:
+                    timeout = remaining
+        finally:
+            watcher.destroy()
+
+        for vmi_model in waiting:
+            if vmi_model.uuid in connected:
+                logger.error('Waiting for proxyHost for port %s of %s timed out',
+                             vmi_model.vcenter_port.port_key, vmi_model)
+            else:
+                logger.error('Waiting for VM %s interface to be connected to port %s timed out',
+                             vmi_model.vm_model.name, vmi_model.vcenter_port.port_key)
+        return ready
+
+    @staticmethod
+    def _check_device_connected(vmi_model, devices, connected):
+        """ Updates connected with the VMI's state; returns False when the VM has no such device. """
+        device_key = vmi_model.vcenter_port.device_key
+        try:
+            device = next(device for device in devices if device.key == device_key)
+        except StopIteration:
+            return False
+        if device.connectable.connected:
+            logger.info('VM %s interface is connected to port %s.',
+                        vmi_model.vm_model.name, vmi_model.vcenter_port.port_key)
+            connected.add(vmi_model.uuid)
+        else:
+            connected.discard(vmi_model.uuid)
+        return True
@@ -1,11 +1,12 @@
 # pylint: disable=redefined-outer-name
 import pytest
+from cvm.clients import PortStateCache
 from cvm.constants import ID_PERMS
-from cvm.controllers import (GuestNetHandler, PowerStateHandler, UpdateHandler,
-                             VmReconfiguredHandler, VmRegisteredHandler,
-                             VmRemovedHandler, VmRenamedHandler,
-                             VmUpdatedHandler, VmwareController,
-                             VmwareToolsStatusHandler)
+from cvm.controllers import (GuestNetHandler, PowerStateHandler, SharedLock,
+                             UpdateHandler, VmReconfiguredHandler,
+                             VmRegisteredHandler, VmRemovedHandler,
+                             VmRenamedHandler, VmUpdatedHandler,
+                             VmwareController, VmwareToolsStatusHandler)
 from cvm.database import Database
 from cvm.models import (VirtualMachineInterfaceModel, VirtualMachineModel,
                         VirtualNetworkModel, VlanIdPool)
@@ -15,7 +16,7 @@ from cvm.services import (VirtualMachineInterfaceService,
                           VlanIdService, VRouterPortService)
 from mock import Mock
 from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
-from tests.utils import assign_ip_to_instance_ip, wrap_into_update_set
+from tests.utils import assign_ip_to_instance_ip, create_vm_record, wrap_into_update_set
 from vnc_api import vnc_api
 
 
@@ -136,7 +137,7 @@ def portgroup():
 @pytest.fixture()
 def vmware_vm_1(host_1):
     vmware_vm = Mock(spec=vim.VirtualMachine)
-    vmware_vm.configure_mock(name='VM1')
+    vmware_vm.configure_mock(_moId='vm-1', name='VM1')
     vmware_vm.summary.runtime.host = host_1
     vmware_vm.config.instanceUuid = 'vmware-vm-uuid-1'
     backing = Mock(spec=vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo)
@@ -148,7 +149,7 @@ def vmware_vm_1(host_1):
 @pytest.fixture()
 def vmware_vm_1_updated(host_1):
     vmware_vm = Mock(spec=vim.VirtualMachine)
-    vmware_vm.configure_mock(name='VM1')
+    vmware_vm.configure_mock(_moId='vm-1', name='VM1')
     vmware_vm.summary.runtime.host = host_1
     vmware_vm.config.instanceUuid = 'vmware-vm-uuid-1'
     backing = Mock(spec=vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo)
@@ -160,7 +161,7 @@ def vmware_vm_1_updated(host_1):
 @pytest.fixture()
 def vmware_vm_2(host_1):
     vmware_vm = Mock(spec=vim.VirtualMachine)
-    vmware_vm.configure_mock(name='VM2')
+    vmware_vm.configure_mock(_moId='vm-2', name='VM2')
     vmware_vm.summary.runtime.host = host_1
     vmware_vm.config.instanceUuid = 'vmware-vm-uuid-2'
     backing = Mock(spec=vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo)
@@ -172,7 +173,7 @@ def vmware_vm_2(host_1):
 @pytest.fixture()
 def vmware_vm_no_uuid(host_1):
     vmware_vm = Mock(spec=vim.VirtualMachine)
-    vmware_vm.configure_mock(name='VM1')
+    vmware_vm.configure_mock(_moId='vm-3', name='VM1')
     vmware_vm.summary.runtime.host = host_1
     vmware_vm.config = None
     return vmware_vm
@@ -251,14 +252,14 @@ def contrail_vm_properties(host_1):
 
 @pytest.fixture()
 def vm_model(vmware_vm_1, vm_properties_1):
-    model = VirtualMachineModel(vmware_vm_1, vm_properties_1)
+    model = VirtualMachineModel(create_vm_record(vmware_vm_1, vm_properties_1))
     model.property_filter = Mock()
     return model
 
 
 @pytest.fixture()
 def vm_model_2(vmware_vm_2, vm_properties_2):
-    model = VirtualMachineModel(vmware_vm_2, vm_properties_2)
+    model = VirtualMachineModel(create_vm_record(vmware_vm_2, vm_properties_2))
     model.property_filter = Mock()
     return model
 
@@ -362,6 +363,7 @@ def vnc_api_client(project, security_group):
     vnc_client.create_and_read_instance_ip.side_effect = assign_ip_to_instance_ip
     vnc_client.read_vmi.return_value = None
     vnc_client.get_vmi_uuids_by_vm_uuid.return_value = []
+    vnc_client.get_vmi_uuids_by_vm_uuids.return_value = {}
     return vnc_client
 
 
@@ -372,23 +374,30 @@ def vcenter_api_client():
     vcenter_client.__exit__ = Mock()
     vcenter_client.get_ip_pool_for_dpg.return_value = None
     vcenter_client.set_vlan_id.return_value = 'success', 'success message'
+    vcenter_client.restore_vlan_id.return_value = 'success', 'success message'
+    vcenter_client.get_vlan_ids.side_effect = lambda ports: {
+        port.port_key: vcenter_client.get_vlan_id(port) for port in ports
+    }
+    vcenter_client.set_vlan_ids.side_effect = lambda ports: {
+        port.port_key: vcenter_client.set_vlan_id(port) for port in ports
+    }
+    vcenter_client.restore_vlan_ids.side_effect = lambda ports: {
+        port.port_key: vcenter_client.restore_vlan_id(port) for port in ports
+    }
     return vcenter_client
 
 
 @pytest.fixture()
-def esxi_api_client(vm_properties_1):
+def esxi_api_client(vmware_vm_1, vm_properties_1):
     esxi_client = Mock()
     esxi_client.read_vrouter_uuid.return_value = 'vrouter-uuid-1'
-    esxi_client.read_vm_properties.return_value = vm_properties_1
+    esxi_client.read_vm_record.return_value = create_vm_record(vmware_vm_1, vm_properties_1)
     return esxi_client
 
 
 @pytest.fixture()
 def lock():
-    semaphore = Mock()
-    semaphore.__enter__ = Mock()
-    semaphore.__exit__ = Mock()
-    return semaphore
+    return SharedLock()
 
 
 @pytest.fixture()
@@ -482,8 +491,7 @@ def vrouter_port_service(service_kwargs):
 @pytest.fixture()
 def vlan_id_service(service_kwargs):
     vlan_id_service = VlanIdService(**service_kwargs)
-    vlan_id_service._wait_for_proxy_host = Mock(return_value=True)
-    vlan_id_service._wait_for_device_connected = Mock(return_value=True)
+    vlan_id_service._wait_for_ports_ready = Mock(side_effect=lambda vmi_models: vmi_models)
     return vlan_id_service
 
 
@@ -496,6 +504,9 @@ def database():
 def vrouter_api_client():
     client = Mock()
     client.read_port.return_value = None
+    client.read_all_ports.return_value = None
+    # Nothing is trusted without verification, so every port is read from the agent
+    client.port_state_cache = PortStateCache(verify_interval=0)
     return client
 
 
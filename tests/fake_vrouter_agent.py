@@ -0,0 +1,94 @@
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class _AgentServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _AgentHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive, like the real agent
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment, otherwise delayed ACKs stall every keep-alive response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.agent.connections += 1
+
+    def do_GET(self):
+        agent = self.server.agent
+        agent.requests += 1
+        if agent.delay:
+            time.sleep(agent.delay)
+        parts = self.path.strip('/').split('/')
+        if parts == ['port'] and agent.list_ports:
+            self._respond(200, list(agent.ports.values()))
+        elif len(parts) == 2 and parts[0] == 'port' and parts[1] in agent.ports:
+            self._respond(200, agent.ports[parts[1]])
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def _respond(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeVRouterAgent(object):
+    """ In-process vRouter Agent REST API serving GET /port and GET /port/<uuid>. """
+
+    def __init__(self, ports=None, list_ports=True, delay=0):
+        self.ports = {port['id']: port for port in ports or ()}
+        self.list_ports = list_ports
+        self.delay = delay
+        self.requests = 0
+        self.connections = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._server = _AgentServer(('127.0.0.1', 0), _AgentHandler)
+        self._server.agent = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def make_agent_port(uuid, mac_address='mac-address', ip_address='10.10.10.1', vlan_id=1):
+    return {
+        'id': uuid,
+        'mac-address': mac_address,
+        'ip-address': ip_address,
+        'rx-vlan-id': vlan_id,
+        'tx-vlan-id': vlan_id,
+    }
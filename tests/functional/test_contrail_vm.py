@@ -1,7 +1,10 @@
+from tests.utils import create_vm_record
+
+
 def test_contrail_vm(controller, database, esxi_api_client, vnc_api_client, vrouter_api_client, vm_created_update,
-                     contrail_vm_properties):
+                     vmware_vm_1, contrail_vm_properties):
     """ We don't need ContrailVM model for CVM to operate properly. """
-    esxi_api_client.read_vm_properties.return_value = contrail_vm_properties
+    esxi_api_client.read_vm_record.return_value = create_vm_record(vmware_vm_1, contrail_vm_properties)
     # A new update containing VmCreatedEvent arrives and is being handled by the controller
     controller.handle_update(vm_created_update)
 
@@ -0,0 +1,108 @@
+from tests.utils import create_vm_record
+
+
+def sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm, vm_properties,
+            vnc_vn, portgroup):
+    esxi_api_client.read_vm_inventory.return_value = [create_vm_record(vmware_vm, vm_properties)]
+    vcenter_api_client.get_all_vms.return_value = [vmware_vm]
+    vnc_api_client.read_vn.return_value = vnc_vn
+    vnc_api_client.get_all_vm_uuids.return_value = []
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.return_value = {}
+    vcenter_api_client.get_dpg_by_key.return_value = portgroup
+    vcenter_api_client.get_vlan_id.return_value = None
+    controller.sync()
+    for client in (esxi_api_client, vcenter_api_client, vnc_api_client):
+        client.reset_mock()
+
+
+def test_resync_unchanged_vm(controller, database, esxi_api_client, vcenter_api_client, vrouter_api_client,
+                             vnc_api_client, vmware_vm_1, vm_properties_1, vnc_vn_1, portgroup):
+    sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+            vnc_vn_1, portgroup)
+    vrouter_api_client.reset_mock()
+    vrouter_api_client.get_all_port_uuids.return_value = [vmi_model.uuid for vmi_model in
+                                                          database.get_all_vmi_models()]
+
+    assert controller.resync() is True
+
+    assert len(database.get_all_vm_models()) == 1
+    assert len(database.get_all_vmi_models()) == 1
+    esxi_api_client.add_filter.assert_called_once()
+    vnc_api_client.update_vm.assert_not_called()
+    vnc_api_client.update_vmi.assert_not_called()
+    vrouter_api_client.add_port.assert_not_called()
+    vrouter_api_client.delete_port.assert_not_called()
+    vnc_api_client.get_all_vm_uuids.assert_not_called()
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.assert_not_called()
+
+
+def test_resync_powered_off_vm(controller, database, esxi_api_client, vcenter_api_client, vrouter_api_client,
+                               vnc_api_client, vmware_vm_1, vm_properties_1, vm_properties_1_off, vnc_vn_1,
+                               portgroup):
+    sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+            vnc_vn_1, portgroup)
+    esxi_api_client.read_vm_inventory.return_value = [create_vm_record(vmware_vm_1, vm_properties_1_off)]
+    vrouter_api_client.reset_mock()
+
+    assert controller.resync() is True
+
+    assert not database.get_vm_model_by_uuid('vmware-vm-uuid-1').is_powered_on
+    vnc_api_client.update_vmi.assert_called_once()
+    vrouter_api_client.read_port.assert_called_once()
+
+
+def test_resync_deletes_stale_vmis_of_changed_vm(controller, database, esxi_api_client, vcenter_api_client,
+                                                 vnc_api_client, vmware_vm_1, vm_properties_1, vm_properties_1_off,
+                                                 vnc_vn_1, portgroup):
+    sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+            vnc_vn_1, portgroup)
+    esxi_api_client.read_vm_inventory.return_value = [create_vm_record(vmware_vm_1, vm_properties_1_off)]
+    vmi_uuid = database.get_all_vmi_models()[0].uuid
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.return_value = {'vmware-vm-uuid-1': [vmi_uuid, 'stale-vmi-uuid']}
+
+    assert controller.resync() is True
+
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.assert_called_once_with(['vmware-vm-uuid-1'])
+    vnc_api_client.delete_vmi.assert_called_once_with('stale-vmi-uuid')
+
+
+def test_resync_vanished_vm(controller, database, esxi_api_client, vcenter_api_client, vnc_api_client,
+                            vmware_vm_1, vm_properties_1, vnc_vn_1, portgroup):
+    sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+            vnc_vn_1, portgroup)
+    esxi_api_client.read_vm_inventory.return_value = []
+    vcenter_api_client.is_vm_removed.return_value = True
+
+    assert controller.resync() is True
+
+    assert not database.get_all_vm_models()
+    assert not database.get_all_vmi_models()
+    vnc_api_client.delete_vm.assert_called_once_with('vmware-vm-uuid-1')
+    vnc_api_client.delete_vmi.assert_called_once()
+
+
+def test_resync_falls_back_when_inventory_is_unreadable(controller, database, esxi_api_client,
+                                                        vcenter_api_client, vnc_api_client, vmware_vm_1,
+                                                        vm_properties_1, vnc_vn_1, portgroup):
+    sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+            vnc_vn_1, portgroup)
+    esxi_api_client.read_vm_inventory.side_effect = Exception('Read timed out')
+
+    assert controller.resync() is False
+
+    assert len(database.get_all_vm_models()) == 1
+    vnc_api_client.update_vm.assert_not_called()
+
+
+def test_resync_deletes_vanished_vm_left_in_vnc(controller, database, esxi_api_client, vcenter_api_client,
+                                                vnc_api_client, vmware_vm_1, vm_properties_1, vnc_vn_1, portgroup):
+    sync_vm(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+            vnc_vn_1, portgroup)
+    esxi_api_client.read_vm_inventory.return_value = []
+    esxi_api_client.read_host_uuid.side_effect = Exception('Read timed out')
+    vcenter_api_client.get_all_vms.return_value = []
+    vnc_api_client.get_all_vm_uuids.return_value = ['vmware-vm-uuid-1', 'vmware-vm-uuid-2']
+
+    assert controller.resync() is True
+
+    vnc_api_client.delete_vm.assert_called_once_with(uuid='vmware-vm-uuid-1')
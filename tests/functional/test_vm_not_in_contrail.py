@@ -1,6 +1,8 @@
 from mock import Mock
 from pyVmomi import vim
 
+from tests.utils import create_vm_record
+
 
 def test_vm_created(controller, vcenter_api_client, vnc_api_client, vrouter_api_client,
                     vm_created_update):
@@ -41,8 +43,9 @@ def test_vm_reconfigured(controller, vcenter_api_client, vnc_api_client, vrouter
     vrouter_api_client.add_port.assert_not_called()
 
 
-def test_network_change(controller, vcenter_api_client, vnc_api_client, vrouter_api_client,
-                        vm_created_update, vm_reconfigured_update, vnc_vn_1, portgroup, vmware_vm_1):
+def test_network_change(controller, esxi_api_client, vcenter_api_client, vnc_api_client, vrouter_api_client,
+                        vm_created_update, vm_reconfigured_update, vnc_vn_1, portgroup, vmware_vm_1,
+                        vm_properties_1):
     """
     What happens when we change the VMIs connection from
     Contrail managed network to a non-Contrail one.
@@ -62,6 +65,7 @@ def test_network_change(controller, vcenter_api_client, vnc_api_client, vrouter_
     device.backing.port = port
     device.macAddress = 'mac-address'
     vmware_vm_1.config.hardware.device = [device]
+    esxi_api_client.read_vm_record.return_value = create_vm_record(vmware_vm_1, vm_properties_1)
 
     controller.handle_update(vm_reconfigured_update)
 
@@ -100,8 +104,8 @@ def test_vm_powered_on(database, controller, vcenter_api_client, vnc_api_client,
 
 
 def test_sync(controller, database, esxi_api_client, vcenter_api_client, vrouter_api_client, vnc_api_client, vmware_vm_1,
-              portgroup, vnc_vm):
-    esxi_api_client.get_all_vms.return_value = [vmware_vm_1]
+              vm_properties_1, portgroup, vnc_vm):
+    esxi_api_client.read_vm_inventory.return_value = [create_vm_record(vmware_vm_1, vm_properties_1)]
     vnc_api_client.read_vn.return_value = None
     vnc_api_client.get_all_vms.return_value = [vnc_vm]
     vcenter_api_client.get_dpg_by_key.return_value = portgroup
@@ -1,6 +1,6 @@
 from mock import Mock
 
-from tests.utils import assert_vm_model_state
+from tests.utils import assert_vm_model_state, create_vm_record
 
 
 def test_vm_power_state_update(controller, database, vrouter_api_client, vm_created_update, vm_power_on_state_update,
@@ -39,7 +39,8 @@ def test_vm_power_state_update(controller, database, vrouter_api_client, vm_crea
 
 
 def test_set_vlan_id_on_power_on(controller, database, vcenter_api_client, esxi_api_client, vrouter_api_client,
-                                 vm_registered_update, vm_power_on_state_update, vn_model_1, vm_properties_1_off):
+                                 vm_registered_update, vm_power_on_state_update, vn_model_1, vmware_vm_1,
+                                 vm_properties_1_off):
     # Virtual Networks are already created for us and after synchronization,
     # their models are stored in our database
     database.save(vn_model_1)
@@ -50,7 +51,7 @@ def test_set_vlan_id_on_power_on(controller, database, vcenter_api_client, esxi_
     vcenter_api_client.set_vlan_id.return_value = 'success', None
 
     # VM is powered off when the VM Registered event comes
-    esxi_api_client.read_vm_properties.return_value = vm_properties_1_off
+    esxi_api_client.read_vm_record.return_value = create_vm_record(vmware_vm_1, vm_properties_1_off)
 
     # A new update containing VmCreatedEvent arrives and is being handled by the controller
     controller.handle_update(vm_registered_update)
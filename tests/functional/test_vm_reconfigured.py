@@ -1,10 +1,10 @@
 from tests.utils import (assert_vm_model_state, assert_vmi_model_state,
-                         reserve_vlan_ids)
+                         create_vm_record, reserve_vlan_ids)
 
 
-def test_vm_reconfigured(controller, database, vcenter_api_client, vnc_api_client, vrouter_api_client,
-                         vm_created_update, vm_reconfigured_update, vmware_vm_1, vn_model_1, vnc_vn_2, vn_model_2,
-                         vlan_id_pool):
+def test_vm_reconfigured(controller, database, esxi_api_client, vcenter_api_client, vnc_api_client,
+                         vrouter_api_client, vm_created_update, vm_reconfigured_update, vmware_vm_1, vm_properties_1,
+                         vn_model_1, vnc_vn_2, vn_model_2, vlan_id_pool):
     # Virtual Networks are already created for us and after synchronization,
     # their models are stored in our database
     database.save(vn_model_1)
@@ -20,6 +20,7 @@ def test_vm_reconfigured(controller, database, vcenter_api_client, vnc_api_clien
     # After a portgroup is changed, the port key is also changed
     vmware_vm_1.config.hardware.device[0].backing.port.portgroupKey = 'dvportgroup-2'
     vmware_vm_1.config.hardware.device[0].backing.port.portKey = '11'
+    esxi_api_client.read_vm_record.return_value = create_vm_record(vmware_vm_1, vm_properties_1)
 
     # Then VmReconfiguredEvent is being handled
     controller.handle_update(vm_reconfigured_update)
@@ -1,9 +1,9 @@
 from tests.utils import (assert_vm_model_state, assert_vmi_model_state,
-                         assert_vnc_vm_state)
+                         assert_vnc_vm_state, create_vm_record)
 
 
 def test_vm_renamed(controller, database, esxi_api_client, vcenter_api_client, vnc_api_client, vrouter_api_client,
-                    vm_created_update, vm_renamed_update, vm_properties_renamed, vn_model_1):
+                    vm_created_update, vm_renamed_update, vmware_vm_1, vm_properties_renamed, vn_model_1):
     # Virtual Networks are already created for us and after synchronization,
     # their models are stored in our database
     database.save(vn_model_1)
@@ -15,7 +15,7 @@ def test_vm_renamed(controller, database, esxi_api_client, vcenter_api_client, v
     controller.handle_update(vm_created_update)
 
     # A user renames the VM in vSphere and VmRenamedEvent arrives
-    esxi_api_client.read_vm_properties.return_value = vm_properties_renamed
+    esxi_api_client.read_vm_record.return_value = create_vm_record(vmware_vm_1, vm_properties_renamed)
     controller.handle_update(vm_renamed_update)
 
     # Check if VM Model has been saved properly:
@@ -0,0 +1,62 @@
+from mock import Mock
+
+from tests.utils import create_vm_record
+
+
+def test_warm_sync_skips_unchanged_objects(controller, database, esxi_api_client, vcenter_api_client,
+                                           vrouter_api_client, vnc_api_client, vmware_vm_1, vm_properties_1,
+                                           vnc_vn_1, portgroup, vlan_id_pool):
+    # VLAN 0 reads back from vCenter as no VLAN
+    vlan_id_pool.reserve(0)
+    esxi_api_client.read_vm_inventory.side_effect = lambda: [create_vm_record(vmware_vm_1, vm_properties_1)]
+    vcenter_api_client.get_all_vms.return_value = [vmware_vm_1]
+    vcenter_api_client.get_dpg_by_key.return_value = portgroup
+    vcenter_api_client.get_vlan_ids.side_effect = lambda vcenter_ports: {port.port_key: None for port in vcenter_ports}
+    vnc_api_client.read_vn.return_value = vnc_vn_1
+    vnc_api_client.get_all_vm_uuids.return_value = []
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.return_value = {}
+    vnc_api_client.create_and_read_instance_ip.return_value = Mock(instance_ip_address='192.168.100.5')
+    controller.sync()
+    cold_vmi_model = database.get_all_vmi_models()[0]
+    snapshot = database.make_snapshot()
+
+    database.clear_database()
+    database.load_snapshot(snapshot)
+    for client in (vcenter_api_client, vnc_api_client, vrouter_api_client):
+        client.reset_mock()
+    vnc_api_client.get_all_vm_uuids.return_value = [cold_vmi_model.vm_model.uuid]
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.return_value = {cold_vmi_model.vm_model.uuid: [cold_vmi_model.uuid]}
+    vcenter_api_client.get_vlan_ids.side_effect = lambda vcenter_ports: {
+        port.port_key: cold_vmi_model.vcenter_port.vlan_id for port in vcenter_ports}
+    controller.sync()
+
+    vmi_model = database.get_all_vmi_models()[0]
+    assert vmi_model.uuid == cold_vmi_model.uuid
+    assert vmi_model.vcenter_port.vlan_id == cold_vmi_model.vcenter_port.vlan_id
+    assert vmi_model.vnc_instance_ip.instance_ip_address == '192.168.100.5'
+    vnc_api_client.update_vm.assert_not_called()
+    vnc_api_client.update_vmi.assert_not_called()
+    vnc_api_client.create_and_read_instance_ip.assert_not_called()
+    vcenter_api_client.get_vlan_ids.assert_called_once()
+    vcenter_api_client.set_vlan_ids.assert_not_called()
+
+
+def test_warm_sync_recreates_objects_missing_from_vnc(controller, database, esxi_api_client, vcenter_api_client,
+                                                      vnc_api_client, vmware_vm_1, vm_properties_1, vnc_vn_1,
+                                                      portgroup):
+    esxi_api_client.read_vm_inventory.side_effect = lambda: [create_vm_record(vmware_vm_1, vm_properties_1)]
+    vcenter_api_client.get_all_vms.return_value = [vmware_vm_1]
+    vcenter_api_client.get_dpg_by_key.return_value = portgroup
+    vnc_api_client.read_vn.return_value = vnc_vn_1
+    vnc_api_client.get_all_vm_uuids.return_value = []
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.return_value = {}
+    controller.sync()
+    snapshot = database.make_snapshot()
+
+    database.clear_database()
+    database.load_snapshot(snapshot)
+    vnc_api_client.reset_mock()
+    controller.sync()
+
+    vnc_api_client.update_vm.assert_called_once()
+    vnc_api_client.update_vmi.assert_called_once()
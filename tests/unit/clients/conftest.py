@@ -5,7 +5,7 @@ from mock import Mock, patch
 from vnc_api import vnc_api
 
 from cvm.clients import VCenterAPIClient, VNCAPIClient
-from cvm.models import VCenterPort
+from cvm.models import PortRecord, VCenterPort
 from tests.utils import create_dv_port
 
 
@@ -33,10 +33,8 @@ def dv_port_3():
 
 @pytest.fixture()
 def vcenter_port():
-    device = Mock(macAddress='mac-address')
-    device.backing.port.portKey = '8'
-    device.backing.port.portgroupKey = 'portgroup-key'
-    return VCenterPort(device)
+    return VCenterPort(PortRecord(device_key=4000, mac_address='mac-address', port_key='8',
+                                  portgroup_key='portgroup-key'))
 
 
 @pytest.fixture()
@@ -24,12 +24,6 @@ def esxi_api_client(service_instance):
         return clients.ESXiAPIClient({})
 
 
-@pytest.fixture
-def vcenter_api_client():
-    with mock.patch("cvm.clients.SmartConnectNoSSL"):
-        return clients.VCenterAPIClient({})
-
-
 @pytest.fixture
 def vnc_api_client():
     with mock.patch("cvm.clients.vnc_api.VncApi"):
@@ -48,16 +42,18 @@ def test_esxi_connection_lost(service_instance, esxi_api_client):
         esxi_api_client.wait_for_updates()
 
 
-def test_vcenter_connection_lost(service_instance, vcenter_api_client):
+def test_vcenter_connection_lost(service_instance):
+    service_instance.content.viewManager.CreateContainerView.return_value.view = []
+    with mock.patch("cvm.clients.SmartConnectNoSSL") as si:
+        si.return_value = service_instance
+        vcenter_api_client = clients.VCenterAPIClient({})
     service_instance.content.viewManager.CreateContainerView.side_effect = (
         socket.error
     )
 
-    with mock.patch("cvm.clients.SmartConnectNoSSL") as si:
-        si.return_value = service_instance
-        with pytest.raises(exceptions.APIClientConnectionLostError):
-            with vcenter_api_client:
-                pass
+    with pytest.raises(exceptions.APIClientConnectionLostError):
+        with vcenter_api_client:
+            vcenter_api_client.can_rename_vm(mock.Mock(), 'vm-name')
 
 
 def test_vnc_connections_lost(vnc_api_client):
@@ -1,6 +1,7 @@
-# pylint: disable=redefined-outer-name
+# pylint: disable=redefined-outer-name, protected-access
 import pytest
 from mock import Mock, patch
+from pyVmomi import vim  # pylint: disable=no-name-in-module
 
 from cvm.clients import ESXiAPIClient
 
@@ -16,6 +17,7 @@ def vm_esxi_properties(vmware_vm_1):
 def property_collector(vm_esxi_properties):
     pc = Mock()
     pc.RetrievePropertiesEx.return_value.objects = [vm_esxi_properties]
+    pc.RetrievePropertiesEx.return_value.token = None
     return pc
 
 
@@ -27,6 +29,41 @@ def esxi_api_client(property_collector):
 
 
 def test_read_vm(esxi_api_client, vmware_vm_1):
-    result = esxi_api_client.read_vm_properties(vmware_vm_1)
+    result = esxi_api_client.read_vm_record(vmware_vm_1)
 
-    assert result.get('name') == 'VM1'
+    assert result.name == 'VM1'
+
+
+def make_object_content(obj, properties):
+    prop_set = []
+    for name, val in properties.items():
+        dynamic_property = Mock(val=val)
+        dynamic_property.configure_mock(name=name)
+        prop_set.append(dynamic_property)
+    return Mock(obj=obj, propSet=prop_set)
+
+
+def test_read_vm_inventory(esxi_api_client, property_collector, vmware_vm_1, vm_properties_1):
+    host = Mock(spec=vim.HostSystem)
+    vm_properties = dict(vm_properties_1, **{'summary.runtime.host': host})
+    vm_content = make_object_content(vmware_vm_1, dict(vm_properties, **{
+        'config.template': False,
+        'config.hardware.device': vmware_vm_1.config.hardware.device,
+    }))
+    host_content = make_object_content(host, {'hardware.systemInfo.uuid': 'host-uuid-1'})
+    view_manager = esxi_api_client._si.content.viewManager
+    view_manager.CreateContainerView.return_value = vim.view.ContainerView('view-1', Mock())
+    property_collector.RetrievePropertiesEx.return_value = Mock(objects=[vm_content], token='page-2')
+    property_collector.ContinueRetrievePropertiesEx.return_value = Mock(objects=[host_content], token=None)
+
+    inventory = esxi_api_client.read_vm_inventory()
+
+    assert len(inventory) == 1
+    record = inventory[0]
+    assert record.vmware_vm is vmware_vm_1
+    assert record.vm_properties == vm_properties
+    assert [port.port_key for port in record.ports] == ['10']
+    assert record.host_uuid == 'host-uuid-1'
+    assert record.template is False
+    property_collector.RetrievePropertiesEx.assert_called_once()
+    property_collector.ContinueRetrievePropertiesEx.assert_called_once_with('page-2')
@@ -1,13 +1,18 @@
+import gevent
+import pytest
+from mock import DEFAULT, MagicMock, Mock, patch
+from pyVmomi import vim
+
 from cvm.clients import VCenterAPIClient
-from mock import Mock, patch
 
 
-def test_set_vlan_id(vcenter_api_client, dvs, vcenter_port):
+def test_set_vlan_id(dvs, vcenter_port):
     vcenter_port.vlan_id = 10
 
     with patch('cvm.clients.wait_for_task'):
         with patch('cvm.clients.SmartConnectNoSSL'):
             with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=dvs):
+                vcenter_api_client = VCenterAPIClient({})
                 with vcenter_api_client:
                     vcenter_api_client.set_vlan_id(vcenter_port)
 
@@ -41,22 +46,24 @@ def test_vlan_override_enabled(vcenter_api_client, portgroup):
     portgroup.ReconfigureDVPortgroup_Task.assert_not_called()
 
 
-def test_get_vlan_id(vcenter_api_client, dvs, vcenter_port, dv_port):
+def test_get_vlan_id(dvs, vcenter_port, dv_port):
     dv_port.config.setting.vlan.vlanId = 10
     dv_port.config.setting.vlan.inherited = False
 
     with patch('cvm.clients.SmartConnectNoSSL'):
         with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=dvs):
+            vcenter_api_client = VCenterAPIClient({})
             with vcenter_api_client:
                 result = vcenter_api_client.get_vlan_id(vcenter_port)
 
     assert result == 10
 
 
-def test_restore_vlan_id(vcenter_api_client, dvs, vcenter_port):
+def test_restore_vlan_id(dvs, vcenter_port):
     with patch('cvm.clients.wait_for_task'):
         with patch('cvm.clients.SmartConnectNoSSL'):
             with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=dvs):
+                vcenter_api_client = VCenterAPIClient({})
                 with vcenter_api_client:
                     vcenter_api_client.restore_vlan_id(vcenter_port)
 
@@ -119,11 +126,233 @@ def test_can_rename_vmi(vcenter_api_client, vmi_model, vmware_vm_1, host_2):
                 assert not vcenter_api_client.can_rename_vmi(vmi_model, 'VM-renamed')
 
 
-def test_get_all_vms(vcenter_api_client, vmware_vm_1, vmware_vm_2):
+def test_get_all_vms(vmware_vm_1, vmware_vm_2):
     with patch.object(VCenterAPIClient, '_get_datacenter') as dc_mock:
         dc_mock.return_value.datastore = [Mock(vm=[vmware_vm_1]), Mock(vm=[vmware_vm_2]), Mock(vm=[3])]
         with patch('cvm.clients.SmartConnectNoSSL'):
+            vcenter_api_client = VCenterAPIClient({})
             with vcenter_api_client:
                 vms = vcenter_api_client.get_all_vms()
 
     assert vms == [vmware_vm_1, vmware_vm_2]
+
+
+def test_session_is_reused(vcenter_api_client):
+    with patch('cvm.clients.SmartConnectNoSSL') as connect:
+        with vcenter_api_client:
+            pass
+        with vcenter_api_client:
+            pass
+
+    connect.assert_not_called()
+    assert vcenter_api_client.login_count == 1
+
+
+def test_relogin_after_not_authenticated(vcenter_api_client):
+    with patch('cvm.clients.SmartConnectNoSSL') as connect:
+        with pytest.raises(vim.fault.NotAuthenticated):
+            with vcenter_api_client:
+                raise vim.fault.NotAuthenticated()
+        with vcenter_api_client:
+            pass
+
+    connect.assert_called_once()
+    assert vcenter_api_client.login_count == 2
+
+
+def test_relogin_after_session_expired(vcenter_api_client):
+    vcenter_api_client._last_used = 0
+    vcenter_api_client._si.content.sessionManager.currentSession = None
+
+    with patch('cvm.clients.SmartConnectNoSSL') as connect:
+        with vcenter_api_client:
+            pass
+
+    connect.assert_called_once()
+    assert vcenter_api_client.login_count == 2
+
+
+def test_concurrent_checkouts_login_once(vcenter_api_client):
+    vcenter_api_client._session_expired = True
+
+    def login(**_):
+        gevent.sleep(0.01)
+        return MagicMock()
+
+    with patch('cvm.clients.SmartConnectNoSSL', side_effect=login) as connect:
+        def use_session():
+            with vcenter_api_client:
+                pass
+        gevent.joinall([gevent.spawn(use_session) for _ in range(3)], raise_error=True)
+
+    connect.assert_called_once()
+    assert vcenter_api_client.login_count == 2
+
+
+def test_stale_checkout_keeps_new_session(vcenter_api_client):
+    with patch('cvm.clients.SmartConnectNoSSL'):
+        with pytest.raises(vim.fault.NotAuthenticated):
+            with vcenter_api_client:
+                vcenter_api_client._renew_session(vcenter_api_client._session_generation)
+                raise vim.fault.NotAuthenticated()
+
+    assert not vcenter_api_client._session_expired
+    assert vcenter_api_client.login_count == 2
+
+
+def test_retry_once_after_not_authenticated(vcenter_api_client, dvs, dv_port):
+    vcenter_api_client._dvs = dvs
+    dvs.FetchDVPorts.side_effect = [vim.fault.NotAuthenticated(), [dv_port]]
+    with patch('cvm.clients.SmartConnectNoSSL'):
+        with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=dvs):
+            with vcenter_api_client:
+                result = vcenter_api_client.fetch_port_from_dvs('8')
+
+    assert result is dv_port
+    assert vcenter_api_client.login_count == 2
+
+
+def test_keep_session_alive(vcenter_api_client):
+    vcenter_api_client._keepalive_interval = 0.01
+    vcenter_api_client._si.content.sessionManager.currentSession = None
+
+    with patch('cvm.clients.SmartConnectNoSSL'):
+        greenlet = gevent.spawn(vcenter_api_client.keep_session_alive)
+        gevent.sleep(0.05)
+        greenlet.kill()
+
+    assert vcenter_api_client.login_count == 2
+
+def make_property_change(name, val, op='assign'):
+    change = Mock(op=op, val=val)
+    change.name = name
+    return change
+
+
+@pytest.fixture()
+def indexed_vcenter_api_client(dvs):
+    portgroup_1, portgroup_2 = Mock(), Mock()
+    with patch('cvm.clients.SmartConnectNoSSL'):
+        with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=dvs):
+            client = VCenterAPIClient({})
+    initial_update_set = Mock(version='1', truncated=False, filterSet=[Mock(objectSet=[
+        Mock(kind='enter', obj=portgroup_1, changeSet=[make_property_change('key', 'dvportgroup-1'),
+                                                       make_property_change('name', 'pg-1')]),
+        Mock(kind='enter', obj=portgroup_2, changeSet=[make_property_change('key', 'dvportgroup-2'),
+                                                       make_property_change('name', 'pg-2'),
+                                                       make_property_change('config.policy.vlanOverrideAllowed',
+                                                                            True)]),
+    ])])
+    collector = client._si.content.propertyCollector.CreatePropertyCollector.return_value
+    collector.WaitForUpdatesEx.side_effect = lambda version, options: initial_update_set if version == '' else DEFAULT
+    collector.WaitForUpdatesEx.return_value = None
+    return client, collector, portgroup_1, portgroup_2
+
+
+def test_get_dpg_from_index(indexed_vcenter_api_client):
+    client, _, portgroup_1, portgroup_2 = indexed_vcenter_api_client
+
+    with patch('cvm.clients.make_portgroup_filter_spec'):
+        with client:
+            assert client.get_dpg_by_key('dvportgroup-1') is portgroup_1
+            assert client.get_dpg_by_name('pg-2') is portgroup_2
+            assert client.get_dpg_by_key('dvportgroup-3') is None
+
+    client._si.content.propertyCollector.RetrievePropertiesEx.assert_not_called()
+
+
+def test_portgroup_hits_refresh_once_per_interval(indexed_vcenter_api_client):
+    client, collector, portgroup_1, _ = indexed_vcenter_api_client
+
+    with patch('cvm.clients.make_portgroup_filter_spec'):
+        with client:
+            for _ in range(3):
+                assert client.get_dpg_by_key('dvportgroup-1') is portgroup_1
+
+    assert [call[0][0] for call in collector.WaitForUpdatesEx.call_args_list] == ['']
+
+    with patch('cvm.clients.PORTGROUP_REFRESH_INTERVAL', 0):
+        client.get_dpg_by_key('dvportgroup-1')
+
+    assert collector.WaitForUpdatesEx.call_args[0][0] == '1'
+
+
+def test_portgroup_index_follows_updates(indexed_vcenter_api_client):
+    client, collector, portgroup_1, portgroup_2 = indexed_vcenter_api_client
+    portgroup_3 = Mock()
+    with patch('cvm.clients.make_portgroup_filter_spec'):
+        with client:
+            client.get_dpg_by_key('dvportgroup-1')
+            collector.WaitForUpdatesEx.return_value = Mock(version='1', truncated=False, filterSet=[Mock(objectSet=[
+                Mock(kind='modify', obj=portgroup_1, changeSet=[make_property_change('name', 'pg-1-renamed')]),
+                Mock(kind='leave', obj=portgroup_2, changeSet=[]),
+                Mock(kind='enter', obj=portgroup_3, changeSet=[make_property_change('key', 'dvportgroup-3'),
+                                                               make_property_change('name', 'pg-3')]),
+            ])])
+
+            assert client.get_dpg_by_name('pg-1-renamed') is portgroup_1
+            collector.WaitForUpdatesEx.return_value = None
+            assert client.get_dpg_by_name('pg-1') is None
+            assert client.get_dpg_by_key('dvportgroup-2') is None
+            assert client.get_dpg_by_key('dvportgroup-3') is portgroup_3
+
+
+def test_vlan_override_allowed_from_index(indexed_vcenter_api_client):
+    client, _, _, portgroup_2 = indexed_vcenter_api_client
+    portgroup_2.config.policy.vlanOverrideAllowed = False
+
+    with patch('cvm.clients.make_portgroup_filter_spec'):
+        with client:
+            client.enable_vlan_override(client.get_dpg_by_key('dvportgroup-2'))
+
+    portgroup_2.ReconfigureDVPortgroup_Task.assert_not_called()
+
+
+@pytest.fixture()
+def batch_dvs():
+    dv_ports = []
+    for key in ('8', '9'):
+        dv_port = Mock(key=key)
+        dv_port.config.configVersion = '1'
+        dv_ports.append(dv_port)
+    dvswitch = Mock()
+    dvswitch.FetchDVPorts.return_value = dv_ports
+    return dvswitch
+
+
+def test_set_vlan_ids_in_one_task(batch_dvs):
+    vcenter_ports = [Mock(port_key='8', vlan_id=10), Mock(port_key='9', vlan_id=11), Mock(port_key='7', vlan_id=12)]
+
+    with patch('cvm.clients.wait_for_task', return_value=('success', None)):
+        with patch('cvm.clients.SmartConnectNoSSL'):
+            with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=batch_dvs):
+                vcenter_api_client = VCenterAPIClient({})
+                with vcenter_api_client:
+                    results = vcenter_api_client.set_vlan_ids(vcenter_ports)
+
+    batch_dvs.FetchDVPorts.assert_called_once()
+    batch_dvs.ReconfigureDVPort_Task.assert_called_once()
+    specs = batch_dvs.ReconfigureDVPort_Task.call_args[1]['port']
+    assert {spec.key: spec.setting.vlan.vlanId for spec in specs} == {'8': 10, '9': 11}
+    assert results['8'] == ('success', None)
+    assert results['9'] == ('success', None)
+    assert results['7'][0] == 'error'
+
+
+def test_set_vlan_ids_isolates_failed_port(batch_dvs):
+    vcenter_ports = [Mock(port_key='8', vlan_id=10), Mock(port_key='9', vlan_id=11)]
+
+    def reconfigure(port):
+        failed = any(spec.key == '9' for spec in port)
+        return ('error', 'port 9 failed') if failed else ('success', None)
+
+    batch_dvs.ReconfigureDVPort_Task.side_effect = reconfigure
+    with patch('cvm.clients.wait_for_task', side_effect=lambda task, *_: task):
+        with patch('cvm.clients.SmartConnectNoSSL'):
+            with patch.object(VCenterAPIClient, '_get_dvswitch', return_value=batch_dvs):
+                vcenter_api_client = VCenterAPIClient({})
+                with vcenter_api_client:
+                    results = vcenter_api_client.set_vlan_ids(vcenter_ports)
+
+    assert batch_dvs.ReconfigureDVPort_Task.call_count == 3
+    assert results == {'8': ('success', None), '9': ('error', 'port 9 failed')}
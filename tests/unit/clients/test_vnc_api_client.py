@@ -1,5 +1,8 @@
+from mock import Mock
 from vnc_api.exceptions import NoIdError
 
+from cvm.clients import VNCObjectCache
+
 
 def test_update_create_vm(vnc_api_client, vnc_lib, vnc_vm):
     vnc_api_client.update_vm(vnc_vm)
@@ -58,21 +61,45 @@ def test_dont_update_vmi_vn(vnc_api_client, vnc_lib, vnc_vmi_1, vnc_vn_1):
 
 
 def test_get_all_vms(vnc_api_client, vnc_lib, vnc_vm):
-    vnc_lib.virtual_machines_list.return_value = {
-        u'virtual-machines': [{
-            u'fq_name': [u'vm-uuid'],
-            u'href': u'http://10.100.0.84:8082/virtual-machine/vm-uuid',
-            u'uuid': u'vm-uuid',
-        }]
-    }
-    vnc_lib.virtual_machine_read.return_value = vnc_vm
+    vnc_lib.virtual_machines_list.side_effect = [
+        {
+            u'virtual-machines': [{
+                u'fq_name': [u'vm-uuid'],
+                u'href': u'http://10.100.0.84:8082/virtual-machine/vm-uuid',
+                u'uuid': u'vm-uuid',
+            }]
+        },
+        [vnc_vm],
+    ]
 
     all_vms = vnc_api_client.get_all_vms()
 
-    vnc_lib.virtual_machine_read.assert_called_once_with(id=u'vm-uuid')
+    vnc_lib.virtual_machines_list.assert_called_with(obj_uuids=[u'vm-uuid'], detail=True)
+    vnc_lib.virtual_machine_read.assert_not_called()
     assert all_vms == [vnc_vm]
 
 
+def test_get_all_vm_uuids_paged(vnc_api_client, vnc_lib):
+    vnc_api_client._list_page_size = 2
+    vm_uuids = ['vm-uuid-1', 'vm-uuid-2', 'vm-uuid-3']
+
+    def virtual_machines_list(obj_uuids=None, fields=None):
+        if obj_uuids is None:
+            return {'virtual-machines': [{'uuid': uuid} for uuid in vm_uuids]}
+        return {'virtual-machines': [
+            {'uuid': uuid, 'id_perms': {'creator': 'other' if uuid == 'vm-uuid-2' else 'vcenter-manager'}}
+            for uuid in obj_uuids
+        ]}
+
+    vnc_lib.virtual_machines_list.side_effect = virtual_machines_list
+
+    result = vnc_api_client.get_all_vm_uuids()
+
+    assert result == ['vm-uuid-1', 'vm-uuid-3']
+    assert vnc_lib.virtual_machines_list.call_count == 3
+    vnc_lib.virtual_machine_read.assert_not_called()
+
+
 def test_get_vmi_uuids_by_vm_uuid(vnc_api_client, vnc_lib, vnc_vm):
     vnc_lib.virtual_machine_read.return_value = vnc_vm
 
@@ -81,6 +108,22 @@ def test_get_vmi_uuids_by_vm_uuid(vnc_api_client, vnc_lib, vnc_vm):
     assert vmi_uuids == ['vmi-uuid']
 
 
+def test_get_vmi_uuids_by_vm_uuids(vnc_api_client, vnc_lib):
+    vnc_lib.virtual_machine_interfaces_list.return_value = {
+        'virtual-machine-interfaces': [
+            {'uuid': 'vmi-uuid-1', 'virtual_machine_refs': [{'uuid': 'vm-uuid-1'}]},
+            {'uuid': 'vmi-uuid-2', 'virtual_machine_refs': [{'uuid': 'vm-uuid-1'}]},
+            {'uuid': 'vmi-uuid-3', 'virtual_machine_refs': [{'uuid': 'vm-uuid-3'}]},
+        ]
+    }
+
+    result = vnc_api_client.get_vmi_uuids_by_vm_uuids(['vm-uuid-1', 'vm-uuid-2'])
+
+    assert result == {'vm-uuid-1': ['vmi-uuid-1', 'vmi-uuid-2'], 'vm-uuid-2': []}
+    vnc_lib.virtual_machine_interfaces_list.assert_called_once()
+    vnc_lib.virtual_machine_read.assert_not_called()
+
+
 def test_read_instance_ip(vnc_api_client, vnc_lib, vmi_model, vnc_vmi_1, instance_ip, vnf_instance_ip):
     vnc_lib.virtual_machine_interface_read.return_value = vnc_vmi_1
     vnc_lib.instance_ip_read.side_effect = [vnf_instance_ip, instance_ip]
@@ -88,3 +131,116 @@ def test_read_instance_ip(vnc_api_client, vnc_lib, vmi_model, vnc_vmi_1, instanc
     read_instance_ip = vnc_api_client._read_instance_ip(vmi_model)
 
     assert read_instance_ip == instance_ip
+
+
+def test_read_vm_is_cached(vnc_api_client, vnc_lib, vnc_vm):
+    vnc_lib.virtual_machine_read.return_value = vnc_vm
+
+    vnc_api_client.read_vm(vnc_vm.uuid)
+    result = vnc_api_client.read_vm(vnc_vm.uuid)
+
+    assert result == vnc_vm
+    vnc_lib.virtual_machine_read.assert_called_once_with(id=vnc_vm.uuid)
+    stats = vnc_api_client.get_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_update_vm_invalidates_cache(vnc_api_client, vnc_lib, vnc_vm):
+    vnc_lib.virtual_machine_read.return_value = vnc_vm
+    vnc_api_client.read_vm(vnc_vm.uuid)
+
+    vnc_api_client.update_vm(vnc_vm)
+    vnc_api_client.read_vm(vnc_vm.uuid)
+
+    assert vnc_lib.virtual_machine_read.call_count == 2
+
+
+def test_create_vmi_invalidates_refs(vnc_api_client, vnc_lib, vnc_vmi_1, vnc_vn_1):
+    vnc_lib.virtual_network_read.return_value = vnc_vn_1
+    vnc_api_client.read_vn(['domain', 'project', 'vnc-vn-1'])
+
+    vnc_api_client.create_vmi(vnc_vmi_1)
+    vnc_api_client.read_vn(['domain', 'project', 'vnc-vn-1'])
+
+    assert vnc_lib.virtual_network_read.call_count == 2
+
+
+def test_update_vmi_leaves_cached_vmi_untouched(vnc_api_client, vnc_lib, vnc_vmi_1):
+    cached_vmi, fresh_vmi = Mock(), Mock(uuid=vnc_vmi_1.uuid)
+    fresh_vmi.get_virtual_network_refs.return_value = vnc_vmi_1.get_virtual_network_refs()
+    vnc_lib.virtual_machine_interface_read.side_effect = [cached_vmi, fresh_vmi]
+    vnc_api_client.read_vmi(vnc_vmi_1.uuid)
+
+    vnc_api_client.update_vmi(vnc_vmi_1)
+
+    cached_vmi.set_display_name.assert_not_called()
+    fresh_vmi.set_display_name.assert_called_once_with(vnc_vmi_1.display_name)
+    vnc_lib.virtual_machine_interface_update.assert_called_once_with(fresh_vmi)
+
+
+def test_update_vmi_reads_once(vnc_api_client, vnc_lib, vnc_vmi_1):
+    vnc_lib.virtual_machine_interface_read.return_value = vnc_vmi_1
+
+    vnc_api_client.update_vmi(vnc_vmi_1)
+    vnc_api_client.read_vmi(vnc_vmi_1.uuid)
+
+    vnc_lib.virtual_machine_interface_read.assert_called_once_with(id=vnc_vmi_1.uuid)
+
+
+def test_delete_vmi_reads_current_back_refs(vnc_api_client, vnc_lib, vnc_vmi_1):
+    cached_vmi = Mock(uuid=vnc_vmi_1.uuid)
+    cached_vmi.get_instance_ip_back_refs.return_value = None
+    vnc_lib.virtual_machine_interface_read.side_effect = [cached_vmi, vnc_vmi_1]
+    vnc_api_client.read_vmi(vnc_vmi_1.uuid)
+
+    vnc_api_client.delete_vmi(vnc_vmi_1.uuid)
+
+    assert vnc_lib.instance_ip_delete.call_count == 2
+    vnc_lib.virtual_machine_interface_delete.assert_called_once_with(id=vnc_vmi_1.uuid)
+
+
+def test_delete_vm_reads_current_back_refs(vnc_api_client, vnc_lib, vnc_vm):
+    cached_vm = Mock(uuid=vnc_vm.uuid)
+    cached_vm.get_virtual_machine_interface_back_refs.return_value = None
+    vnc_lib.virtual_machine_read.side_effect = [cached_vm, vnc_vm, vnc_vm]
+    vnc_lib.virtual_machine_interface_read.return_value.get_instance_ip_back_refs.return_value = None
+    vnc_api_client.read_vm(vnc_vm.uuid)
+
+    vnc_api_client.delete_vm(vnc_vm.uuid)
+    vmi_uuids = vnc_api_client.get_vmi_uuids_by_vm_uuid(vnc_vm.uuid)
+
+    vnc_lib.virtual_machine_interface_delete.assert_called_once_with(id='vmi-uuid')
+    assert vmi_uuids == ['vmi-uuid']
+
+
+def test_cache_ttl():
+    clock = Mock(return_value=0)
+    cache = VNCObjectCache(ttl=10, max_size=10, clock=clock)
+    cache.put('virtual_machine', 'vm-uuid', 'vm')
+
+    clock.return_value = 9
+    assert cache.get('virtual_machine', uuid='vm-uuid') == 'vm'
+    clock.return_value = 10
+    assert cache.get('virtual_machine', uuid='vm-uuid') is None
+    assert cache.get_stats()['expirations'] == 1
+
+
+def test_cache_lru_eviction():
+    cache = VNCObjectCache(ttl=10, max_size=2)
+    cache.put('virtual_network', 'vn-uuid-1', 'vn-1', fq_name=['domain', 'project', 'vn-1'])
+    cache.put('virtual_network', 'vn-uuid-2', 'vn-2')
+    cache.get('virtual_network', fq_name=['domain', 'project', 'vn-1'])
+
+    cache.put('virtual_network', 'vn-uuid-3', 'vn-3')
+
+    assert cache.get('virtual_network', uuid='vn-uuid-1') == 'vn-1'
+    assert cache.get('virtual_network', uuid='vn-uuid-2') is None
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_cache_disabled():
+    cache = VNCObjectCache(ttl=0, max_size=10)
+    cache.put('virtual_machine', 'vm-uuid', 'vm')
+
+    assert cache.get('virtual_machine', uuid='vm-uuid') is None
@@ -0,0 +1,155 @@
+import time
+
+from mock import Mock
+
+from cvm.clients import PortStateCache, VRouterAPIClient
+from tests.fake_vrouter_agent import FakeVRouterAgent, make_agent_port
+
+
+def make_client(agent, **vrouter_cfg):
+    vrouter_cfg.setdefault('agent_url', agent.url)
+    return VRouterAPIClient(vrouter_cfg)
+
+
+def test_read_port_reuses_connection():
+    ports = [make_agent_port('port-uuid-{}'.format(i)) for i in range(5)]
+    with FakeVRouterAgent(ports) as agent:
+        client = make_client(agent)
+
+        results = [client.read_port(port['id']) for port in ports]
+
+    assert results == ports
+    assert agent.requests == 5
+    assert agent.connections == 1
+
+
+def test_read_missing_port():
+    with FakeVRouterAgent() as agent:
+        client = make_client(agent)
+
+        assert client.read_port('port-uuid') is None
+
+
+def test_read_port_timeout():
+    with FakeVRouterAgent([make_agent_port('port-uuid')], delay=1) as agent:
+        client = make_client(agent, read_timeout=0.1)
+
+        start = time.time()
+        result = client.read_port('port-uuid')
+
+    assert result is None
+    assert time.time() - start < 1
+
+
+def test_read_all_ports():
+    ports = [make_agent_port('port-uuid-1'), make_agent_port('port-uuid-2', vlan_id=2)]
+    with FakeVRouterAgent(ports) as agent:
+        client = make_client(agent)
+
+        result = client.read_all_ports()
+
+    assert result == {'port-uuid-1': ports[0], 'port-uuid-2': ports[1]}
+    assert agent.requests == 1
+
+
+def test_read_all_ports_not_supported():
+    with FakeVRouterAgent([make_agent_port('port-uuid')], list_ports=False) as agent:
+        client = make_client(agent)
+
+        assert client.read_all_ports() is None
+
+
+def test_read_all_ports_agent_down():
+    with FakeVRouterAgent() as agent:
+        client = make_client(agent)
+    # Agent is stopped, connection will be refused
+
+    assert client.read_all_ports() is None
+
+
+def test_get_all_port_uuids(tmpdir):
+    tmpdir.join('port-uuid-1').write('')
+    tmpdir.mkdir('not-a-port')
+    client = VRouterAPIClient({'port_files_path': str(tmpdir)})
+
+    assert client.get_all_port_uuids() == {'port-uuid-1'}
+
+    tmpdir.join('port-uuid-2').write('')
+
+    assert client.get_all_port_uuids() == {'port-uuid-1', 'port-uuid-2'}
+    assert client.port_file_exists('port-uuid-2')
+
+
+def make_vmi_model():
+    vmi_model = Mock(uuid='port-uuid', ip_address='10.10.10.1', vnc_instance_ip=None)
+    vmi_model.vm_model.uuid = 'vm-uuid'
+    vmi_model.vn_model.uuid = 'vn-uuid'
+    vmi_model.vcenter_port.vlan_id = 1
+    return vmi_model
+
+
+def test_port_state_cache():
+    cache = PortStateCache(verify_interval=60)
+    cache.record('port-uuid', make_agent_port('port-uuid'))
+
+    assert cache.get('port-uuid') == {'instance-id': None, 'vn-id': None, 'rx-vlan-id': 1,
+                                      'tx-vlan-id': 1, 'ip-address': '10.10.10.1'}
+
+    cache.invalidate()
+
+    assert cache.get('port-uuid') is None
+    assert cache.generation == 1
+
+
+def test_port_state_cache_expiry():
+    cache = PortStateCache(verify_interval=0)
+    cache.record('port-uuid', make_agent_port('port-uuid'))
+
+    assert 'port-uuid' not in cache
+    assert len(cache) == 1
+
+
+def test_add_port_caches_pushed_state():
+    client = VRouterAPIClient()
+    client.vrouter_api = Mock()
+
+    client.add_port(make_vmi_model())
+
+    assert client.port_state_cache.get('port-uuid') == {'instance-id': 'vm-uuid', 'vn-id': 'vn-uuid', 'rx-vlan-id': 1,
+                                                        'tx-vlan-id': 1, 'ip-address': '10.10.10.1'}
+
+    client.delete_port('port-uuid')
+
+    assert client.port_state_cache.get('port-uuid') is None
+
+
+def test_failed_add_port_is_not_cached():
+    client = VRouterAPIClient()
+    client.vrouter_api = Mock()
+    client.vrouter_api.add_port.side_effect = Exception()
+
+    client.add_port(make_vmi_model())
+
+    assert client.port_state_cache.get('port-uuid') is None
+
+
+def test_unreachable_agent_invalidates_cache():
+    with FakeVRouterAgent() as agent:
+        client = make_client(agent)
+    client.port_state_cache.record('port-uuid', make_agent_port('port-uuid'))
+
+    client.read_port('port-uuid')
+
+    assert 'port-uuid' not in client.port_state_cache
+    assert client.port_state_cache.generation == 1
+
+
+def test_restarted_agent_invalidates_cache():
+    with FakeVRouterAgent([make_agent_port('port-uuid-1')]) as agent:
+        client = make_client(agent)
+        client.port_state_cache.record('port-uuid-1', make_agent_port('port-uuid-1'))
+        client.port_state_cache.record('port-uuid-2', make_agent_port('port-uuid-2'))
+
+        client.read_all_ports()
+
+    assert len(client.port_state_cache) == 0
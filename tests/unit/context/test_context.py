@@ -200,6 +200,36 @@ def test_build_context_services(context, services, patched_libs):
     assert context.services == services
 
 
+def test_build_context_vlan_id_worker_pool(context, services, patched_libs):
+    context.build()
+
+    vlan_id_service = services["vlan_id_service"]
+    vlan_id_service.defer_vcenter_updates.assert_called_once_with(
+        context.vlan_id_worker_pool
+    )
+
+
+def test_build_context_port_file_monitor(context, clients, services, patched_libs):
+    context.config["vrouter"] = {"port_files_poll_interval": 5}
+    context.build()
+
+    monitor = context.port_file_monitor
+    assert monitor._index is clients["vrouter_api_client"].port_file_index
+    assert monitor._vrouter_port_service is services["vrouter_port_service"]
+    assert monitor._poll_interval == 5
+
+
+def test_build_context_sync_executor(context, services, patched_libs):
+    context.config["sync"] = {"pool_size": 32, "vnc_concurrency": 10}
+    context.build()
+
+    patched_libs["services_lib"].SyncExecutor.assert_called_once_with(
+        pool_size=32, backend_limits={"vnc": 10}
+    )
+    for service in services.values():
+        service.use_sync_executor.assert_called_once_with(context.sync_executor)
+
+
 def test_context_handlers(context, handlers, services, patched_libs):
     context.build()
 
@@ -221,7 +251,10 @@ def test_context_vmware_controller(context, services, patched_libs):
 
     c_lib = patched_libs["controllers_lib"]
     c_lib.VmwareController.assert_called_once_with(
-        update_handler=context.update_handler, lock=context.lock, **services
+        update_handler=context.update_handler,
+        lock=context.lock,
+        sync_executor=context.sync_executor,
+        **services
     )
 
 
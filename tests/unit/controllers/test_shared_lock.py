@@ -0,0 +1,58 @@
+import gevent
+
+from cvm.controllers import SharedLock
+
+
+def test_shared_holders_run_concurrently():
+    lock = SharedLock()
+    entered = []
+
+    def hold_shared(name):
+        with lock.shared():
+            entered.append(name)
+            gevent.sleep(0.01)
+            entered.append(len(entered))
+
+    gevent.joinall([gevent.spawn(hold_shared, 'a'), gevent.spawn(hold_shared, 'b')])
+
+    assert entered[:2] == ['a', 'b']
+
+
+def test_exclusive_waits_for_shared_holders():
+    lock = SharedLock()
+    order = []
+
+    def hold_shared():
+        with lock.shared():
+            gevent.sleep(0.01)
+            order.append('shared')
+
+    def hold_exclusive():
+        with lock:
+            order.append('exclusive')
+
+    shared = gevent.spawn(hold_shared)
+    gevent.sleep(0)
+    gevent.joinall([shared, gevent.spawn(hold_exclusive)])
+
+    assert order == ['shared', 'exclusive']
+
+
+def test_shared_waits_for_exclusive_holder():
+    lock = SharedLock()
+    order = []
+
+    def hold_exclusive():
+        with lock:
+            gevent.sleep(0.01)
+            order.append('exclusive')
+
+    def hold_shared():
+        with lock.shared():
+            order.append('shared')
+
+    exclusive = gevent.spawn(hold_exclusive)
+    gevent.sleep(0)
+    gevent.joinall([exclusive, gevent.spawn(hold_shared)])
+
+    assert order == ['exclusive', 'shared']
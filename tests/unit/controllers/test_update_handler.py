@@ -0,0 +1,75 @@
+# pylint: disable=redefined-outer-name
+import pytest
+from mock import Mock
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+from cvm import controllers
+from tests.utils import create_event, wrap_into_update_set
+
+
+class RecordingEventHandler(controllers.AbstractEventHandler):
+    EVENTS = (vim.event.VmCreatedEvent, vim.event.VmRemovedEvent)
+
+    def __init__(self, handled):
+        super(RecordingEventHandler, self).__init__()
+        self.handled = handled
+
+    def _handle_event(self, event):
+        self.handled.append(event)
+
+
+class RecordingChangeHandler(controllers.AbstractChangeHandler):
+    PROPERTY_NAME = 'runtime.powerState'
+
+    def __init__(self, handled):
+        super(RecordingChangeHandler, self).__init__()
+        self.handled = handled
+
+    def _handle_change(self, obj, value):
+        self.handled.append((obj, value))
+
+    def _log_managed_object_not_found(self, value):
+        pass
+
+
+@pytest.fixture()
+def handled():
+    return []
+
+
+@pytest.fixture()
+def update_handler(handled):
+    return controllers.UpdateHandler([RecordingChangeHandler(handled), RecordingEventHandler(handled)])
+
+
+def test_routes_events_sorted_by_key(update_handler, handled):
+    created = create_event(vim.event.VmCreatedEvent, 1)
+    renamed = create_event(vim.event.VmRenamedEvent, 2)
+    removed = create_event(vim.event.VmRemovedEvent, 3)
+
+    update_handler.handle_update(wrap_into_update_set(event=vim.event.Event.Array([removed, renamed, created])))
+
+    assert handled == [created, removed]
+
+
+def test_routes_property_changes_by_name(update_handler, handled):
+    vmware_vm = Mock(spec=vim.VirtualMachine)
+    power_state = vmodl.query.PropertyCollector.Change(name='runtime.powerState', val='poweredOff', op='assign')
+    tools_status = vmodl.query.PropertyCollector.Change(name='guest.toolsRunningStatus', val='guestToolsRunning',
+                                                        op='assign')
+
+    update_handler.handle_update(wrap_into_update_set(change=power_state, obj=vmware_vm))
+    update_handler.handle_update(wrap_into_update_set(change=tools_status, obj=vmware_vm))
+
+    assert handled == [(vmware_vm, 'poweredOff')]
+
+
+def test_sync_records_phase_times():
+    controller = controllers.VmwareController(Mock(), Mock(), Mock(), Mock(), Mock(), Mock(),
+                                              controllers.SharedLock())
+
+    controller.sync()
+
+    assert list(controller.get_sync_phase_times()) == [
+        'get_vms_from_vmware', 'update_vns', 'update_vmis', 'delete_unused_vms_in_vnc',
+        'delete_unused_vmis_in_vnc', 'update_vlan_ids', 'sync_ports', 'delete_stale_vrouter_ports']
@@ -1,3 +1,6 @@
+from mock import patch
+
+from cvm.database import WorkSet, get_old_name_from_vmfs_path, read_snapshot, write_snapshot
 from cvm.models import VirtualMachineInterfaceModel
 
 
@@ -21,6 +24,22 @@ def test_get_vm_model_by_old_name(database, vm_model):
     assert result is vm_model
 
 
+def test_get_old_name_from_vmfs_path():
+    assert get_old_name_from_vmfs_path('/vmfs/volumes/23c13506-c7f8ba2b/VM1/VM1.vmx') == 'VM1'
+    assert get_old_name_from_vmfs_path('VM1') is None
+    assert get_old_name_from_vmfs_path(None) is None
+    assert get_old_name_from_vmfs_path(object()) is None
+
+
+def test_get_vm_model_by_name_after_rename(database, vm_model):
+    database.save(vm_model)
+    vm_model.rename('VM1-renamed')
+
+    assert database.get_vm_model_by_name('VM1-renamed') is vm_model
+    assert database.get_vm_model_by_name('VM1') is None
+    assert not database.check_consistency()
+
+
 def test_delete_vm_model(database, vm_model):
     database.save(vm_model)
 
@@ -28,6 +47,8 @@ def test_delete_vm_model(database, vm_model):
     result = database.get_vm_model_by_uuid('vmware-vm-uuid-1')
 
     assert result is None
+    assert database.get_vm_model_by_name('VM1') is None
+    assert not database.check_consistency()
 
 
 def test_get_vn_model_by_uuid(database, vn_model_1):
@@ -54,6 +75,7 @@ def test_delete_vn_model(database, vn_model_1):
     database.delete_vn_model('dvportgroup-1')
 
     assert database.get_vn_model_by_key('dvportgroup-1') is None
+    assert database.get_vn_model_by_uuid('vnc-vn-uuid-1') is None
 
 
 def test_get_vmi_model_by_uuid(database, vmi_model):
@@ -73,6 +95,49 @@ def test_delete_vmi_model(database, vmi_model):
     database.delete_vmi_model(uuid)
 
     assert database.get_vmi_model_by_uuid(uuid) is None
+    assert database.get_vmi_models_by_vm_uuid('vmware-vm-uuid-1') == []
+    assert database.get_vmi_models_by_vn_uuid('vnc-vn-uuid-1') == []
+    assert not database.check_consistency()
+
+
+def test_get_vmi_models_by_vm_and_vn_uuid(database, vmi_model, vmi_model_2):
+    database.save(vmi_model)
+    database.save(vmi_model_2)
+
+    assert database.get_vmi_models_by_vm_uuid('vmware-vm-uuid-1') == [vmi_model]
+    assert database.get_vmi_models_by_vn_uuid('vnc-vn-uuid-2') == [vmi_model_2]
+    assert database.get_vmi_models_by_vm_uuid('dummy-uuid') == []
+
+
+def test_vmi_index_follows_vn_change(database, vmi_model, vn_model_2):
+    database.save(vmi_model)
+
+    vmi_model.vn_model = vn_model_2
+    database.save(vmi_model)
+
+    assert database.get_vmi_models_by_vn_uuid('vnc-vn-uuid-1') == []
+    assert database.get_vmi_models_by_vn_uuid('vnc-vn-uuid-2') == [vmi_model]
+    assert not database.check_consistency()
+
+
+def test_check_consistency_detects_stale_index(database, vm_model):
+    database.save(vm_model)
+
+    vm_model.vm_properties['name'] = 'VM1-renamed'
+
+    assert database.check_consistency()
+
+
+def test_clear_database_clears_indexes(database, vm_model, vn_model_1, vmi_model):
+    database.save(vm_model)
+    database.save(vn_model_1)
+    database.save(vmi_model)
+
+    database.clear_database()
+
+    assert database.get_vm_model_by_name('VM1') is None
+    assert database.get_vn_model_by_uuid('vnc-vn-uuid-1') is None
+    assert database.get_vmi_models_by_vm_uuid('vmware-vm-uuid-1') == []
 
 
 def test_is_vlan_available_true(database, vmi_model, vmi_model_2):
@@ -98,3 +163,148 @@ def test_is_vlan_available_same_vmi(database, vmi_model):
     result = database.is_vlan_available(vmi_model, 1)
 
     assert result
+
+
+def test_set_vlan_id_updates_vlan_index(database, vmi_model, vmi_model_2):
+    database.save(vmi_model)
+
+    database.set_vlan_id(vmi_model, 10)
+
+    assert vmi_model.vcenter_port.vlan_id == 10
+    assert database.is_vlan_available(vmi_model_2, 1)
+    assert not database.is_vlan_available(vmi_model_2, 10)
+    assert not database.check_consistency()
+
+
+def test_release_vlan_id(database, vmi_model, vmi_model_2):
+    database.save(vmi_model)
+
+    database.release_vlan_id(vmi_model)
+
+    assert database.is_vlan_available(vmi_model_2, 1)
+
+
+def test_delete_vmi_model_frees_vlan(database, vmi_model, vmi_model_2):
+    database.save(vmi_model)
+
+    database.delete_vmi_model(vmi_model.uuid)
+
+    assert database.is_vlan_available(vmi_model_2, 1)
+
+
+def test_vlan_conflict_is_logged(database, vmi_model, vmi_model_2):
+    database.save(vmi_model)
+    database.save(vmi_model_2)
+
+    with patch('cvm.database.logger') as logger:
+        database.set_vlan_id(vmi_model_2, 1)
+
+    logger.error.assert_called_once()
+    database.release_vlan_id(vmi_model)
+    assert not database.is_vlan_available(vmi_model, 1)
+
+
+def test_snapshot_round_trip(database, vm_model, vn_model_1, vmi_model, tmpdir):
+    vmi_model.vcenter_port.port_key = '10'
+    vmi_model.vcenter_port.vlan_success = True
+    database.save(vm_model)
+    database.save(vn_model_1)
+    database.save(vmi_model)
+    path = str(tmpdir.join('database.snapshot'))
+
+    write_snapshot(path, database.make_snapshot(updates_version='5'))
+    snapshot = read_snapshot(path, max_age=60)
+
+    assert snapshot['updates_version'] == '5'
+    assert snapshot['vms'] == {'vmware-vm-uuid-1': {'name': 'VM1'}}
+    assert snapshot['vmis'][vmi_model.uuid]['vlan_id'] == 1
+    assert snapshot['vmis'][vmi_model.uuid]['vn_uuid'] == vn_model_1.uuid
+    assert not tmpdir.join('database.snapshot.tmp').exists()
+
+
+def test_read_snapshot_rejects_stale_and_foreign_files(database, tmpdir):
+    path = str(tmpdir.join('database.snapshot'))
+    snapshot = database.make_snapshot()
+
+    assert read_snapshot(path, max_age=60) is None
+    write_snapshot(path, dict(snapshot, created_at=snapshot['created_at'] - 120))
+    assert read_snapshot(path, max_age=60) is None
+    write_snapshot(path, dict(snapshot, format=snapshot['format'] + 1))
+    assert read_snapshot(path, max_age=60) is None
+    tmpdir.join('database.snapshot').write('{truncated')
+    assert read_snapshot(path, max_age=60) is None
+
+
+def test_write_snapshot_syncs_directory(database, tmpdir):
+    path = str(tmpdir.join('database.snapshot'))
+
+    with patch('cvm.database.os.fsync') as fsync:
+        write_snapshot(path, database.make_snapshot())
+
+    assert fsync.call_count == 2
+
+
+def test_verify_snapshot_drops_missing_objects(database, vm_model, vm_model_2, vmi_model, vmi_model_2):
+    database.save(vm_model)
+    database.save(vm_model_2)
+    database.save(vmi_model)
+    database.save(vmi_model_2)
+    database.load_snapshot(database.make_snapshot())
+
+    database.verify_snapshot({vm_model.uuid: [vmi_model.uuid]})
+
+    assert database.get_snapshot_vm_uuids() == [vm_model.uuid]
+    assert database.get_snapshot_vmi(vmi_model.uuid) is not None
+    assert database.get_snapshot_vmi(vmi_model_2.uuid) is None
+
+def test_work_set_deduplicates_by_uuid(vmi_model, vmi_model_2):
+    work_set = WorkSet()
+    work_set.append(vmi_model)
+    work_set.append(vmi_model_2)
+    enqueued_at = work_set.get_enqueued_at(vmi_model)
+    duplicate = VirtualMachineInterfaceModel(vmi_model.vm_model, vmi_model.vn_model, vmi_model.vcenter_port)
+
+    work_set += [duplicate, 'port-uuid']
+
+    assert list(work_set) == [duplicate, vmi_model_2, 'port-uuid']
+    assert work_set.get_enqueued_at(duplicate) == enqueued_at
+
+
+def test_work_set_keeps_entry_replaced_during_processing(vmi_model):
+    work_set = WorkSet([vmi_model])
+    processed = work_set.pending()
+    replacement = VirtualMachineInterfaceModel(vmi_model.vm_model, vmi_model.vn_model, vmi_model.vcenter_port)
+    work_set.append(replacement)
+
+    work_set.discard(processed[0])
+
+    assert list(work_set) == [replacement]
+    assert work_set.get_attempts(replacement) == 1
+    work_set.discard(replacement)
+    assert not work_set
+
+
+def test_pending_work_stats(database, vmi_model):
+    database.ports_to_update.append(vmi_model)
+    database.ports_to_update.pending()
+    database.ports_to_update.pending()
+
+    stats = database.get_pending_work_stats()
+
+    size, attempts, age = stats['ports_to_update']
+    assert (size, attempts) == (1, 2)
+    assert age >= 0
+    assert stats['vlans_to_update'] == (0, 0, 0.0)
+
+
+def test_work_set_claims_per_owner(vmi_model, vmi_model_2):
+    work_set = WorkSet([vmi_model, vmi_model_2])
+    work_set.append('port-uuid', owner=vmi_model_2.vm_model.uuid)
+
+    with work_set.claim({vmi_model_2.vm_model.uuid}) as claimed:
+        assert claimed == [vmi_model_2, 'port-uuid']
+        assert work_set.pending() == [vmi_model]
+        work_set.discard('port-uuid')
+
+    assert work_set.pending({vmi_model_2.vm_model.uuid}) == [vmi_model_2]
+    assert work_set.get_attempts(vmi_model_2) == 2
@@ -6,6 +6,7 @@ from pyVmomi import vim  # pylint: disable=no-name-in-module
 @pytest.fixture()
 def vmware_vm_1_updated():
     vmware_vm = Mock(spec=vim.VirtualMachine)
+    vmware_vm.configure_mock(_moId='vm-1')
     vmware_vm.summary.runtime.host.vm = []
     vmware_vm.config.instanceUuid = 'vmware-vm-uuid-1'
     vmware_vm.config.hardware.device = []
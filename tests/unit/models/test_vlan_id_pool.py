@@ -1,6 +1,9 @@
 from builtins import range
 import pytest
 
+from cvm.models import VlanIdPool
+from tests.utils import reserve_vlan_ids
+
 
 def test_reserve(vlan_id_pool):
     vlan_id_pool.reserve(0)
@@ -56,3 +59,71 @@ def test_double_free(vlan_id_pool):
     vlan_id_pool.reserve(5000)
 
     assert vlan_id_pool.is_available(5000) is False
+
+
+def test_freed_ids_are_reused_last(vlan_id_pool):
+    first = vlan_id_pool.get_available()
+    second = vlan_id_pool.get_available()
+
+    vlan_id_pool.free(second)
+    vlan_id_pool.free(first)
+
+    assert vlan_id_pool.get_available() == 2
+    for _ in range(3, 4096):
+        vlan_id_pool.get_available()
+    assert vlan_id_pool.get_available() == second
+    assert vlan_id_pool.get_available() == first
+
+
+def test_reserve_freed_id(vlan_id_pool):
+    vlan_id_pool.get_available()
+    vlan_id_pool.free(0)
+    vlan_id_pool.reserve(0)
+    vlan_id_pool.free(0)
+
+    for _ in range(1, 4096):
+        vlan_id_pool.get_available()
+
+    assert vlan_id_pool.get_available() == 0
+    with pytest.raises(Exception):
+        vlan_id_pool.get_available()
+
+
+def test_free_none(vlan_id_pool):
+    vlan_id_pool.free(None)
+
+    assert vlan_id_pool.is_available(None) is False
+    assert vlan_id_pool.get_available() == 0
+
+
+def test_snapshot_restore(vlan_id_pool):
+    reserve_vlan_ids(vlan_id_pool, [0, 1, 2, 10])
+    vlan_id_pool.free(1)
+    snapshot = vlan_id_pool.snapshot()
+
+    restored = VlanIdPool(0, 4095)
+    restored.restore(snapshot)
+
+    assert restored.snapshot() == snapshot
+    assert restored.is_available(1) is True
+    assert restored.is_available(10) is False
+    assert [restored.get_available() for _ in range(2)] == [3, 4]
+
+
+def test_restore_keeps_lock(vlan_id_pool):
+    snapshot = vlan_id_pool.snapshot()
+    lock = vlan_id_pool._lock
+
+    with lock:
+        vlan_id_pool.restore(snapshot)
+
+    assert vlan_id_pool._lock is lock
+
+
+def test_restore_keeps_configured_range():
+    vlan_id_pool = VlanIdPool(1, 10)
+
+    vlan_id_pool.restore({'start': 1, 'end': 100, 'cursor': 50, 'reserved': [5, 50], 'recycled': [42, 7]})
+
+    assert vlan_id_pool.snapshot() == {'start': 1, 'end': 10, 'cursor': 0, 'reserved': [5], 'recycled': [7]}
+    assert [vlan_id_pool.get_available() for _ in range(2)] == [1, 2]
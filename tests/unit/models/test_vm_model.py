@@ -1,14 +1,20 @@
-from cvm.models import VirtualMachineModel
+import pytest
+
+from cvm.models import PortRecord, VirtualMachineModel
+from tests.utils import create_vm_record
 
 
 def test_init(vmware_vm_1, vm_properties_1):
-    vm_model = VirtualMachineModel(vmware_vm_1, vm_properties_1)
+    vm_model = VirtualMachineModel(create_vm_record(vmware_vm_1, vm_properties_1))
 
-    assert vmware_vm_1.config.hardware.device is vm_model.devices
+    assert [port.port_key for port in vm_model.ports] == ['10']
+    assert vm_model.host_uuid == 'host_uuid_1'
     assert vm_model.uuid == 'vmware-vm-uuid-1'
     assert vm_model.name == 'VM1'
     assert vm_model.is_powered_on
     assert vm_model.tools_running
+    assert vm_model.moref == 'vm-1'
+    assert not hasattr(vm_model, 'vmware_vm')
 
 
 def test_to_vnc(vm_model):
@@ -22,9 +28,9 @@ def test_to_vnc(vm_model):
 
 
 def test_update(vm_model, vmware_vm_1_updated, vm_properties_1_updated):
-    vm_model.update(vmware_vm_1_updated, vm_properties_1_updated)
+    vm_model.update(create_vm_record(vmware_vm_1_updated, vm_properties_1_updated))
 
-    assert vm_model.devices == []
+    assert vm_model.ports == []
     assert vm_model.uuid == 'vmware-vm-uuid-1'
     assert vm_model.name == 'VM1-renamed'
     assert vm_model.is_powered_on is False
@@ -49,3 +55,31 @@ def test_update_tools_running(vm_model):
     assert check_1 is True
     assert check_2 is False
     assert vm_model.tools_running is False
+
+
+def test_vm_properties_are_copied_from_record(vmware_vm_1, vm_properties_1):
+    vm_record = create_vm_record(vmware_vm_1, vm_properties_1)
+    vm_model = VirtualMachineModel(vm_record)
+
+    vm_model.update_power_state('poweredOff')
+
+    assert vm_record.vm_properties['runtime.powerState'] == 'poweredOn'
+
+
+def test_records_are_immutable():
+    port_record = PortRecord(device_key=4000, mac_address='mac-address', port_key='10', portgroup_key='dvportgroup-1')
+
+    with pytest.raises(AttributeError):
+        port_record.port_key = '11'
+    with pytest.raises(AttributeError):
+        port_record.extra = True
+    assert port_record == PortRecord(4000, 'mac-address', '10', 'dvportgroup-1')
+
+
+def test_vm_record_resolves_uuid_and_name(vmware_vm_1, vm_properties_1):
+    vm_record = create_vm_record(vmware_vm_1, vm_properties_1)
+
+    assert (vm_record.moref, vm_record.uuid, vm_record.name) == ('vm-1', 'vmware-vm-uuid-1', 'VM1')
+    assert vm_record == create_vm_record(vmware_vm_1, vm_properties_1)
+    with pytest.raises(AttributeError):
+        vm_record.uuid = 'other-uuid'
@@ -6,7 +6,7 @@ def test_to_vnc(vmi_model, project, security_group):
     vmi_model.parent = project
     vmi_model.security_group = security_group
 
-    vnc_vmi = vmi_model.vnc_vmi
+    vnc_vmi = vmi_model.construct_vnc_vmi()
 
     assert vnc_vmi.name == vmi_model.uuid
     assert vnc_vmi.parent_name == project.name
@@ -50,3 +50,16 @@ def test_create_uuid():
 
     assert uuid_str == '2f269404-b466-3cc7-8817-d9ee99f63187'
     assert uuid_unicode == '2f269404-b466-3cc7-8817-d9ee99f63187'
+
+
+def test_derived_names_follow_renames(vmi_model):
+    uuid = vmi_model.uuid
+    display_name = vmi_model.display_name
+
+    vmi_model.vm_model.rename('VM1-renamed')
+    vmi_model.vcenter_port.mac_address = 'mac-address-2'
+
+    assert display_name != vmi_model.display_name
+    assert vmi_model.display_name.endswith('VM1-renamed')
+    assert uuid != vmi_model.uuid
+    assert vmi_model.uuid == VirtualMachineInterfaceModel.create_uuid('mac-address-2')
@@ -1,8 +1,12 @@
 # pylint: disable=redefined-outer-name
+import gevent
+import gevent.queue
 import pytest
-from mock import Mock
+from mock import Mock, patch
+from pyVmomi import vim  # pylint: disable=no-name-in-module
 
-from cvm.monitors import VMwareMonitor
+from cvm.monitors import VMwareMonitor, shard_update_set
+from tests.utils import create_event, wrap_into_update_set
 
 
 @pytest.fixture()
@@ -31,3 +35,68 @@ def test_pass_update_to_controller(monitor, controller, vm_created_update):
         pass
 
     controller.handle_update.assert_called_once_with(vm_created_update)
+
+
+def test_shard_keeps_vm_events_together(vmware_vm_1, vmware_vm_2):
+    events = [
+        create_event(vim.event.VmCreatedEvent, 1, vmware_vm_1),
+        create_event(vim.event.VmCreatedEvent, 2, vmware_vm_2),
+        create_event(vim.event.VmRemovedEvent, 3, vmware_vm_1),
+    ]
+    update_set = wrap_into_update_set(event=vim.event.Event.Array(events))
+
+    shards = shard_update_set(update_set, 64)
+
+    vm_1_shard = [[change.val for _, change in entries] for entries in shards.values()
+                  if events[0] in [change.val for _, change in entries]][0]
+    assert [event for event in vm_1_shard if event.vm.vm is vmware_vm_1] == [events[0], events[2]]
+
+
+def test_workers_handle_vms_concurrently(vmware_vm_1, vmware_vm_2):
+    handled = []
+    slow_vm_event = create_event(vim.event.VmCreatedEvent, 1, vmware_vm_1)
+    fast_vm_event = create_event(vim.event.VmCreatedEvent, 2, vmware_vm_2)
+
+    def handle_update(update_set):
+        event = update_set.filterSet[0].objectSet[0].changeSet[0].val
+        if event is slow_vm_event:
+            gevent.sleep(0.05)
+        handled.append(event)
+
+    controller = Mock()
+    controller.handle_update.side_effect = handle_update
+    queue = gevent.queue.Queue()
+    queue.put(wrap_into_update_set(event=vim.event.Event.Array([slow_vm_event, fast_vm_event])))
+    monitor = VMwareMonitor(controller, queue, workers=2)
+    with patch('cvm.monitors.hash', side_effect=lambda vm: 0 if vm is vmware_vm_1 else 1, create=True):
+        greenlet = gevent.spawn(monitor.monitor)
+        gevent.sleep(0.1)
+        greenlet.kill()
+
+    assert handled == [fast_vm_event, slow_vm_event]
+
+
+def test_event_without_vm_reference_waits_for_other_workers(vmware_vm_1):
+    handled = []
+    vm_event = create_event(vim.event.VmCreatedEvent, 1, vmware_vm_1)
+    unreferenced_event = create_event(vim.event.VmRemovedEvent, 2, None)
+
+    def handle_update(update_set):
+        events = [object_update.changeSet[0].val for object_update in update_set.filterSet[0].objectSet]
+        if vm_event in events:
+            gevent.sleep(0.05)
+        handled.append(events)
+
+    controller = Mock()
+    controller.handle_update.side_effect = handle_update
+    queue = gevent.queue.Queue()
+    queue.put(wrap_into_update_set(event=vm_event))
+    queue.put(wrap_into_update_set(event=unreferenced_event))
+    monitor = VMwareMonitor(controller, queue, workers=2)
+    with patch('cvm.monitors.hash', side_effect=lambda vm: 1 if vm is vmware_vm_1 else 0, create=True):
+        greenlet = gevent.spawn(monitor.monitor)
+        gevent.sleep(0.1)
+        greenlet.kill()
+
+    assert shard_update_set(wrap_into_update_set(event=unreferenced_event), 2) is None
+    assert handled == [[vm_event], [unreferenced_event]]
@@ -0,0 +1,96 @@
+# pylint: disable=redefined-outer-name
+import os
+
+import gevent
+import pytest
+from mock import Mock, patch
+
+from cvm.clients import PortFileIndex
+from cvm.controllers import SharedLock
+from cvm.monitors import InotifyWatch, PortFileMonitor
+
+
+def wait_for(condition, timeout=2):
+    with gevent.Timeout(timeout):
+        while not condition():
+            gevent.sleep(0.01)
+
+
+def touch(path, name):
+    with open(os.path.join(path, name), 'w'):
+        pass
+
+
+@pytest.fixture()
+def port_dir(tmpdir):
+    touch(str(tmpdir), 'port-uuid-1')
+    tmpdir.mkdir('not-a-port')
+    return str(tmpdir)
+
+
+@pytest.fixture()
+def vrouter_api_client(port_dir):
+    return Mock(port_file_index=PortFileIndex(port_dir))
+
+
+@pytest.fixture()
+def vrouter_port_service():
+    return Mock()
+
+
+@pytest.fixture()
+def port_file_monitor(vrouter_api_client, vrouter_port_service):
+    monitor = PortFileMonitor(vrouter_api_client, vrouter_port_service, SharedLock(), poll_interval=0.01)
+    greenlet = gevent.spawn(monitor.run)
+    yield monitor
+    greenlet.kill()
+
+
+def test_rescan(port_dir):
+    index = PortFileIndex(port_dir)
+
+    assert index.rescan() == set()
+    assert index.get_uuids() == {'port-uuid-1'}
+
+    os.remove(os.path.join(port_dir, 'port-uuid-1'))
+
+    assert index.rescan() == {'port-uuid-1'}
+    assert len(index) == 0
+
+
+def test_rescan_missing_directory(tmpdir):
+    index = PortFileIndex(str(tmpdir.join('ports')))
+
+    assert index.rescan() == set()
+    assert index.get_uuids() == frozenset()
+
+
+def test_watch_port_files(port_file_monitor, port_dir, vrouter_api_client, vrouter_port_service):
+    index = vrouter_api_client.port_file_index
+    wait_for(lambda: index.watched)
+    assert index.get_uuids() == {'port-uuid-1'}
+
+    touch(port_dir, 'port-uuid-2')
+    wait_for(lambda: 'port-uuid-2' in index)
+
+    os.remove(os.path.join(port_dir, 'port-uuid-1'))
+    wait_for(lambda: vrouter_port_service.restore_ports.called)
+
+    vrouter_port_service.restore_ports.assert_called_once_with({'port-uuid-1'})
+    assert index.get_uuids() == {'port-uuid-2'}
+
+
+def test_poll_without_inotify(vrouter_api_client, vrouter_port_service, port_dir):
+    index = vrouter_api_client.port_file_index
+    with patch.object(InotifyWatch, 'open', Mock(return_value=None)):
+        monitor = PortFileMonitor(vrouter_api_client, vrouter_port_service, SharedLock(), poll_interval=0.01)
+        greenlet = gevent.spawn(monitor.run)
+        try:
+            wait_for(lambda: 'port-uuid-1' in index)
+            os.remove(os.path.join(port_dir, 'port-uuid-1'))
+            wait_for(lambda: vrouter_port_service.restore_ports.called)
+        finally:
+            greenlet.kill()
+
+    assert not index.watched
+    vrouter_port_service.restore_ports.assert_called_once_with({'port-uuid-1'})
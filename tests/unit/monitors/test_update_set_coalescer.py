@@ -0,0 +1,124 @@
+# pylint: disable=redefined-outer-name
+import gevent.queue
+import pytest
+from mock import Mock
+from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
+
+from cvm.monitors import UpdateSetCoalescer, VMwareMonitor
+from tests.utils import create_event, wrap_into_update_set
+
+
+def make_reconfigured_event(key, vmware_vm, device_type):
+    event = create_event(vim.event.VmReconfiguredEvent, key, vmware_vm)
+    device_spec = Mock(spec=vim.vm.device.VirtualDeviceSpec(), device=Mock(spec=device_type()))
+    event.configSpec.deviceChange = [device_spec]
+    return event
+
+
+def wrap_into_event_page(events):
+    return wrap_into_update_set(event=vim.event.Event.Array(events))
+
+
+def make_property_update(obj, name, value):
+    change = vmodl.query.PropertyCollector.Change(name=name, val=value, op='assign')
+    return wrap_into_update_set(change=change, obj=obj)
+
+
+def get_changes(update_set):
+    return [(object_update.obj, change.name, change.val)
+            for filter_update in update_set.filterSet
+            for object_update in filter_update.objectSet
+            for change in object_update.changeSet]
+
+
+@pytest.fixture()
+def coalescer():
+    return UpdateSetCoalescer()
+
+
+def test_keeps_latest_property_value(coalescer, vmware_vm_1, vmware_vm_2):
+    update_sets = [
+        make_property_update(vmware_vm_1, 'runtime.powerState', 'poweredOn'),
+        make_property_update(vmware_vm_2, 'runtime.powerState', 'poweredOn'),
+        make_property_update(vmware_vm_1, 'runtime.powerState', 'poweredOff'),
+    ]
+
+    update_set = coalescer.coalesce(update_sets)
+
+    assert get_changes(update_set) == [
+        (vmware_vm_2, 'runtime.powerState', 'poweredOn'),
+        (vmware_vm_1, 'runtime.powerState', 'poweredOff'),
+    ]
+    assert coalescer.dropped_changes == 1
+
+
+def test_keeps_events_in_order(coalescer, vmware_vm_1):
+    created = create_event(vim.event.VmCreatedEvent, 1, vmware_vm_1)
+    removed = create_event(vim.event.VmRemovedEvent, 2, vmware_vm_1)
+    created_again = create_event(vim.event.VmCreatedEvent, 3, vmware_vm_1)
+
+    update_set = coalescer.coalesce([
+        wrap_into_event_page([removed, created]),
+        wrap_into_update_set(event=created_again),
+    ])
+
+    assert [val for _, _, val in get_changes(update_set)] == [created, removed, created_again]
+    assert coalescer.dropped_changes == 0
+
+
+def test_drops_duplicated_events(coalescer, vmware_vm_1):
+    created = create_event(vim.event.VmCreatedEvent, 1, vmware_vm_1)
+
+    update_set = coalescer.coalesce([
+        wrap_into_update_set(event=created),
+        wrap_into_update_set(event=created),
+    ])
+
+    assert [val for _, _, val in get_changes(update_set)] == [created]
+    assert coalescer.dropped_changes == 1
+
+
+def test_collapses_consecutive_reconfigures(coalescer, vmware_vm_1, vmware_vm_2):
+    first = make_reconfigured_event(1, vmware_vm_1, vim.vm.device.VirtualVmxnet3)
+    other_vm = make_reconfigured_event(2, vmware_vm_2, vim.vm.device.VirtualDisk)
+    second = make_reconfigured_event(3, vmware_vm_1, vim.vm.device.VirtualVmxnet3)
+
+    update_set = coalescer.coalesce([wrap_into_event_page([first, other_vm, second])])
+
+    assert [val for _, _, val in get_changes(update_set)] == [other_vm, second]
+    assert coalescer.dropped_changes == 1
+
+
+def test_prefers_reconfigure_with_network_change(coalescer, vmware_vm_1):
+    network_change = make_reconfigured_event(1, vmware_vm_1, vim.vm.device.VirtualVmxnet3)
+    disk_change = make_reconfigured_event(2, vmware_vm_1, vim.vm.device.VirtualDisk)
+
+    update_set = coalescer.coalesce([wrap_into_event_page([network_change, disk_change])])
+
+    assert [val for _, _, val in get_changes(update_set)] == [network_change]
+
+
+def test_does_not_collapse_reconfigures_across_other_events(coalescer, vmware_vm_1):
+    first = make_reconfigured_event(1, vmware_vm_1, vim.vm.device.VirtualVmxnet3)
+    renamed = create_event(vim.event.VmRenamedEvent, 2, vmware_vm_1)
+    second = make_reconfigured_event(3, vmware_vm_1, vim.vm.device.VirtualVmxnet3)
+
+    update_set = coalescer.coalesce([wrap_into_event_page([first, renamed, second])])
+
+    assert [val for _, _, val in get_changes(update_set)] == [first, renamed, second]
+
+
+def test_monitor_coalesces_queued_update_sets(vmware_vm_1):
+    controller = Mock()
+    controller.handle_update.side_effect = StopIteration
+    queue = gevent.queue.Queue()
+    queue.put(make_property_update(vmware_vm_1, 'runtime.powerState', 'poweredOn'))
+    queue.put(make_property_update(vmware_vm_1, 'runtime.powerState', 'poweredOff'))
+    monitor = VMwareMonitor(controller, queue, coalescer=UpdateSetCoalescer())
+
+    with pytest.raises(StopIteration):
+        monitor.monitor()
+
+    update_set = controller.handle_update.call_args[0][0]
+    assert get_changes(update_set) == [(vmware_vm_1, 'runtime.powerState', 'poweredOff')]
+    assert queue.empty()
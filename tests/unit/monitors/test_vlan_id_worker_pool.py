@@ -0,0 +1,123 @@
+# pylint: disable=redefined-outer-name
+import gevent
+import pytest
+from mock import Mock
+
+from cvm.monitors import VlanIdWorkerPool
+
+
+@pytest.fixture()
+def vlan_id_service():
+    service = Mock()
+    service.set_vcenter_vlans.return_value = []
+    service.restore_vcenter_vlans.return_value = []
+    return service
+
+
+def run_pool(pool):
+    greenlet = gevent.spawn(pool.run)
+    gevent.sleep(0.01)
+    greenlet.kill()
+
+
+def make_vmi_model(uuid):
+    return Mock(uuid=uuid)
+
+
+def test_update_in_batch(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=2)
+    vmi_models = [make_vmi_model('vmi-1'), make_vmi_model('vmi-2')]
+
+    pool.submit_update(vmi_models)
+    assert pool.get_stats()['queue_depth'] == 2
+    run_pool(pool)
+
+    vlan_id_service.set_vcenter_vlans.assert_called_once_with(vmi_models)
+    stats = pool.get_stats()
+    assert stats['queue_depth'] == 0
+    assert stats['in_flight'] == 0
+    assert stats['completed'] == 2
+
+
+def test_same_vmi_keeps_order(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=2)
+    vmi_model = make_vmi_model('vmi-1')
+    calls = []
+    vlan_id_service.set_vcenter_vlans.side_effect = lambda vmi_models: calls.append('update') or []
+    vlan_id_service.restore_vcenter_vlans.side_effect = lambda vmi_models: calls.append('restore') or []
+
+    pool.submit_update([vmi_model])
+    pool.submit_restore([vmi_model])
+    run_pool(pool)
+
+    assert calls == ['update', 'restore']
+
+
+def test_retry_with_backoff(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=1, retry_limit=3, backoff=0)
+    vmi_model = make_vmi_model('vmi-1')
+    vlan_id_service.set_vcenter_vlans.side_effect = [[vmi_model], Exception('vCenter task failed'), []]
+
+    pool.submit_update([vmi_model])
+    run_pool(pool)
+
+    assert vlan_id_service.set_vcenter_vlans.call_count == 3
+    stats = pool.get_stats()
+    assert stats['retried'] == 2
+    assert stats['completed'] == 1
+    assert stats['failed'] == 0
+
+
+def test_retry_failed_restore(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=1, retry_limit=3, backoff=0)
+    vmi_model = make_vmi_model('vmi-1')
+    vlan_id_service.restore_vcenter_vlans.side_effect = [[vmi_model], []]
+
+    pool.submit_restore([vmi_model])
+    run_pool(pool)
+
+    assert vlan_id_service.restore_vcenter_vlans.call_count == 2
+    assert pool.get_stats()['retried'] == 1
+
+
+def test_give_up_after_retry_limit(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=1, retry_limit=2, backoff=0)
+    vmi_model = make_vmi_model('vmi-1')
+    vlan_id_service.set_vcenter_vlans.return_value = [vmi_model]
+
+    pool.submit_update([vmi_model])
+    run_pool(pool)
+
+    assert vlan_id_service.set_vcenter_vlans.call_count == 2
+    assert pool.get_stats()['failed'] == 1
+
+
+def test_newer_task_supersedes_delayed_retry(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=1, retry_limit=3, backoff=0.05)
+    vmi_model = make_vmi_model('vmi-1')
+    calls = []
+    vlan_id_service.set_vcenter_vlans.side_effect = lambda vmi_models: calls.append('update') or vmi_models
+    vlan_id_service.restore_vcenter_vlans.side_effect = lambda vmi_models: calls.append('restore') or []
+
+    greenlet = gevent.spawn(pool.run)
+    pool.submit_update([vmi_model])
+    gevent.sleep(0.01)
+    pool.submit_restore([vmi_model])
+    gevent.sleep(0.1)
+    greenlet.kill()
+
+    assert calls == ['update', 'restore']
+    assert pool.get_stats()['queue_depth'] == 0
+
+
+def test_other_vmis_are_taken_past_busy_one(vlan_id_service):
+    pool = VlanIdWorkerPool(vlan_id_service, size=1, batch_size=2)
+    vmi_model_1, vmi_model_2 = make_vmi_model('vmi-1'), make_vmi_model('vmi-2')
+
+    pool.submit_update([vmi_model_1])
+    pool.submit_restore([vmi_model_1])
+    pool.submit_update([vmi_model_2])
+    run_pool(pool)
+
+    vlan_id_service.set_vcenter_vlans.assert_called_once_with([vmi_model_1, vmi_model_2])
+    vlan_id_service.restore_vcenter_vlans.assert_called_once_with([vmi_model_1])
@@ -52,6 +52,17 @@ def test_true(vrouter_port_service, database, vrouter_api_client, vmi_model, vro
 
     vrouter_port_service.sync_ports()
 
+    vrouter_api_client.delete_port.assert_not_called()
+    vrouter_api_client.add_port.assert_called_once_with(vmi_model)
+
+
+def test_identity_changed(vrouter_port_service, database, vrouter_api_client, vmi_model, vrouter_response):
+    database.ports_to_update.append(vmi_model)
+    vrouter_response['vn-id'] = 'd0f7a1a4-1f3e-4cbb-8d9e-2f1c8b2ad9f0'
+    vrouter_api_client.read_port.return_value = vrouter_response
+
+    vrouter_port_service.sync_ports()
+
     vrouter_api_client.delete_port.assert_called_once_with(vmi_model.uuid)
     vrouter_api_client.add_port.assert_called_once_with(vmi_model)
 
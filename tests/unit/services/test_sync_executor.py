@@ -0,0 +1,98 @@
+import traceback
+
+import gevent
+import pytest
+
+from cvm import exceptions
+from cvm.services import SyncExecutor
+
+
+def test_map_respects_backend_limit():
+    executor = SyncExecutor(pool_size=16, backend_limits={'vrouter': 2})
+    running = []
+    max_running = []
+
+    def work(_):
+        running.append(1)
+        max_running.append(len(running))
+        gevent.sleep(0.001)
+        running.pop()
+
+    executor.map(work, range(10), backend='vrouter')
+
+    assert max(max_running) == 2
+
+
+def test_map_runs_items_concurrently():
+    executor = SyncExecutor(pool_size=8, backend_limits={'vnc': 8})
+    finished = []
+
+    def work(item):
+        gevent.sleep(0.05)
+        finished.append(item)
+
+    start = gevent.get_hub().loop.now()
+    executor.map(work, range(8), backend='vnc')
+
+    assert sorted(finished) == list(range(8))
+    assert gevent.get_hub().loop.now() - start < 0.3
+
+
+def test_map_reraises_cvm_error():
+    executor = SyncExecutor(pool_size=4)
+
+    def work(item):
+        if item == 2:
+            raise exceptions.CVMError('Bad things happened')
+
+    with pytest.raises(exceptions.CVMError):
+        executor.map(work, range(4), backend='vnc')
+
+
+def test_backend_limit_holds_across_concurrent_maps():
+    executor = SyncExecutor(pool_size=16, backend_limits={'vcenter': 2})
+    running = []
+    max_running = []
+
+    def work(_):
+        running.append(1)
+        max_running.append(len(running))
+        gevent.sleep(0.001)
+        running.pop()
+
+    gevent.joinall([gevent.spawn(executor.map, work, range(4), 'vcenter') for _ in range(3)], raise_error=True)
+
+    assert max(max_running) == 2
+
+
+def test_nested_map_shares_slot_of_outer_item():
+    executor = SyncExecutor(pool_size=16, backend_limits={'vnc': 1})
+    finished = []
+
+    def work(item):
+        executor.map(finished.append, [item * 10, item * 10 + 1], backend='vnc')
+
+    with gevent.Timeout(1):
+        executor.map(work, range(2), backend='vnc')
+
+    assert finished == [0, 1, 10, 11]
+
+
+def test_map_keeps_original_traceback():
+    executor = SyncExecutor(pool_size=4)
+
+    def fail(item):
+        raise ValueError(item)
+
+    with pytest.raises(ValueError) as exc_info:
+        executor.map(fail, range(4), backend='vnc')
+
+    assert traceback.extract_tb(exc_info.tb)[-1][2] == 'fail'
+
+def test_phase_records_time():
+    executor = SyncExecutor()
+
+    with executor.phase('update_vmis'):
+        gevent.sleep(0.01)
+
+    assert executor.phase_times['update_vmis'] >= 0.01
@@ -1,5 +1,7 @@
 import pytest
+from mock import Mock, patch
 
+from cvm.services import VlanIdService
 from tests.utils import reserve_vlan_ids
 
 
@@ -59,3 +61,109 @@ def test_restore_vlan_id(vlan_id_service, database, vcenter_api_client,
         vmi_model.vcenter_port)
     assert vlan_id_pool.is_available(20)
     assert not database.vlans_to_restore
+
+
+def test_failed_restore_keeps_vlan_id(vlan_id_service, database, vcenter_api_client,
+                                     vlan_id_pool, vmi_model):
+    reserve_vlan_ids(vlan_id_pool, [20])
+    database.vlans_to_restore.append(vmi_model)
+    vmi_model.vcenter_port.vlan_id = 20
+    vcenter_api_client.restore_vlan_id.return_value = 'error', 'Task failed'
+
+    vlan_id_service.update_vlan_ids()
+
+    assert vlan_id_pool.is_available(20) is False
+    assert vmi_model.vcenter_port.vlan_id == 20
+    assert vmi_model in database.vlans_to_restore
+
+
+def test_vlan_ids_set_in_batch(vlan_id_service, database, vcenter_api_client, vmi_model, vmi_model_2):
+    vmi_model.vcenter_port.vlan_success = False
+    vmi_model_2.vcenter_port.vlan_success = False
+    vmi_model_2.vm_model = vmi_model.vm_model
+    database.vlans_to_update.extend([vmi_model, vmi_model_2])
+    vcenter_api_client.get_vlan_ids.side_effect = None
+    vcenter_api_client.get_vlan_ids.return_value = {vmi_model.vcenter_port.port_key: None,
+                                                    vmi_model_2.vcenter_port.port_key: None}
+    vcenter_api_client.set_vlan_ids.side_effect = None
+    vcenter_api_client.set_vlan_ids.return_value = {vmi_model.vcenter_port.port_key: ('success', None),
+                                                    vmi_model_2.vcenter_port.port_key: ('error', 'failed')}
+
+    vlan_id_service.update_vlan_ids()
+
+    vcenter_api_client.get_vlan_ids.assert_called_once()
+    assert vcenter_api_client.set_vlan_ids.call_args_list[0][0][0] == [vmi_model.vcenter_port,
+                                                                       vmi_model_2.vcenter_port]
+    assert vcenter_api_client.set_vlan_ids.call_args_list[1][0][0] == [vmi_model_2.vcenter_port]
+    assert vmi_model.vcenter_port.vlan_success is True
+    assert vmi_model_2.vcenter_port.vlan_success is False
+    assert not database.vlans_to_update
+
+
+def make_device(key, connected):
+    device = Mock(key=key)
+    device.connectable.connected = connected
+    return device
+
+
+def test_wait_for_ports_ready(service_kwargs, esxi_api_client, vcenter_api_client, vmi_model):
+    vlan_id_service = VlanIdService(**service_kwargs)
+    vm_moref = vmi_model.vm_model.moref
+    vmi_model.vcenter_port.device_key = 4000
+    watcher = esxi_api_client.create_property_watcher.return_value
+    watcher.wait.side_effect = [
+        [(vm_moref, {'config.hardware.device': [make_device(4000, False)]})],
+        [(vm_moref, {'config.hardware.device': [make_device(4000, True)]})],
+    ]
+    esxi_api_client.read_host_uuid.return_value = 'host-uuid'
+    vcenter_api_client.get_proxy_host_uuids.return_value = {vmi_model.vcenter_port.port_key: 'host-uuid'}
+
+    ready = vlan_id_service._wait_for_ports_ready([vmi_model])
+
+    assert ready == [vmi_model]
+    assert watcher.wait.call_count == 2
+    vcenter_api_client.get_proxy_host_uuids.assert_called_once()
+    watcher.destroy.assert_called_once()
+
+
+def test_wait_for_ports_ready_timeout(service_kwargs, esxi_api_client, vcenter_api_client, vmi_model):
+    vlan_id_service = VlanIdService(**service_kwargs)
+    vmi_model.vcenter_port.device_key = 4000
+    watcher = esxi_api_client.create_property_watcher.return_value
+    watcher.wait.return_value = [(vmi_model.vm_model.moref, {'config.hardware.device': [make_device(4000, True)]})]
+    esxi_api_client.read_host_uuid.return_value = 'host-uuid'
+    vcenter_api_client.get_proxy_host_uuids.return_value = {vmi_model.vcenter_port.port_key: 'other-host-uuid'}
+
+    with patch('cvm.services.WAIT_FOR_PORT_TIMEOUT', 0):
+        ready = vlan_id_service._wait_for_ports_ready([vmi_model])
+
+    assert ready == []
+    watcher.destroy.assert_called_once()
+
+
+def test_deferred_vcenter_update(vlan_id_service, database, vcenter_api_client, vlan_id_pool, vmi_model):
+    worker_pool = Mock()
+    vlan_id_service.defer_vcenter_updates(worker_pool)
+    vmi_model.vcenter_port.vlan_success = False
+    database.vlans_to_update.append(vmi_model)
+    reserve_vlan_ids(vlan_id_pool, [0, 1])
+    vcenter_api_client.get_vlan_id.return_value = None
+
+    vlan_id_service.update_vlan_ids()
+
+    assert vmi_model.vcenter_port.vlan_id == 2
+    worker_pool.submit_update.assert_called_once_with([vmi_model])
+    vcenter_api_client.set_vlan_ids.assert_not_called()
+    assert not database.vlans_to_update
+
+
+def test_deferred_restore(vlan_id_service, database, vcenter_api_client, vmi_model):
+    worker_pool = Mock()
+    vlan_id_service.defer_vcenter_updates(worker_pool)
+    database.vlans_to_restore.append(vmi_model)
+
+    vlan_id_service.update_vlan_ids()
+
+    worker_pool.submit_restore.assert_called_once_with([vmi_model])
+    vcenter_api_client.restore_vlan_ids.assert_not_called()
+    assert not database.vlans_to_restore
@@ -1,8 +1,8 @@
 from mock import Mock
 
 from cvm.constants import VM_UPDATE_FILTERS
-from cvm.models import VirtualMachineModel
-from tests.utils import assert_vm_model_state, create_property_filter
+from cvm.models import VirtualMachineModel, make_vm_record
+from tests.utils import assert_vm_model_state, create_property_filter, create_vm_record
 
 
 def test_update_new_vm(vm_service, database, vnc_api_client, vmware_vm_1):
@@ -41,7 +41,7 @@ def test_destroy_property_filter(vm_service, database):
     vm_model.destroy_property_filter.assert_called_once()
 
 
-def test_update_existing_vm(vm_service, database, vnc_api_client, vmware_vm_1, vm_properties_1):
+def test_update_existing_vm(vm_service, database, esxi_api_client, vnc_api_client, vmware_vm_1):
     old_vm_model = Mock(uuid='vmware-vm-uuid-1', vmi_models=[], spec=VirtualMachineModel)
     database.save(old_vm_model)
 
@@ -49,17 +49,17 @@ def test_update_existing_vm(vm_service, database, vnc_api_client, vmware_vm_1, v
 
     new_vm_model = database.get_vm_model_by_uuid('vmware-vm-uuid-1')
     assert new_vm_model is old_vm_model
-    old_vm_model.update.assert_called_once_with(vmware_vm_1, vm_properties_1)
+    old_vm_model.update.assert_called_once_with(esxi_api_client.read_vm_record.return_value)
     vnc_api_client.update_vm.assert_not_called()
 
 
-def test_sync_vms(vm_service, database, esxi_api_client, vnc_api_client, vmware_vm_1):
-    esxi_api_client.get_all_vms.return_value = [vmware_vm_1]
+def test_sync_vms(vm_service, database, esxi_api_client, vnc_api_client, vmware_vm_1, vm_properties_1):
+    esxi_api_client.read_vm_inventory.return_value = [create_vm_record(vmware_vm_1, vm_properties_1)]
 
     vm_service.get_vms_from_vmware()
 
     vm_model = database.get_vm_model_by_uuid('vmware-vm-uuid-1')
-    assert vm_model.devices == vmware_vm_1.config.hardware.device
+    assert [port.mac_address for port in vm_model.ports] == ['mac-address']
     assert_vm_model_state(
         vm_model=vm_model,
         uuid='vmware-vm-uuid-1',
@@ -68,13 +68,19 @@ def test_sync_vms(vm_service, database, esxi_api_client, vnc_api_client, vmware_
     vnc_api_client.update_vm.assert_called_once()
 
 
-def test_sync_no_uuid_vm(vm_service, database, esxi_api_client, vnc_api_client, vmware_vm_1, vmware_vm_no_uuid):
-    esxi_api_client.get_all_vms.return_value = [vmware_vm_1, vmware_vm_no_uuid]
+def test_sync_no_uuid_vm(vm_service, database, esxi_api_client, vnc_api_client, vmware_vm_1, vmware_vm_no_uuid,
+                         vm_properties_1):
+    no_uuid_properties = dict(vm_properties_1)
+    del no_uuid_properties['config.instanceUuid']
+    esxi_api_client.read_vm_inventory.return_value = [
+        create_vm_record(vmware_vm_1, vm_properties_1),
+        make_vm_record(vmware_vm_no_uuid, no_uuid_properties, []),
+    ]
 
     vm_service.get_vms_from_vmware()
 
     vm_model = database.get_vm_model_by_uuid('vmware-vm-uuid-1')
-    assert vm_model.devices == vmware_vm_1.config.hardware.device
+    assert [port.mac_address for port in vm_model.ports] == ['mac-address']
     assert_vm_model_state(
         vm_model=vm_model,
         uuid='vmware-vm-uuid-1',
@@ -85,7 +91,7 @@ def test_sync_no_uuid_vm(vm_service, database, esxi_api_client, vnc_api_client,
 
 def test_sync_no_vms(vm_service, database, esxi_api_client, vnc_api_client):
     """ Syncing when there's no VMware VMs doesn't update anything. """
-    esxi_api_client.get_all_vms.return_value = []
+    esxi_api_client.read_vm_inventory.return_value = []
     vnc_api_client.get_all_vms.return_value = []
 
     vm_service.get_vms_from_vmware()
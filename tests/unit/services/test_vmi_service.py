@@ -1,3 +1,6 @@
+from tests.utils import create_vm_record
+
+
 def test_create_vmis_proper_dpg(vmi_service, database, vnc_api_client, vm_model, vmi_model, vn_model_1, vn_model_2):
     """ A new VMI is being created with proper DPG. """
     vmi_model.vcenter_port.portgroup_key = 'dvportgroup-1'
@@ -12,8 +15,9 @@ def test_create_vmis_proper_dpg(vmi_service, database, vnc_api_client, vm_model,
     assert vmi_model.vn_model == vn_model_1
     assert vmi_model in database.ports_to_update
     assert vmi_model in database.vlans_to_update
-    assert 'vnc-vn-uuid-1' in [ref['uuid'] for ref in vmi_model.vnc_vmi.get_virtual_network_refs()]
     vnc_api_client.update_vmi.assert_called_once()
+    vnc_vmi = vnc_api_client.update_vmi.call_args[0][0]
+    assert 'vnc-vn-uuid-1' in [ref['uuid'] for ref in vnc_vmi.get_virtual_network_refs()]
 
 
 def test_no_update_for_no_dpgs(vmi_service, database, vnc_api_client, vm_model):
@@ -28,13 +32,13 @@ def test_no_update_for_no_dpgs(vmi_service, database, vnc_api_client, vm_model):
 
 
 def test_update_existing_vmi(vmi_service, database, vnc_api_client, vmi_model, vm_model,
-                             vn_model_1, vn_model_2, vmware_vm_1_updated):
+                             vn_model_1, vn_model_2, vmware_vm_1_updated, vm_properties_1):
     """ Existing VMI is updated when VM changes the DPG to which it is connected. """
     database.save(vm_model)
     database.save(vn_model_1)
     database.save(vn_model_2)
     database.save(vmi_model)
-    vm_model.update_interfaces(vmware_vm_1_updated)
+    vm_model.update_interfaces(create_vm_record(vmware_vm_1_updated, vm_properties_1))
     new_vmi_model = vm_model.vmi_models[0]
     database.vmis_to_update.append(new_vmi_model)
 
@@ -43,10 +47,11 @@ def test_update_existing_vmi(vmi_service, database, vnc_api_client, vmi_model, v
     assert database.get_all_vmi_models() == [new_vmi_model]
     assert new_vmi_model.vm_model == vm_model
     assert new_vmi_model.vn_model == vn_model_2
-    assert 'vnc-vn-uuid-2' in [ref['uuid'] for ref in new_vmi_model.vnc_vmi.get_virtual_network_refs()]
-    assert 'vnc-vn-uuid-1' not in [ref['uuid'] for ref in new_vmi_model.vnc_vmi.get_virtual_network_refs()]
     assert new_vmi_model in database.ports_to_update
     vnc_api_client.update_vmi.assert_called_once()
+    vnc_vmi = vnc_api_client.update_vmi.call_args[0][0]
+    assert 'vnc-vn-uuid-2' in [ref['uuid'] for ref in vnc_vmi.get_virtual_network_refs()]
+    assert 'vnc-vn-uuid-1' not in [ref['uuid'] for ref in vnc_vmi.get_virtual_network_refs()]
 
 
 def test_sync_vmis(vmi_service, database, vnc_api_client, vm_model, vn_model_1):
@@ -156,3 +161,19 @@ def test_update_instance_ip(vmi_service, database, vnc_api_client, vmi_model):
 
     assert vmi_model.vnc_instance_ip is not None
     vnc_api_client.create_and_read_instance_ip.assert_called_once_with(vmi_model)
+
+
+def test_delete_unused_vmis_in_vnc(vmi_service, database, vnc_api_client, vm_model, vm_model_2):
+    database.save(vm_model)
+    database.save(vm_model_2)
+    vmi_uuid = vm_model.vmi_models[0].uuid
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.return_value = {
+        vm_model.uuid: [vmi_uuid, 'stale-vmi-uuid'],
+        vm_model_2.uuid: [],
+    }
+
+    vmi_service.delete_unused_vmis_in_vnc()
+
+    vnc_api_client.get_vmi_uuids_by_vm_uuids.assert_called_once()
+    vnc_api_client.get_vmi_uuids_by_vm_uuid.assert_not_called()
+    vnc_api_client.delete_vmi.assert_called_once_with('stale-vmi-uuid')
@@ -1,9 +1,10 @@
 from cvm.constants import VNC_ROOT_DOMAIN, VNC_VCENTER_PROJECT
+from cvm.database import WorkSet
 from tests.utils import assert_vn_model_state
 
 
 def test_update_vns_no_vns(vn_service, database, vcenter_api_client, vnc_api_client):
-    database.vmis_to_update = []
+    database.vmis_to_update = WorkSet()
 
     vn_service.update_vns()
 
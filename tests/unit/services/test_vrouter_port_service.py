@@ -1,7 +1,15 @@
+import gevent
+import pytest
 from mock import Mock, patch
 
+from cvm.constants import (PORT_CHANGE_CREATE, PORT_CHANGE_IDENTITY, PORT_CHANGE_IP,
+                           PORT_CHANGE_VLAN, PORT_CHANGE_IP_AND_VLAN)
+from cvm.clients import PortStateCache
+from cvm.models import VirtualMachineInterfaceModel
+from cvm.services import SyncExecutor, VRouterPortService
 
-@patch('cvm.services.VRouterPortService._port_needs_an_update', Mock(return_value=True))
+
+@patch('cvm.services.VRouterPortService._classify_port_change', Mock(return_value=PORT_CHANGE_CREATE))
 def test_create_port(vrouter_port_service, database, vrouter_api_client, vmi_model):
     database.ports_to_update.append(vmi_model)
 
@@ -12,7 +20,7 @@ def test_create_port(vrouter_port_service, database, vrouter_api_client, vmi_mod
     vrouter_api_client.enable_port.assert_called_once_with(vmi_model.uuid)
 
 
-@patch('cvm.services.VRouterPortService._port_needs_an_update', Mock(return_value=False))
+@patch('cvm.services.VRouterPortService._classify_port_change', Mock(return_value=None))
 def test_no_update(vrouter_port_service, database, vrouter_api_client, vmi_model):
     vrouter_api_client.read_port.return_value = {'dummy': 'dummy-value'}
     database.ports_to_update.append(vmi_model)
@@ -24,6 +32,43 @@ def test_no_update(vrouter_port_service, database, vrouter_api_client, vmi_model
     assert database.ports_to_update == []
 
 
+@patch('cvm.services.VRouterPortService._classify_port_change', Mock(return_value=PORT_CHANGE_CREATE))
+def test_sync_ports_of_other_vm_concurrently(vrouter_port_service, database, vrouter_api_client, vmi_model,
+                                             vmi_model_2):
+    added = []
+
+    def add_port(vmi):
+        if vmi is vmi_model:
+            gevent.sleep(0.05)
+        added.append(vmi)
+
+    vrouter_api_client.add_port.side_effect = add_port
+    vrouter_port_service.use_sync_executor(SyncExecutor())
+    database.ports_to_update.append(vmi_model)
+    database.ports_to_update.append(vmi_model_2)
+
+    slow = gevent.spawn(vrouter_port_service.sync_ports, {vmi_model.vm_model.uuid})
+    gevent.sleep(0)
+    fast = gevent.spawn(vrouter_port_service.sync_ports, {vmi_model_2.vm_model.uuid})
+    gevent.joinall([slow, fast], raise_error=True)
+
+    assert added == [vmi_model_2, vmi_model]
+    assert database.ports_to_update == []
+
+
+@patch('cvm.services.VRouterPortService._classify_port_change', Mock(return_value=PORT_CHANGE_CREATE))
+def test_create_port_of_powered_off_vm(vrouter_port_service, database, vrouter_api_client, vmi_model):
+    vmi_model.vm_model.update_power_state('poweredOff')
+    database.ports_to_update.append(vmi_model)
+
+    vrouter_port_service.sync_ports()
+
+    vrouter_api_client.add_port.assert_called_once_with(vmi_model)
+    vrouter_api_client.enable_port.assert_not_called()
+    vrouter_api_client.disable_port.assert_not_called()
+    assert database.ports_to_update == []
+
+
 def test_delete_port(vrouter_port_service, database, vrouter_api_client):
     database.ports_to_delete.append('port-uuid')
 
@@ -32,7 +77,7 @@ def test_delete_port(vrouter_port_service, database, vrouter_api_client):
     vrouter_api_client.delete_port.assert_called_once_with('port-uuid')
 
 
-@patch('cvm.services.VRouterPortService._port_needs_an_update', Mock(return_value=False))
+@patch('cvm.services.VRouterPortService._classify_port_change', Mock(return_value=None))
 def test_enable_port(vrouter_port_service, database, vrouter_api_client, vmi_model):
     vmi_model.vm_model.update_power_state = True
     database.ports_to_update.append(vmi_model)
@@ -43,7 +88,7 @@ def test_enable_port(vrouter_port_service, database, vrouter_api_client, vmi_mod
     vrouter_api_client.disable_port.assert_not_called()
 
 
-@patch('cvm.services.VRouterPortService._port_needs_an_update', Mock(return_value=False))
+@patch('cvm.services.VRouterPortService._classify_port_change', Mock(return_value=None))
 def test_disable_port(vrouter_port_service, database, vrouter_api_client, vmi_model):
     vmi_model.vm_model.update_power_state = False
     database.ports_to_update.append(vmi_model)
@@ -52,3 +97,132 @@ def test_disable_port(vrouter_port_service, database, vrouter_api_client, vmi_mo
 
     vrouter_api_client.enable_port.assert_called_once_with(vmi_model.uuid)
     vrouter_api_client.disable_port.assert_not_called()
+
+
+@patch('cvm.services.VRouterPortService._classify_port_change',
+       Mock(side_effect=lambda vrouter_port, _: None if vrouter_port else PORT_CHANGE_CREATE))
+def test_update_ports_from_listing(vrouter_port_service, database, vrouter_api_client, vmi_model, vmi_model_2):
+    vrouter_api_client.read_all_ports.return_value = {vmi_model.uuid: {'dummy': 'dummy-value'}}
+    database.ports_to_update.extend([vmi_model, vmi_model_2])
+
+    vrouter_port_service.sync_ports()
+
+    vrouter_api_client.read_port.assert_not_called()
+    vrouter_api_client.add_port.assert_called_once_with(vmi_model_2)
+
+
+def test_update_ports_listing_not_supported(vrouter_port_service, database, vrouter_api_client, vmi_model, vmi_model_2):
+    database.ports_to_update.extend([vmi_model, vmi_model_2])
+
+    vrouter_port_service.sync_ports()
+
+    assert vrouter_api_client.read_port.call_count == 2
+    assert vrouter_api_client.add_port.call_count == 2
+
+
+def test_restore_ports(vrouter_port_service, database, vrouter_api_client, vmi_model, vmi_model_2):
+    database.save(vmi_model)
+    database.save(vmi_model_2)
+    vrouter_api_client.port_file_exists.side_effect = lambda uuid: uuid == vmi_model_2.uuid
+
+    vrouter_port_service.restore_ports({vmi_model.uuid, vmi_model_2.uuid, 'unknown-uuid'})
+
+    vrouter_api_client.add_port.assert_called_once_with(vmi_model)
+
+
+def make_vrouter_port(vmi_model, **changes):
+    vrouter_port = {
+        'instance-id': vmi_model.vm_model.uuid,
+        'vn-id': vmi_model.vn_model.uuid,
+        'rx-vlan-id': vmi_model.vcenter_port.vlan_id,
+        'tx-vlan-id': vmi_model.vcenter_port.vlan_id,
+        'ip-address': '192.168.100.5',
+    }
+    vrouter_port.update(changes)
+    return vrouter_port
+
+
+@pytest.mark.parametrize('changes, expected', [
+    ({}, None),
+    ({'ip-address': '192.168.100.6'}, PORT_CHANGE_IP),
+    ({'rx-vlan-id': 7, 'tx-vlan-id': 7}, PORT_CHANGE_VLAN),
+    ({'ip-address': '192.168.100.6', 'tx-vlan-id': 7}, PORT_CHANGE_IP_AND_VLAN),
+    ({'vn-id': 'other-vn-uuid', 'ip-address': '192.168.100.6'}, PORT_CHANGE_IDENTITY),
+    ({'instance-id': 'other-vm-uuid'}, PORT_CHANGE_IDENTITY),
+])
+def test_classify_port_change(vmi_model, changes, expected):
+    vmi_model.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+
+    assert VRouterPortService._classify_port_change(make_vrouter_port(vmi_model, **changes), vmi_model) == expected
+
+
+def test_classify_missing_port(vmi_model):
+    assert VRouterPortService._classify_port_change(None, vmi_model) == PORT_CHANGE_CREATE
+
+
+def test_reconcile_ports(vrouter_port_service, database, vrouter_api_client, vmi_model, vmi_model_2):
+    vmi_model.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+    vmi_model_2.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+    vrouter_api_client.read_all_ports.return_value = {
+        vmi_model.uuid: make_vrouter_port(vmi_model, **{'rx-vlan-id': 7, 'tx-vlan-id': 7}),
+        vmi_model_2.uuid: make_vrouter_port(vmi_model_2, **{'vn-id': 'other-vn-uuid'}),
+    }
+    database.ports_to_update.extend([vmi_model, vmi_model_2])
+
+    vrouter_port_service.sync_ports()
+
+    vrouter_api_client.delete_port.assert_called_once_with(vmi_model_2.uuid)
+    assert [call[0][0] for call in vrouter_api_client.add_port.call_args_list] == [vmi_model, vmi_model_2]
+    assert vrouter_port_service.port_change_counts == {PORT_CHANGE_VLAN: 1, PORT_CHANGE_IDENTITY: 1}
+
+
+def test_update_cached_ports_without_agent_reads(vrouter_port_service, database, vrouter_api_client, vmi_model,
+                                                  vmi_model_2):
+    vmi_model.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+    vmi_model_2.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+    vrouter_api_client.port_state_cache = PortStateCache(verify_interval=60)
+    vrouter_api_client.port_state_cache.record(vmi_model.uuid, make_vrouter_port(vmi_model))
+    vrouter_api_client.port_state_cache.record(vmi_model_2.uuid, make_vrouter_port(vmi_model_2, **{'rx-vlan-id': 7}))
+    database.ports_to_update.extend([vmi_model, vmi_model_2])
+
+    vrouter_port_service.sync_ports()
+
+    vrouter_api_client.read_port.assert_not_called()
+    vrouter_api_client.read_all_ports.assert_not_called()
+    vrouter_api_client.delete_port.assert_not_called()
+    vrouter_api_client.add_port.assert_called_once_with(vmi_model_2)
+
+
+def test_verified_ports_are_cached(vrouter_port_service, database, vrouter_api_client, vmi_model):
+    vmi_model.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+    vrouter_api_client.port_state_cache = PortStateCache(verify_interval=60)
+    vrouter_api_client.read_port.return_value = make_vrouter_port(vmi_model)
+
+    database.ports_to_update.append(vmi_model)
+    vrouter_port_service.sync_ports()
+    database.ports_to_update.append(vmi_model)
+    vrouter_port_service.sync_ports()
+
+    vrouter_api_client.read_port.assert_called_once_with(vmi_model.uuid)
+
+
+def test_agent_restart_drops_cached_ports(vrouter_port_service, database, vrouter_api_client, vmi_model, vmi_model_2,
+                                          vm_model, vn_model_1):
+    vmi_model_3 = VirtualMachineInterfaceModel(
+        vm_model, vn_model_1, Mock(mac_address='mac-address-3', portgroup_key='dvportgroup-1', vlan_id=3))
+    for model in (vmi_model, vmi_model_2, vmi_model_3):
+        model.vnc_instance_ip = Mock(instance_ip_address='192.168.100.5')
+    port_state_cache = vrouter_api_client.port_state_cache = PortStateCache(verify_interval=60)
+    port_state_cache.record(vmi_model.uuid, make_vrouter_port(vmi_model))
+
+    def read_all_ports():
+        # The restarted agent lost every port
+        port_state_cache.invalidate()
+        return {}
+
+    vrouter_api_client.read_all_ports.side_effect = read_all_ports
+    database.ports_to_update.extend([vmi_model, vmi_model_2, vmi_model_3])
+
+    vrouter_port_service.sync_ports()
+
+    assert vrouter_api_client.add_port.call_count == 3
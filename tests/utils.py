@@ -3,6 +3,7 @@ from mock import Mock
 from pyVmomi import vim, vmodl  # pylint: disable=no-name-in-module
 
 from cvm.clients import make_filter_spec
+from cvm.models import HostRecord, make_vm_record
 
 
 def create_dv_port(vlan_id, vrouter_uuid):
@@ -21,6 +22,20 @@ def create_property_filter(obj, filters):
     return vmodl.query.PropertyCollector.Filter(filter_spec)
 
 
+def create_vm_record(vmware_vm, vm_properties, template=False):
+    host = vm_properties['summary.runtime.host']
+    host_record = HostRecord(uuid=host.hardware.systemInfo.uuid, name=host.name)
+    return make_vm_record(vmware_vm, vm_properties, vmware_vm.config.hardware.device, host_record, template)
+
+
+def create_event(event_type, key, vmware_vm=None, vm_name='VM1'):
+    event = Mock(spec=event_type())
+    event.key = key
+    event.vm.vm = vmware_vm
+    event.vm.name = vm_name
+    return event
+
+
 def reserve_vlan_ids(vlan_id_pool, vlan_ids):
     for vlan_id in vlan_ids:
         vlan_id_pool.reserve(vlan_id)